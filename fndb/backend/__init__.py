@@ -10,8 +10,61 @@ class BackendBase(object):
         and returns the resulting key"""
         raise NotImplementedError
 
+    def delete(self, key):
+        """Removes the value stored for key from the backend (if there is one)"""
+        raise NotImplementedError
+
+    def get_multi(self, keys):
+        """Returns a list of the values stored for `keys` (None for the missing
+        ones). Backends should override the *_multi methods if they can do
+        better than one call per key."""
+        return [self.get(key) for key in keys]
+
+    def put_multi(self, items):
+        """Writes the (key, value) pairs in `items` to the backend and returns
+        the list of resulting keys (see put)."""
+        return [self.put(key, value) for key, value in items]
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+
     def keys(self):
         raise NotImplementedError
 
+    def query(self, query, limit=None, position=None, keys_only=False, projection=None):
+        """Returns an iterator over the entities matching `query`, stopping
+        after `limit` entities if it is given. When `position` (a
+        utils.Position) is given, the results start after it and it's kept
+        up to date with where they got to (see utils.run_query). With
+        `keys_only` the Keys of the entities are returned instead. With
+        `projection` (a frozenset of property names) the entities only need
+        to have those properties, so the others needn't be loaded.
+
+        Backends override this to make use of whatever they can to speed up
+        the query. Raising NotImplementedError makes Query fall back to a
+        generic scan over keys()."""
+        raise NotImplementedError
+
+    def count(self, query, limit=None):
+        """Returns the number of entities matching `query` (or `limit`, if
+        there are more) when the backend can tell without going through
+        them, e.g. from its indexes. Otherwise returns None, and Query.count
+        runs a keys only query to count them."""
+        return None
+
+    def after_fork(self):
+        """Called in the processes forked to run a parallel query (see
+        utils.parallel_scan), which only read from the backend. Backends
+        replace anything that can't be used from the new process, e.g. locks
+        that another thread may have been holding or threads that weren't
+        copied."""
+        pass
+
+    def close(self):
+        """Called when the backend is being replaced (see BackendProxy.reconfigure),
+        gives backends a chance to write out anything they are holding on to."""
+        pass
+
 from .proxy import BackendProxy
 backend = BackendProxy()
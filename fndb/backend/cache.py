@@ -0,0 +1,204 @@
+from __future__ import absolute_import
+from fndb.backend import BackendBase, codec
+from fndb.backend.proxy import load_backend
+from collections import OrderedDict
+import threading
+import time
+
+# cached for keys the backend has no value for
+_MISSING = object()
+
+class BackendWrapper(BackendBase):
+    def __init__(self, name=None, backend=None, max_entries=10000, max_bytes=None,
+                 ttl=None, cache_misses=True):
+        """Creates a backend keeping the most recently used values of another
+        backend in memory.
+        backend: the settings of the backend being cached, e.g.
+                 {'name':'simplekv', 'store':..., 'root':...}
+        max_entries: how many values can be kept (None for no limit)
+        max_bytes: how much the kept values can add up to, using the size
+                   of their encoding (optional, it costs an encoding of every
+                   value that gets cached)
+        ttl: how many seconds a value is kept for (optional)
+        cache_misses: whether keys without a value are remembered too
+
+        Puts and deletes go to the cached backend and update the cache, so
+        it stays coherent as long as nothing else writes to that backend
+        (set a ttl if something does). The cache is shared by every thread.
+        """
+        if not isinstance(backend, dict):
+            raise ValueError("settings.BACKEND['backend'] needs to be set to the "
+                             "settings of the backend to cache, got: %r" % (backend,))
+        self.backend = load_backend(backend)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.cache_misses = cache_misses
+        # key -> (value, size, expiry time), least recently used first
+        self._cache = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # bumped by every write, values read while one was going on aren't
+        # cached as they may be from before it
+        self._writes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __getattr__(self, name):
+        # e.g. flush() or merge() of the cached backend
+        if name == 'backend':
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+    def stats(self):
+        """Returns the hit, miss and eviction counts and how much is cached."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'entries': len(self._cache),
+                    'bytes': self._bytes}
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+
+    def _lookup(self, key):
+        """Returns the cached value for `key` (_MISSING for a cached miss), or
+        None if it isn't cached. Called with the lock held."""
+        entry = self._cache.pop(key, None)
+        if entry is None:
+            return None
+        if entry[2] is not None and entry[2] < time.time():
+            self._bytes -= entry[1]
+            return None
+        self._cache[key] = entry
+        return entry[0]
+
+    def _store(self, key, value):
+        """Caches `value` (_MISSING for a miss). Called with the lock held."""
+        old = self._cache.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        if value is _MISSING:
+            if not self.cache_misses:
+                return
+            size = 0
+        else:
+            # the lists of repeated properties are the entity's own
+            value = dict((k, list(v) if isinstance(v, list) else v)
+                         for k, v in value.iteritems())
+            size = len(codec.dumps(value)) if self.max_bytes is not None else 0
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        self._cache[key] = (value, size, expires)
+        self._bytes += size
+        while ((self.max_entries is not None and len(self._cache) > self.max_entries) or
+               (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            _, (_, size, _) = self._cache.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    def get(self, key):
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                self.hits += 1
+                return None if value is _MISSING else value
+            self.misses += 1
+            writes = self._writes
+        value = self.backend.get(key)
+        with self._lock:
+            if self._writes == writes:
+                self._store(key, _MISSING if value is None else value)
+        return value
+
+    def get_multi(self, keys):
+        values = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                if key in values:
+                    continue
+                value = self._lookup(key)
+                if value is None:
+                    self.misses += 1
+                    values[key] = None
+                    missing.append(key)
+                else:
+                    self.hits += 1
+                    values[key] = None if value is _MISSING else value
+            writes = self._writes
+        if missing:
+            loaded = self.backend.get_multi(missing)
+            with self._lock:
+                for key, value in zip(missing, loaded):
+                    values[key] = value
+                    if self._writes == writes:
+                        self._store(key, _MISSING if value is None else value)
+        return [values[key] for key in keys]
+
+    def put(self, key, value):
+        return self.put_multi([(key, value)])[0]
+
+    def put_multi(self, items):
+        items = list(items)
+        with self._lock:
+            self._writes += 1
+        try:
+            keys = self.backend.put_multi(items)
+        except:
+            self._invalidate(key for key, _ in items)
+            raise
+        with self._lock:
+            self._writes += 1
+            for key, (_, value) in zip(keys, items):
+                self._store(key, value)
+        return keys
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        keys = list(keys)
+        with self._lock:
+            self._writes += 1
+        try:
+            self.backend.delete_multi(keys)
+        except:
+            self._invalidate(keys)
+            raise
+        with self._lock:
+            self._writes += 1
+            for key in keys:
+                self._store(key, _MISSING)
+
+    def _invalidate(self, keys):
+        with self._lock:
+            for key in keys:
+                entry = self._cache.pop(key, None)
+                if entry is not None:
+                    self._bytes -= entry[1]
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self.backend.after_fork()
+
+    def keys(self):
+        return self.backend.keys()
+
+    def count(self, query, limit=None):
+        return self.backend.count(query, limit)
+
+    def query(self, query, limit=None, position=None, keys_only=False, projection=None):
+        kwargs = {}
+        if position is not None:
+            kwargs['position'] = position
+        if keys_only:
+            kwargs['keys_only'] = True
+        if projection is not None:
+            kwargs['projection'] = projection
+        return self.backend.query(query, limit, **kwargs)
+
+    def close(self):
+        self.clear()
+        self.backend.close()
@@ -0,0 +1,280 @@
+"""
+Encodings used by the backends.
+
+The values they store (the dicts of property name to value made by
+Model._prepare_for_put) are pickled with the highest protocol, see dumps()
+and loads(); cPickle is both smaller and faster than anything that can be
+written in python for them.
+
+Query cursors hold the values the last result was sorted on, which are
+encoded with encode_values() as the cursors come from anywhere and can't be
+unpickled.
+
+Keys are encoded so that the encoded strings sort the way the keys do (see
+encode_key()), which is what the backends store and index them under.
+"""
+import datetime
+import struct
+import cPickle as pickle
+from cStringIO import StringIO
+from fndb.db import Key
+
+__all__ = ['dumps', 'loads']
+
+_I = struct.Struct('>I')
+_Q = struct.Struct('>q')
+_D = struct.Struct('>d')
+_DATETIME = struct.Struct('>HBBBBBI')
+_DATETIME_ATTRS = ('year', 'month', 'day', 'hour', 'minute', 'second',
+                   'microsecond')
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+
+def dumps(value):
+    """Encodes the dict `value` stored for an entity, returns a str."""
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+def loads(data, names=None):
+    """Decodes what dumps() returned (or a pickle of the value made with any
+    other protocol, as stored by older versions). `data` can be a str or a
+    buffer. If `names` (a frozenset of property names) is given, only those
+    properties are kept in the dict."""
+    if isinstance(data, str):
+        value = pickle.loads(data)
+    else:
+        value = pickle.load(StringIO(data))
+    if names is not None:
+        value = dict((k, v) for k, v in value.iteritems() if k in names)
+    return value
+
+def _encode_value(v):
+    """Returns what _encode() makes of `v`, as a str."""
+    out = []
+    _encode(v, out.append)
+    return ''.join(out)
+
+def _encode(v, append):
+    """Encodes a value as a tag followed by the value."""
+    t = type(v)
+    if t is unicode or t is str:
+        if t is unicode:
+            v = v.encode('utf-8')
+        if len(v) < 256:
+            # short ones (most of them) with a one byte length
+            append(('u' if t is unicode else 's') + chr(len(v)) + v)
+        else:
+            append(('U' if t is unicode else 'S') + _I.pack(len(v)) + v)
+    elif (t is int or t is long) and _INT64_MIN <= v <= _INT64_MAX:
+        append(('i' if t is int else 'l') + _Q.pack(v))
+    elif t is int or t is long:
+        # too large for the above, in decimal
+        v = str(v)
+        append('B' + chr(len(v)) + v)
+    elif t is bool:
+        append('T' if v else 'F')
+    elif v is None:
+        append('n')
+    elif t is float:
+        append('f' + _D.pack(v))
+    elif t is datetime.datetime and v.tzinfo is None:
+        append('t' + _DATETIME.pack(*[getattr(v, attr) for attr in _DATETIME_ATTRS]))
+    elif t is list or t is tuple:
+        append(('L' if t is list else 'R') + _I.pack(len(v)))
+        for i in v:
+            _encode(i, append)
+    elif t is Key:
+        flat = v.flat()
+        append('k' + chr(len(flat)))
+        for i in flat:
+            _encode(i, append)
+    else:
+        data = pickle.dumps(v, pickle.HIGHEST_PROTOCOL)
+        append('p' + _I.pack(len(data)) + data)
+
+def _decode_value(data, pos):
+    """Decodes what _encode() wrote at `pos`, returns the value and the
+    position after it. Pickled values raise ValueError."""
+    tag = data[pos]
+    pos += 1
+    if tag == 'u' or tag == 's':
+        end = pos + 1 + ord(data[pos])
+        v = data[pos + 1:end]
+        return (v.decode('utf-8') if tag == 'u' else v), end
+    if tag == 'U' or tag == 'S':
+        end = pos + 4 + _I.unpack_from(data, pos)[0]
+        v = data[pos + 4:end]
+        return (v.decode('utf-8') if tag == 'U' else v), end
+    if tag == 'i':
+        return _Q.unpack_from(data, pos)[0], pos + 8
+    if tag == 'T':
+        return True, pos
+    if tag == 'F':
+        return False, pos
+    if tag == 'n':
+        return None, pos
+    if tag == 'f':
+        return _D.unpack_from(data, pos)[0], pos + 8
+    if tag == 't':
+        return datetime.datetime(*_DATETIME.unpack_from(data, pos)), pos + _DATETIME.size
+    if tag == 'L' or tag == 'R':
+        count = _I.unpack_from(data, pos)[0]
+        pos += 4
+        items = []
+        for _ in xrange(count):
+            item, pos = _decode_value(data, pos)
+            items.append(item)
+        return (items if tag == 'L' else tuple(items)), pos
+    if tag == 'k':
+        count = ord(data[pos])
+        pos += 1
+        flat = []
+        for _ in xrange(count):
+            item, pos = _decode_value(data, pos)
+            flat.append(item)
+        return Key(*flat), pos
+    if tag == 'l':
+        return long(_Q.unpack_from(data, pos)[0]), pos + 8
+    if tag == 'B':
+        end = pos + 1 + ord(data[pos])
+        return long(data[pos + 1:end]), end
+    raise ValueError('Unknown value tag %r' % (tag,))
+
+def encode_values(values):
+    """Encodes a tuple of values of the types properties hold (e.g. for a
+    query Cursor), returns a str."""
+    return _encode_value(tuple(values))
+
+def decode_values(data):
+    """Decodes what encode_values() returned. As `data` may come from
+    anywhere, values that would have to be unpickled aren't: ValueError is
+    raised for them, as for anything else encode_values() can't have
+    returned."""
+    try:
+        values, end = _decode_value(data, 0)
+    except (IndexError, struct.error, UnicodeError, TypeError):
+        raise ValueError('Invalid encoded values')
+    if type(values) is not tuple or end != len(data):
+        raise ValueError('Invalid encoded values')
+    return values
+
+# Keys, encoded so that the encoded strings sort the way the keys do. Each
+# kind and string id is followed by a terminator, with the \0 bytes in them
+# escaped, and ids are preceded by their type (None < int < str, as python
+# compares them). Integer ids are stored big-endian with their sign bit
+# flipped. The ones that don't fit in 64 bits get tags of their own, before
+# and after those, followed by the number of bytes and the bytes of their
+# absolute value (all inverted for negative ones, so larger ones come
+# first). As a key's encoding is a prefix of its descendants', "all the
+# keys under this one" is a range of encoded keys (see key_range()).
+_TERMINATOR = '\x00\x01'
+_ESCAPED = '\x00\xff'
+_NONE_ID = '\x01'
+_NEGATIVE_ID = '\x02'
+_INT_ID = '\x03'
+_POSITIVE_ID = '\x04'
+_STR_ID = '\x05'
+_ID_OFFSET = 2 ** 63
+_U64 = struct.Struct('>Q')
+# turns the bytes of a negative id's absolute value around
+_INVERTED = ''.join(chr(255 - i) for i in range(256))
+
+def encode_key(key):
+    """Encodes a Key as a str sorting like the Key does."""
+    parts = []
+    append = parts.append
+    flat = key.flat()
+    for i in xrange(0, len(flat), 2):
+        append(flat[i].replace('\x00', _ESCAPED))
+        append(_TERMINATOR)
+        id = flat[i + 1]
+        if id is None:
+            append(_NONE_ID)
+        elif isinstance(id, str):
+            append(_STR_ID)
+            append(id.replace('\x00', _ESCAPED))
+            append(_TERMINATOR)
+        elif -_ID_OFFSET <= id < _ID_OFFSET:
+            append(_INT_ID + _U64.pack(id + _ID_OFFSET))
+        else:
+            append(_encode_big_id(id))
+    return ''.join(parts)
+
+def _encode_big_id(id):
+    digits = '%x' % abs(id)
+    data = (('0' if len(digits) % 2 else '') + digits).decode('hex')
+    if len(data) > 255:
+        raise ValueError('Key id %r is too large to be encoded' % (id,))
+    if id > 0:
+        return _POSITIVE_ID + chr(len(data)) + data
+    return _NEGATIVE_ID + (chr(len(data)) + data).translate(_INVERTED)
+
+def _decode_big_id(data, pos):
+    """Decodes the id _encode_big_id() wrote at `pos` (after the tag),
+    returns it and the position after it."""
+    negative = data[pos - 1] == _NEGATIVE_ID
+    length = ord(data[pos])
+    if negative:
+        length = 255 - length
+    end = pos + 1 + length
+    value = data[pos + 1:end]
+    if negative:
+        return -long(value.translate(_INVERTED).encode('hex'), 16), end
+    return long(value.encode('hex'), 16), end
+
+def _decode_string(data, pos):
+    end = data.find('\x00', pos)
+    if data[end + 1] == '\x01':
+        return data[pos:end], end + 2
+    # there are \0 bytes in it
+    parts = []
+    while data[end + 1] == '\xff':
+        parts.append(data[pos:end + 1])
+        pos = end + 2
+        end = data.find('\x00', pos)
+    parts.append(data[pos:end])
+    return ''.join(parts), end + 2
+
+def decode_key(data):
+    """Decodes what encode_key() returned."""
+    flat = []
+    append = flat.append
+    pos = 0
+    end = len(data)
+    while pos < end:
+        kind, pos = _decode_string(data, pos)
+        append(intern(kind))
+        tag = data[pos]
+        if tag == _INT_ID:
+            id = _U64.unpack_from(data, pos + 1)[0] - _ID_OFFSET
+            append(int(id))
+            pos += 9
+        elif tag == _STR_ID:
+            id, pos = _decode_string(data, pos + 1)
+            append(id)
+        elif tag == _POSITIVE_ID or tag == _NEGATIVE_ID:
+            id, pos = _decode_big_id(data, pos + 1)
+            append(id)
+        else:
+            append(None)
+            pos += 1
+    return Key._from_flat(tuple(flat))
+
+def key_range(ancestor=None, kind=None):
+    """Returns the (start, end) range the encoded keys of the descendants of
+    `ancestor` (at any depth) are in, only those under a `kind` entity if it
+    is given: start <= encoded key < end. With no ancestor, the range covers
+    the keys whose root entity is of `kind`. end is None when there's no
+    upper bound.
+    """
+    prefix = encode_key(ancestor) if ancestor is not None else ''
+    if kind is not None:
+        prefix += kind.replace('\x00', _ESCAPED) + _TERMINATOR
+        start = prefix
+    else:
+        # leaving out the ancestor itself
+        start = prefix + '\x00'
+    # the smallest string greater than everything starting with the prefix
+    end = prefix.rstrip('\xff')
+    if not end:
+        return start, None
+    return start, end[:-1] + chr(ord(end[-1]) + 1)
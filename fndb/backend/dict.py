@@ -1,33 +1,262 @@
 from __future__ import absolute_import
 from fndb.config import settings
 from fndb.backend import BackendBase, utils
+from fndb.backend.codec import encode_key, decode_key
+from fndb.backend.index import Index
 from fndb.db import Key
+from fndb.backend.log import AppendLog, read_records
+import atexit
 import cPickle as pickle
+import os
+import threading
+import weakref
 from collections import OrderedDict
 
+# names of the files kept in the `path` of a durable dict backend
+SNAPSHOT_FILE = 'snapshot'
+LOG_FILE = 'log'
+# the log being compacted into the snapshot
+OLD_LOG_FILE = 'log.old'
+
 class BackendWrapper(BackendBase):
-    def __init__(self, name=None, pickle_file=None):
+    def __init__(self, name=None, pickle_file=None, path=None, sync_every=1,
+                 compact_size=64 * 1024 * 1024):
         """Creates a dict based backend.
-        pickle_file: file to pickle the dict to (optional)
+        pickle_file: file to pickle the dict to (optional). It is loaded
+                     when the backend is created and rewritten by flush(),
+                     close() and when the process exits (if it's still
+                     open), use `path` to have every change saved.
+        path: directory to keep the data in (optional). Changes are appended
+              to a log in there, which is replayed on top of the last snapshot
+              of the data when the backend is created.
+        sync_every: how many changes can be written to the log before calling
+                    fsync (0 leaves it up to the OS)
+        compact_size: size (in bytes) the log can grow to before a new
+                      snapshot is written (in a background thread) and the
+                      log is started over
         """
         self.pickle_file = pickle_file
+        self.path = path
+        self.sync_every = sync_every
+        self.compact_size = compact_size
+        self.log = None
+        self._compaction = None
+        # whether there are changes pickle_file doesn't have
+        self._unsaved = False
+        # held by writers (for as long as it takes to log their changes)
+        self._lock = threading.RLock()
+        # held while changes are applied to the store and index, and by
+        # queries while they look through the index, so they neither see
+        # half made changes nor wait for the log to be written. gets don't
+        # need it, a lookup in the store is atomic
+        self._index_lock = threading.Lock()
         if pickle_file is not None:
             self.store = pickle.load(pickle_file)
             if not isinstance(self.store, dict):
                 raise ValueError, "pickle file '%s' does not contain a dict" % pickle_file
+            upgraded = _upgrade(self.store)
+            self._unsaved = upgraded is not self.store
+            self.store = upgraded
         else:
             self.store = OrderedDict()
+        if path is not None:
+            self._load()
+        self.index = Index(encode_key)
+        for k, v in self.store.iteritems():
+            self.index.add(decode_key(k), v)
+        if pickle_file is not None:
+            atexit.register(_flush_at_exit, weakref.ref(self))
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        """Loads the snapshot and replays the logs on top of it."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        if os.path.exists(self._file(SNAPSHOT_FILE)):
+            with open(self._file(SNAPSHOT_FILE), 'rb') as f:
+                self.store = _upgrade(pickle.load(f))
+        old_log = os.path.exists(self._file(OLD_LOG_FILE))
+        if old_log:
+            # a compaction didn't finish, so the snapshot may not have the
+            # changes in the old log
+            for record, _ in read_records(self._file(OLD_LOG_FILE)):
+                self._apply(record)
+        size = 0
+        for record, size in read_records(self._file(LOG_FILE)):
+            self._apply(record)
+        self.log = AppendLog(self._file(LOG_FILE), self.sync_every, size)
+        if old_log:
+            self.compact(wait=True)
+
+    def _apply(self, record):
+        op, dumped, value = record
+        if not _encoded(dumped):
+            # logged before keys were encoded by the codec
+            dumped = encode_key(load_key(dumped))
+        if op == 'put':
+            self.store[dumped] = value
+        else:
+            self.store.pop(dumped, None)
+
+    def compact(self, wait=False):
+        """Writes a snapshot of the data and starts a new log. The snapshot is
+        written in a background thread unless `wait` is True."""
+        if self.path is None:
+            return
+        with self._lock:
+            if self._compaction is not None:
+                self._compaction.join()
+            if not os.path.exists(self._file(OLD_LOG_FILE)):
+                self.log.close()
+                os.rename(self._file(LOG_FILE), self._file(OLD_LOG_FILE))
+                self.log = AppendLog(self._file(LOG_FILE), self.sync_every)
+            # the values are never changed in place, so a shallow copy is
+            # all the snapshot needs
+            store = OrderedDict(self.store)
+            self._compaction = threading.Thread(target=self._write_snapshot,
+                                                args=(store,))
+            self._compaction.daemon = True
+            self._compaction.start()
+        if wait:
+            self._compaction.join()
+
+    def _write_snapshot(self, store):
+        tmp = self._file(SNAPSHOT_FILE + '.tmp')
+        with open(tmp, 'wb') as f:
+            pickle.dump(store, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self._file(SNAPSHOT_FILE))
+        os.remove(self._file(OLD_LOG_FILE))
+
+    def _write(self, keys, records):
+        """Logs and applies the given (op, dumped key, value) records for
+        `keys`. Called with self._lock held."""
+        # made first, so that if a value can't be indexed nothing is written
+        rows = [self.index.row(key.kind(), record[2]) if record[0] == 'put' else None
+                for key, record in zip(keys, records)]
+        if self.log is not None:
+            for record in records:
+                self.log.append(record)
+            self.log.commit()
+        if records:
+            self._unsaved = True
+        with self._index_lock:
+            for key, record, row in zip(keys, records, rows):
+                self._apply(record)
+                if record[0] == 'put':
+                    self.index.add(key, row=row)
+                else:
+                    self.index.remove(key)
+        if (self.log is not None and self.log.size > self.compact_size and
+            (self._compaction is None or not self._compaction.is_alive())):
+            self.compact()
+
+    def flush(self):
+        """Makes sure all the changes are on disk."""
+        with self._lock:
+            if self.log is not None:
+                self.log.sync()
+            if self.pickle_file is not None and self._unsaved:
+                self.pickle_file.seek(0)
+                self.pickle_file.truncate()
+                pickle.dump(self.store, self.pickle_file, pickle.HIGHEST_PROTOCOL)
+                self.pickle_file.flush()
+                self._unsaved = False
+
+    def close(self):
+        with self._lock:
+            if self._compaction is not None:
+                self._compaction.join()
+            self.flush()
+            if self.log is not None:
+                self.log.close()
+
+    def after_fork(self):
+        self._lock = threading.RLock()
+        self._index_lock = threading.Lock()
+        self._compaction = None
+
     def get(self, key):
-        return self.store.get(dump_key(key))
+        return self.store.get(encode_key(key))
+    def get_multi(self, keys):
+        get = self.store.get
+        return [get(encode_key(key)) for key in keys]
     def put(self, key, value):
-        key = utils.validate_key(key)
-        self.store[dump_key(key)] = value
-        if self.pickle_file is not None:
-            pickle.dump(self.store, self.pickle_file)
-        return key
+        return self.put_multi([(key, value)])[0]
+    def put_multi(self, items):
+        keys = []
+        records = []
+        with self._lock:
+            for key, value in items:
+                key = utils.validate_key(key)
+                keys.append(key)
+                records.append(('put', encode_key(key), value))
+            self._write(keys, records)
+        return keys
+    def delete(self, key):
+        self.delete_multi([key])
+    def delete_multi(self, keys):
+        with self._lock:
+            keys = [key for key in keys if key in self.index]
+            self._write(keys, [('delete', encode_key(key), None) for key in keys])
     def keys(self):
-        return filter(None, [load_key(k) for k in self.store.iterkeys()])
+        with self._index_lock:
+            dumped = list(self.store)
+        return map(decode_key, dumped)
+    def count(self, query, limit=None):
+        with self._index_lock:
+            return self.index.count(query)
+
+    def query(self, query, limit=None, position=None, keys_only=False, projection=None):
+        # the index narrows things down to the right kind and ancestor (and
+        # the best property index range), and the values are already in
+        # memory so there is nothing else to load
+        with self._index_lock:
+            keys, ordered, exact = self.index.plan(query)
+        get = self.store.get
+        if projection is None:
+            load = lambda keys: ((decode_key(k), get(k)) for k in keys)
+        else:
+            load = lambda keys: ((decode_key(k), _project(get(k), projection)) for k in keys)
+        load_keys = (lambda keys: map(decode_key, keys)) if keys_only else None
+        return utils.run_query(query, keys, load, encode_key, limit, ordered, position,
+                               load_keys, exact)
+
+def _flush_at_exit(ref):
+    backend = ref()
+    if backend is not None and not backend.pickle_file.closed:
+        backend.flush()
+
+def _project(value, names):
+    if value is None:
+        return None
+    return dict((name, v) for name, v in value.iteritems() if name in names)
+
+def _encoded(dumped):
+    """Tells whether a stored key was encoded by codec.encode_key(), rather
+    than dumped by dump_key() (which older versions used). The kind is always
+    followed by a \\0 byte in the encoding, a dotted key never has one."""
+    return '\x00' in dumped
+
+def _upgrade(store):
+    """Re-encodes the keys of a store saved by an older version."""
+    if all(_encoded(k) for k in store):
+        return store
+    upgraded = OrderedDict()
+    for k, v in store.iteritems():
+        if not _encoded(k):
+            k = load_key(k)
+            if k is None:
+                continue
+            k = encode_key(k)
+        upgraded[k] = v
+    return upgraded
 
+# the dotted format keys were stored in before fndb.backend.codec encoded
+# them, a '.' in a string id doesn't survive it. Only kept to load old data.
 def dump_key(key):
     return '.'.join("{0}.{1}{2}".format(
         k, 'I' if isinstance(i, (int, long)) else 'S', i
@@ -0,0 +1,632 @@
+"""
+In memory indexes the backends keep next to their stores, so that queries
+only have to look at the keys that can actually match.
+
+Keys are held in their dumped (string) form. Ordered dicts are used as
+ordered sets so kind and ancestor results come back in the order the keys
+were first written, and property indexes are sorted lists of
+(value, ..., dumped key) entries, the values being in their _sort_value()
+form so that any two of them compare.
+"""
+import bisect
+import itertools
+import math
+from collections import OrderedDict
+from fndb.db import Key
+
+__all__ = ['Index', 'SortedIndex']
+
+# how values of different types sort: None first, then numbers, then the
+# other types by the name of their type (as python 2 does, but without
+# raising TypeError for the ones that refuse to be compared, e.g. datetimes
+# with None). str and unicode sort together, like they compare.
+_NUMBERS = frozenset([bool, int, long, float])
+_TYPE_NAMES = {unicode: 'str'}
+
+def _sort_value(value):
+    """Returns what `value` is compared as in the indexes and when sorting
+    results: a tuple of its type's rank and the value itself (always last,
+    see _value())."""
+    if value is None:
+        return (0, None)
+    t = type(value)
+    if t in _NUMBERS:
+        return (1, value)
+    return (2, _TYPE_NAMES.get(t) or t.__name__, value)
+
+def _value(sort_value):
+    """The value a _sort_value() was made of."""
+    return sort_value[-1]
+
+class _Max(object):
+    """Sorts after everything, used to find the end of a run of equal values."""
+    def __lt__(self, other):
+        return False
+    def __gt__(self, other):
+        return True
+    def __le__(self, other):
+        return self is other
+    def __ge__(self, other):
+        return True
+_MAX = _Max()
+
+class _Desc(object):
+    """Wraps the values of descending index columns so they sort in reverse."""
+    def __init__(self, value):
+        self.value = value
+    def __eq__(self, other):
+        if not isinstance(other, _Desc):
+            return NotImplemented
+        return self.value == other.value
+    def __ne__(self, other):
+        if not isinstance(other, _Desc):
+            return NotImplemented
+        return self.value != other.value
+    def __lt__(self, other):
+        if not isinstance(other, _Desc):
+            return NotImplemented
+        return other.value < self.value
+    def __le__(self, other):
+        if not isinstance(other, _Desc):
+            return NotImplemented
+        return other.value <= self.value
+    def __gt__(self, other):
+        if not isinstance(other, _Desc):
+            return NotImplemented
+        return other.value > self.value
+    def __ge__(self, other):
+        if not isinstance(other, _Desc):
+            return NotImplemented
+        return other.value >= self.value
+    def __hash__(self):
+        return hash(self.value)
+
+# what a comparison becomes on a descending column
+_FLIPPED = {'=': '=', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+class SortedIndex(object):
+    """Sorted list of (value, ..., dumped key) entries, used both for the index
+    of a single property (one value per entry) and for composite indexes.
+    Repeated properties get an entry for each of their values.
+
+    entities: the number of entities that have been through this index (some
+              of them may not have any entries, e.g. empty repeated properties)
+    empty: the dumped keys of the entities that didn't get any entries
+    """
+    # the comparisons that can be answered with a range of the index
+    OPERATORS = ('=', '<', '<=', '>', '>=')
+
+    def __init__(self):
+        self.entries = []
+        self.entities = 0
+        self.empty = set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, values, dumped):
+        bisect.insort(self.entries, values + (dumped,))
+
+    def remove(self, values, dumped):
+        entry = values + (dumped,)
+        i = bisect.bisect_left(self.entries, entry)
+        if i < len(self.entries) and self.entries[i] == entry:
+            del self.entries[i]
+
+    def bounds(self, prefix=(), opsymbol=None, value=None):
+        """Returns the (start, end) slice of the entries starting with the
+        values in `prefix` and, if `opsymbol` is given, whose next value
+        satisfies `opsymbol value`."""
+        entries = self.entries
+        start = bisect.bisect_left(entries, prefix)
+        end = bisect.bisect_left(entries, prefix + (_MAX,))
+        if opsymbol is not None:
+            if opsymbol not in self.OPERATORS:
+                raise ValueError('unsupported index operator %r' % opsymbol)
+            if opsymbol in ('=', '>='):
+                start = bisect.bisect_left(entries, prefix + (value,))
+            elif opsymbol == '>':
+                start = bisect.bisect_left(entries, prefix + (value, _MAX))
+            if opsymbol in ('=', '<='):
+                end = bisect.bisect_left(entries, prefix + (value, _MAX))
+            elif opsymbol == '<':
+                end = bisect.bisect_left(entries, prefix + (value,))
+        return start, max(start, end)
+
+    def keys(self, start, end, reverse=False, width=None, empty=False):
+        """Returns the dumped keys in the given slice of the entries, in index
+        order (or the reverse of it) and without duplicates.
+
+        width: how many of the values the keys are wanted in the order of.
+               The entries with the same first `width` values are given out
+               in the order of their keys (rather than in the order of the
+               values after those, or in reverse).
+        empty: whether to add the keys in `empty` (in key order) where None
+               values would be: first, or last in reverse
+        """
+        entries = self.entries[start:end]
+        if reverse:
+            entries.reverse()
+        if width is not None and entries and (reverse or width < len(entries[0]) - 1):
+            # (otherwise they already are)
+            entries = _by_key(entries, width)
+        seen = set()
+        keys = []
+        for entry in entries:
+            dumped = entry[-1]
+            if dumped not in seen:
+                seen.add(dumped)
+                keys.append(dumped)
+        if empty and self.empty:
+            if reverse:
+                keys.extend(sorted(self.empty))
+            else:
+                keys[:0] = sorted(self.empty)
+        return keys
+
+def _by_key(entries, width):
+    """Sorts the runs of `entries` with the same first `width` values by their
+    dumped keys."""
+    result = []
+    for _, run in itertools.groupby(entries, lambda entry: entry[:width]):
+        result.extend(sorted(run, key=lambda entry: entry[-1]))
+    return result
+
+class Union(list):
+    """The candidate keys of an OR query, as returned by Index.plan: the keys
+    of every one of its branches, once each.
+
+    branches: when the query has orders and the keys of every branch are in
+              that order, the lists of keys of the branches (so the results
+              can be merged in order, see utils.run_query), otherwise None
+    """
+    branches = None
+
+class Index(object):
+    """Index of the keys of every kind, of the children of every key, and of
+    the values of the indexed properties of every entity.
+
+    kinds: kind -> ordered set of dumped keys
+    children: dumped parent key -> kind -> ordered set of dumped keys
+    properties: kind -> index name -> SortedIndex. The name of the index of a
+                single property is the property's name, composite indexes are
+                named by their columns (see Model._composite_indexes)
+    rows: dumped key -> the (index name, [values, ...]) entries of the entity
+    """
+    version = 6
+
+    def __init__(self, dump_key):
+        """dump_key: function turning a Key into the string the backend stores
+        it under"""
+        self.dump_key = dump_key
+        self.kinds = {}
+        self.children = {}
+        self.properties = {}
+        self.rows = {}
+
+    def __len__(self):
+        """The number of keys in the index."""
+        return sum(len(keys) for keys in self.kinds.itervalues())
+
+    def __contains__(self, key):
+        keys = self.kinds.get(key.kind())
+        return keys is not None and self.dump_key(key) in keys
+
+    def row(self, kind, value):
+        """Returns the index entries of the stored `value` of an entity of
+        `kind`, to be given to add(). Backends get it before writing the
+        value, so a value that can't be indexed is never written."""
+        return tuple(_index_rows(kind, value))
+
+    def add(self, key, value=None, row=None):
+        """Adds `key` to the index, along with the indexed properties of `value`
+        (the dict stored for the key), or the entries of `row` if it has
+        already been made by row(). Returns False if the key was already
+        there, in which case only its property entries are updated.
+        """
+        dumped = self.dump_key(key)
+        kind = key.kind()
+        keys = self.kinds.setdefault(kind, OrderedDict())
+        new = dumped not in keys
+        if new:
+            keys[dumped] = None
+            parent = key.parent()
+            if parent is not None:
+                kinds = self.children.setdefault(self.dump_key(parent), {})
+                kinds.setdefault(kind, OrderedDict())[dumped] = None
+        if row is None and value is not None:
+            row = self.row(kind, value)
+        self._remove_row(kind, dumped)
+        if row is not None:
+            if row:
+                indexes = self.properties.setdefault(kind, {})
+                for name, entries in row:
+                    index = indexes.get(name)
+                    if index is None:
+                        index = indexes[name] = SortedIndex()
+                    index.entities += 1
+                    if not entries:
+                        index.empty.add(dumped)
+                    for values in entries:
+                        index.add(values, dumped)
+                self.rows[dumped] = row
+        return new
+
+    def remove(self, key):
+        """Removes `key` from the index. Returns False if it wasn't there."""
+        dumped = self.dump_key(key)
+        kind = key.kind()
+        keys = self.kinds.get(kind)
+        if keys is None or dumped not in keys:
+            return False
+        del keys[dumped]
+        parent = key.parent()
+        if parent is not None:
+            dumped_parent = self.dump_key(parent)
+            kinds = self.children[dumped_parent]
+            del kinds[kind][dumped]
+            if not kinds[kind]:
+                del kinds[kind]
+                if not kinds:
+                    del self.children[dumped_parent]
+        self._remove_row(kind, dumped)
+        return True
+
+    def _remove_row(self, kind, dumped):
+        row = self.rows.pop(dumped, None)
+        if row:
+            indexes = self.properties[kind]
+            for name, entries in row:
+                index = indexes[name]
+                index.entities -= 1
+                index.empty.discard(dumped)
+                for values in entries:
+                    index.remove(values, dumped)
+
+    def keys(self, kind=None, ancestor=None):
+        """Returns a list of the dumped keys with the given kind and parent.
+        A list is returned (rather than an iterator) so the index can be
+        updated while the results are being used.
+        """
+        if ancestor is not None:
+            kinds = self.children.get(self.dump_key(ancestor), {})
+        else:
+            kinds = self.kinds
+        if kind is not None:
+            return list(kinds.get(kind, ()))
+        return [k for keys in kinds.itervalues() for k in keys]
+
+    def projection(self, kind, names):
+        """Returns a function giving the values of the properties `names` of
+        an entity of `kind`, from its dumped key, rebuilt from its index
+        entries (a dict, as stored but with only those properties). Returns
+        None if the index doesn't have them all, which it only does for the
+        declared and indexed properties of the model.
+        """
+        from fndb.db import model
+        cls = model.Model._kind_map.get(kind)
+        if cls is None or issubclass(cls, model.Expando):
+            return None
+        properties = cls._properties
+        if not all(name in properties and properties[name]._indexed for name in names):
+            return None
+        repeated = cls._plan.repeated
+        rows = self.rows
+        def values(dumped):
+            value = {}
+            for name, entries in rows.get(dumped, ()):
+                if name in names:
+                    if name in repeated:
+                        value[name] = [_value(v) for v, in entries]
+                    elif entries:
+                        value[name] = _value(entries[0][0])
+            return value
+        return values
+
+    def count(self, query):
+        """Returns the number of entities matching `query` if the index can
+        answer all of its filters, otherwise None. Without filters that's the
+        number of keys of the kind (or of the kind under the ancestor), which
+        is kept as they are added and removed, so nothing is gone through.
+        """
+        from fndb.db.query import FalseNode
+        if isinstance(query.filters, FalseNode):
+            return 0
+        if query.filters is None:
+            if query.ancestor is not None:
+                kinds = self.children.get(self.dump_key(query.ancestor), {})
+            else:
+                kinds = self.kinds
+            if query.kind is not None:
+                return len(kinds.get(query.kind, ()))
+            return sum(len(keys) for keys in kinds.itervalues())
+        keys, _, exact = self.plan(query)
+        return len(keys) if exact else None
+
+    def candidates(self, query):
+        """Works out which index to use for `query`.
+
+        Returns a (keys, ordered) tuple: keys is a list of the dumped keys that
+        may match the query, and ordered tells whether they are already sorted
+        according to the query's orders.
+
+        The kind and ancestor are always satisfied, the filters are only used
+        to narrow things down (using the smallest index range available, or a
+        composite index that also gives the right order), so they still need
+        to be checked against the entities.
+        """
+        keys, ordered, _ = self.plan(query)
+        return keys, ordered
+
+    def plan(self, query):
+        """Like candidates(), but returns a (keys, ordered, exact) tuple, exact
+        telling whether the index range answers all the filters, in which case
+        every one of the keys matches the query (e.g. for a keys only query
+        nothing needs to be loaded)."""
+        from fndb.db.query import FilterNode, ConjunctionNode, DisjunctionNode, FalseNode
+        filters = query.filters
+        if isinstance(filters, FalseNode):
+            return [], True, True
+        if isinstance(filters, DisjunctionNode):
+            return self._union(query, filters)
+        if filters is None:
+            filters = []
+        elif isinstance(filters, FilterNode):
+            filters = [filters]
+        elif isinstance(filters, ConjunctionNode):
+            filters = list(filters)
+        else:
+            # nothing to narrow things down with
+            filters = [None]
+        total = len(filters)
+        filters = [f for f in filters if isinstance(f, FilterNode)]
+        orders = _orders(query)
+        plans = []
+        if query.kind is not None:
+            plans.extend(self._property_plans(query.kind, filters, orders))
+            plans.extend(self._composite_plans(query.kind, filters, orders))
+        if not plans:
+            return self.keys(query.kind, query.ancestor), not orders, not total
+        index, start, end, reverse, ordered, covered, width, empty = min(plans, key=_cost)
+        exact = covered == total
+        if not ordered or not orders:
+            width = None
+        if query.ancestor is not None:
+            children = self.children.get(self.dump_key(query.ancestor), {})
+            children = children.get(query.kind, ())
+            if len(children) < end - start and (not ordered or not orders):
+                return list(children), not orders, not total
+            return ([k for k in index.keys(start, end, reverse, width, empty)
+                     if k in children], ordered, exact)
+        return index.keys(start, end, reverse, width, empty), ordered, exact
+
+    def _union(self, query, filters):
+        """plan() for an OR (ConjunctionNodes distribute their ORs, so they're
+        always at the top): each branch gets its own plan, and the candidates
+        are the union of theirs, which are only all sorted if there are no
+        orders."""
+        keys = Union()
+        seen = set()
+        exact = True
+        branches = []
+        for node in filters:
+            branch = query.__class__(kind=query.kind, ancestor=query.ancestor,
+                                     filters=node, orders=query.orders)
+            branch_keys, ordered, branch_exact = self.plan(branch)
+            exact = exact and branch_exact
+            branches.append((branch_keys, ordered))
+            for k in branch_keys:
+                if k not in seen:
+                    seen.add(k)
+                    keys.append(k)
+        if query.orders is None:
+            return keys, True, exact
+        if all(ordered for _, ordered in branches):
+            keys.branches = [branch_keys for branch_keys, _ in branches]
+        return keys, False, exact
+
+    def _property_plans(self, kind, filters, orders):
+        """Finds the smallest range of each single property index covering
+        `filters`. If there's a single order, the index of that property is
+        also used (all of it if there are no filters on the property) as it
+        is already in the right order. Returns a list of (index, start, end,
+        reverse, ordered, covered, width, empty) tuples, covered being the
+        number of filters the range answers, and width and empty what the keys
+        are to be read with (see SortedIndex.keys).
+        """
+        from fndb.db import model
+        cls = model.Model._kind_map.get(kind)
+        indexes = self.properties.get(kind, {})
+        ranges = {}
+        for f in filters:
+            if f.opsymbol not in SortedIndex.OPERATORS:
+                continue
+            if f.name == '__key__':
+                # the keys aren't in a property index, but an equality is
+                # answered by looking the key up
+                if f.opsymbol == '=' and isinstance(f.value, Key):
+                    index = SortedIndex()
+                    dumped = self.dump_key(f.value)
+                    if dumped in self.kinds.get(kind, ()):
+                        index.entries.append((_sort_value(f.value), dumped))
+                    ranges[f.name] = (index, 0, len(index), False, True, 1, 1, False)
+                continue
+            prop = cls._properties.get(f.name) if cls is not None else None
+            if prop is not None and not prop._indexed:
+                continue
+            index = indexes.get(f.name)
+            if index is None:
+                # nothing has been indexed with this property yet
+                return [(SortedIndex(), 0, 0, False, True, len(filters), 1, False)]
+            start, end = index.bounds((), f.opsymbol, _sort_value(f.value))
+            covered = 1
+            if f.name in ranges and prop is not None and not prop._repeated:
+                # filters on the same single valued property narrow down the
+                # same range (e.g. a > 1 and a < 5). this doesn't work for
+                # repeated properties as each filter may match a different value
+                _, s, e, _, _, c, _, _ = ranges[f.name]
+                start, end = max(start, s), max(max(start, s), min(end, e))
+                covered += c
+            if f.name not in ranges or end - start < ranges[f.name][2] - ranges[f.name][1]:
+                ranges[f.name] = (index, start, end, False, not orders, covered, 1, False)
+        if len(orders) == 1:
+            order = orders[0]
+            prop = cls._properties.get(order.name) if cls is not None else None
+            index = indexes.get(order.name)
+            # every entity needs to have been through the index (so it's no use
+            # for unindexed properties). the ones with an empty list sort as
+            # None, and can only be left out if there's a filter on the
+            # property (which they can't match)
+            if (index is not None and (prop is None or prop._indexed) and
+                index.entities == len(self.kinds.get(kind, ()))):
+                reverse = order.direction == order.DESCENDING
+                if order.name in ranges and prop is not None and prop._repeated:
+                    # entities sort on their smallest (or largest) value, which
+                    # may be outside of the range, so it's all of the index
+                    ranges[None] = (index, 0, len(index), reverse, True, 0, 1, False)
+                else:
+                    index, start, end, _, _, covered, _, _ = ranges.get(
+                        order.name, (index, 0, len(index), 0, 0, 0, 1, True))
+                    ranges[order.name] = (index, start, end, reverse, True, covered, 1,
+                                          not covered)
+        return ranges.values()
+
+    def _composite_plans(self, kind, filters, orders):
+        """Finds the composite indexes that can answer `filters` with a single
+        range: the equality filters have to cover the first columns of the
+        index, and the columns after that have to match `orders` (or all be in
+        the opposite direction, in which case the range is read backwards).
+        A range filter on the column right after the equalities narrows the
+        range down further. Returns a list of (index, start, end, reverse,
+        ordered, covered, width, empty) tuples.
+        """
+        from fndb.db import model
+        cls = model.Model._kind_map.get(kind)
+        if cls is None or not cls._composite_indexes:
+            return []
+        indexes = self.properties.get(kind, {})
+        total = len(self.kinds.get(kind, ()))
+        equalities = {}
+        ranges = {}
+        for f in filters:
+            if f.opsymbol == '=':
+                equalities.setdefault(f.name, []).append(f.value)
+            elif f.opsymbol in SortedIndex.OPERATORS:
+                ranges.setdefault(f.name, []).append(f)
+        # two equalities on the same (repeated) property can't be a prefix
+        equalities = dict((name, values[0]) for name, values in equalities.iteritems()
+                          if len(values) == 1)
+        orders = [(o.name, o.direction == o.DESCENDING) for o in orders]
+        plans = []
+        for columns in cls._composite_indexes:
+            index = indexes.get(columns)
+            if index is None or index.entities != total or index.empty:
+                # entities written before the index was declared aren't in it,
+                # nor are those with an empty list for one of its columns
+                continue
+            n = len(equalities)
+            if len(columns) < n or set(name for name, _ in columns[:n]) != set(equalities):
+                continue
+            prefix = tuple(_Desc(_sort_value(equalities[name])) if descending
+                           else _sort_value(equalities[name])
+                           for name, descending in columns[:n])
+            rest = columns[n:]
+            reverse = False
+            if orders:
+                if [name for name, _ in rest[:len(orders)]] != [name for name, _ in orders]:
+                    continue
+                flipped = set(d1 != d2 for (_, d1), (_, d2) in zip(rest, orders))
+                if len(flipped) > 1:
+                    continue
+                reverse = flipped.pop()
+            start, end = index.bounds(prefix)
+            covered = n
+            ranged = False
+            ordered = True
+            if rest and rest[0][0] in ranges:
+                name, descending = rest[0]
+                fs = ranges[name]
+                if cls._properties[name]._repeated:
+                    fs = fs[:1]
+                    if orders:
+                        # entities sort on their smallest (or largest) value,
+                        # which may be outside of the range: only all of the
+                        # prefix is in order
+                        plans.append((index, start, end, reverse, True, covered,
+                                      n + len(orders), False))
+                        ordered = False
+                for f in fs:
+                    opsymbol, value = f.opsymbol, _sort_value(f.value)
+                    if descending:
+                        opsymbol, value = _FLIPPED[opsymbol], _Desc(value)
+                    s, e = index.bounds(prefix, opsymbol, value)
+                    start, end = max(start, s), max(max(start, s), min(end, e))
+                covered += len(fs)
+                ranged = True
+            if not n and not orders and not ranged:
+                continue
+            plans.append((index, start, end, reverse, ordered, covered, n + len(orders),
+                          False))
+        return plans
+
+def _orders(query):
+    """Returns a list of the orders of `query` that actually order its
+    results. Ordering on a property that has to be equal to something is a
+    no-op, unless it's repeated (entities sort on their smallest or largest
+    value, which isn't necessarily the one that's equal)."""
+    from fndb.db.query import FilterNode, ConjunctionNode
+    if query.orders is None:
+        return []
+    filters = query.filters
+    if isinstance(filters, FilterNode):
+        filters = [filters]
+    elif isinstance(filters, ConjunctionNode):
+        filters = [f for f in filters if isinstance(f, FilterNode)]
+    else:
+        filters = []
+    from fndb.db import model
+    cls = model.Model._kind_map.get(query.kind)
+    equalities = set(f.name for f in filters if f.opsymbol == '=' and
+                     cls is not None and f.name in cls._properties and
+                     not cls._properties[f.name]._repeated)
+    return [o for o in query.orders if o.name not in equalities]
+
+def _cost(plan):
+    """Rough cost of going through the keys of a plan: unordered ones still
+    need to be sorted (if there are any orders)."""
+    _, start, end, _, ordered, _, _, _ = plan
+    size = end - start
+    if ordered:
+        return size
+    return size * math.log(size + 2, 2)
+
+def _index_rows(kind, value):
+    """Yields the (index name, [values, ...]) entries for the stored `value` of
+    an entity of `kind`, the values in their _sort_value() form. Properties
+    declared with indexed=False are left out, and repeated properties get an
+    entry per value (in composite indexes, an entry for every combination of
+    values).
+
+    If the model class for `kind` isn't known (yet), every property is indexed.
+    """
+    from fndb.db import model
+    cls = model.Model._kind_map.get(kind)
+    for name, v in value.iteritems():
+        prop = cls._properties.get(name) if cls is not None else None
+        if prop is not None and not prop._indexed:
+            continue
+        if isinstance(v, (list, tuple)):
+            yield name, [(_sort_value(i),) for i in v]
+        else:
+            yield name, [(_sort_value(v),)]
+    if cls is not None:
+        for columns in cls._composite_indexes:
+            values = []
+            for name, descending in columns:
+                v = value.get(name)
+                v = list(v) if isinstance(v, (list, tuple)) else [v]
+                v = [_sort_value(i) for i in v]
+                if descending:
+                    v = [_Desc(i) for i in v]
+                values.append(v)
+            yield columns, list(itertools.product(*values))
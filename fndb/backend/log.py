@@ -0,0 +1,84 @@
+"""
+Append only log files, used to make in memory backends durable without
+writing out everything they hold on every change.
+
+Every record is a pickled object, preceded by its length and crc32 so that
+what's left of an interrupted write at the end of the file can be detected
+(and dropped) when the log is read back.
+"""
+import os
+import struct
+import zlib
+import cPickle as pickle
+
+__all__ = ['AppendLog', 'read_records']
+
+_HEADER = struct.Struct('>II')
+
+def read_records(filename):
+    """Yields the records in the log file `filename` along with the offset of
+    the end of each one. Stops at the first incomplete or corrupt record.
+    Nothing is yielded if the file doesn't exist.
+    """
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as f:
+        end = 0
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            length, crc = _HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                return
+            end += _HEADER.size + length
+            yield pickle.loads(data), end
+
+class AppendLog(object):
+    """An append only log file.
+
+    Records are written with append() and made durable with commit(), which
+    only calls fsync once every `sync_every` records so the cost of it can be
+    spread over several writes (0 never calls it, leaving it up to the OS).
+    """
+    def __init__(self, filename, sync_every=1, size=None):
+        """filename: the file to append to (created if it doesn't exist)
+        sync_every: how many records can be written between two fsync calls
+        size: where the valid records end (see read_records), anything after
+              that is cut off before appending
+        """
+        self.filename = filename
+        self.sync_every = sync_every
+        self._unsynced = 0
+        self._file = open(filename, 'ab')
+        if size is not None and size < os.path.getsize(filename):
+            self._file.truncate(size)
+        self._file.seek(0, os.SEEK_END)
+
+    @property
+    def size(self):
+        return self._file.tell()
+
+    def append(self, record):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self._file.write(_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff))
+        self._file.write(data)
+        self._unsynced += 1
+
+    def commit(self):
+        """Hands the appended records to the OS, and makes sure they are on
+        disk if `sync_every` records have been written since the last time."""
+        self._file.flush()
+        if self.sync_every and self._unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
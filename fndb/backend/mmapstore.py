@@ -0,0 +1,342 @@
+from __future__ import absolute_import
+from fndb.backend import BackendBase, codec, utils
+from fndb.backend.index import Index
+from fndb.backend.codec import encode_key, decode_key
+import cPickle as pickle
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+# every record is: crc32 of the key and value, the operation, the length of
+# the key, the length of the value, followed by the key and the value
+_HEADER = struct.Struct('>IBII')
+_PUT = 1
+_DELETE = 2
+# first record of a segment written by a merge, its value is the id of the
+# first segment that was merged into it
+_MERGED = 3
+
+SEGMENT_SUFFIX = '.seg'
+# the index, saved when the backend is closed
+INDEX_FILE = 'index'
+MERGE_FILE = 'merge.tmp'
+
+def _record(op, dumped, data):
+    crc = zlib.crc32(data, zlib.crc32(dumped)) & 0xffffffff
+    return _HEADER.pack(crc, op, len(dumped), len(data)) + dumped + data
+
+class _Segment(object):
+    """A segment file, read through an mmap of it."""
+    def __init__(self, path, id):
+        self.id = id
+        self.filename = os.path.join(path, '%08d%s' % (id, SEGMENT_SUFFIX))
+        self.size = os.path.getsize(self.filename) if os.path.exists(self.filename) else 0
+        self._map = None
+
+    def view(self, offset, length):
+        """Returns a buffer over part of the file (no copying involved)."""
+        if self._map is None or offset + length > len(self._map):
+            # the segment being written to has grown since it was mapped
+            self._remap()
+        return buffer(self._map, offset, length)
+
+    def _remap(self):
+        with open(self.filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def records(self):
+        """Yields (op, dumped key, value offset, value length, end of record)
+        for the records in the segment, stopping at the first incomplete or
+        corrupt one."""
+        if not self.size:
+            return
+        self._remap()
+        data = self._map
+        pos = 0
+        while pos + _HEADER.size <= len(data):
+            crc, op, klen, vlen = _HEADER.unpack_from(data, pos)
+            start = pos + _HEADER.size
+            end = start + klen + vlen
+            if end > len(data):
+                return
+            dumped = data[start:start + klen]
+            value = buffer(data, start + klen, vlen)
+            if zlib.crc32(value, zlib.crc32(dumped)) & 0xffffffff != crc:
+                return
+            yield op, dumped, start + klen, vlen, end
+            pos = end
+
+class BackendWrapper(BackendBase):
+    def __init__(self, name=None, path=None, segment_size=64 * 1024 * 1024,
+                 merge_segments=4, sync_every=1):
+        """Creates a log structured backend, keeping its data in mmap'd
+        segment files.
+        path: directory to keep the segment files in
+        segment_size: size (in bytes) a segment can grow to before a new one
+                      is started
+        merge_segments: how many full segments there can be before they are
+                        merged (in a background thread) into one that only
+                        has the current values in it
+        sync_every: how many changes can be written before calling fsync (0
+                    leaves it up to the OS)
+
+        Writes are appended to the last segment, and an in memory hash of
+        where the current value of every key is makes reads a single slice
+        of a segment's mmap.
+        """
+        if path is None:
+            raise ValueError("settings.BACKEND['path'] needs to be set to the "
+                             "directory to keep the data in")
+        self.path = path
+        self.segment_size = segment_size
+        self.merge_segments = merge_segments
+        self.sync_every = sync_every
+        self._unsynced = 0
+        self._lock = threading.RLock()
+        self._merge = None
+        self._open()
+
+    def _open(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        if os.path.exists(os.path.join(self.path, MERGE_FILE)):
+            os.remove(os.path.join(self.path, MERGE_FILE))
+        ids = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                     if name.endswith(SEGMENT_SUFFIX))
+        self.segments = {}
+        for id in ids:
+            self.segments[id] = _Segment(self.path, id)
+        for id in ids:
+            if id not in self.segments:
+                continue
+            for op, _, offset, length, _ in self.segments[id].records():
+                if op == _MERGED:
+                    # a merge didn't get to remove the segments it merged
+                    first = int(str(self.segments[id].view(offset, length)))
+                    for merged in ids:
+                        if first <= merged < id and merged in self.segments:
+                            os.remove(self.segments.pop(merged).filename)
+                break
+        if not self._load_index():
+            self._scan()
+        if not self.segments:
+            self.segments[1] = _Segment(self.path, 1)
+        self._active = self.segments[max(self.segments)]
+        self._file = open(self._active.filename, 'ab')
+        if self._active.size < os.path.getsize(self._active.filename):
+            # drop what's left of an interrupted write
+            self._file.truncate(self._active.size)
+        self._file.seek(0, os.SEEK_END)
+
+    def _state(self):
+        return sorted((id, s.size) for id, s in self.segments.iteritems())
+
+    def _load_index(self):
+        """Loads the index saved by close(), if it is for the segments as
+        they are now."""
+        filename = os.path.join(self.path, INDEX_FILE)
+        if not os.path.exists(filename):
+            return False
+        with open(filename, 'rb') as f:
+            state, keydir, index = pickle.load(f)
+        # it's only good until the next write
+        os.remove(filename)
+        if state != self._state() or getattr(index, 'version', None) != Index.version:
+            return False
+        self.keydir = keydir
+        self.index = index
+        return True
+
+    def _scan(self):
+        """Builds the keydir and index by going through all the segments."""
+        self.keydir = {}
+        for id in sorted(self.segments):
+            segment = self.segments[id]
+            end = 0
+            for op, dumped, offset, length, end in segment.records():
+                if op == _PUT:
+                    self.keydir[dumped] = (id, offset, length)
+                elif op == _DELETE:
+                    self.keydir.pop(dumped, None)
+            segment.size = end
+        self.index = Index(encode_key)
+        for dumped in self.keydir:
+            self.index.add(decode_key(dumped), self._get(dumped))
+
+    def close(self):
+        # the merge needs the lock to finish
+        if self._merge is not None:
+            self._merge.join()
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            with open(os.path.join(self.path, INDEX_FILE), 'wb') as f:
+                pickle.dump((self._state(), self.keydir, self.index), f,
+                            pickle.HIGHEST_PROTOCOL)
+
+    def after_fork(self):
+        self._lock = threading.RLock()
+        self._merge = None
+
+    def _get(self, dumped, names=None):
+        with self._lock:
+            location = self.keydir.get(dumped)
+            if location is None:
+                return None
+            id, offset, length = location
+            # mapped while holding the lock, as a merge may remove the file
+            view = self.segments[id].view(offset, length)
+        return codec.loads(view, names)
+
+    def get(self, key):
+        return self._get(encode_key(key))
+    def get_multi(self, keys):
+        return [self._get(encode_key(key)) for key in keys]
+
+    def _append(self, op, dumped, data):
+        """Appends a record to the active segment, returns the offset of its
+        value."""
+        record = _record(op, dumped, data)
+        self._file.write(record)
+        self._active.size += len(record)
+        self._unsynced += 1
+        return self._active.size - len(data)
+
+    def _commit(self):
+        self._file.flush()
+        if self.sync_every and self._unsynced >= self.sync_every:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        if self._active.size >= self.segment_size:
+            self._roll()
+
+    def _roll(self):
+        """Starts a new segment, merging the full ones if there are enough."""
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._unsynced = 0
+        id = self._active.id + 1
+        self._active = self.segments[id] = _Segment(self.path, id)
+        self._file = open(self._active.filename, 'ab')
+        if len(self.segments) > self.merge_segments:
+            self.merge()
+
+    def put(self, key, value):
+        return self.put_multi([(key, value)])[0]
+    def put_multi(self, items):
+        keys = []
+        with self._lock:
+            for key, value in items:
+                key = utils.validate_key(key)
+                dumped = encode_key(key)
+                # made first, so that if a value can't be indexed nothing is written
+                row = self.index.row(key.kind(), value)
+                data = codec.dumps(value)
+                offset = self._append(_PUT, dumped, data)
+                self.keydir[dumped] = (self._active.id, offset, len(data))
+                self.index.add(key, row=row)
+                keys.append(key)
+            self._commit()
+        return keys
+
+    def delete(self, key):
+        self.delete_multi([key])
+    def delete_multi(self, keys):
+        with self._lock:
+            for key in keys:
+                dumped = encode_key(key)
+                if dumped in self.keydir:
+                    self._append(_DELETE, dumped, '')
+                    del self.keydir[dumped]
+                    self.index.remove(key)
+            self._commit()
+
+    def keys(self):
+        # the encoded keys sort like the keys do
+        with self._lock:
+            dumped = sorted(self.keydir)
+        return map(decode_key, dumped)
+
+    def count(self, query, limit=None):
+        with self._lock:
+            return self.index.count(query)
+
+    def query(self, query, limit=None, position=None, keys_only=False, projection=None):
+        with self._lock:
+            keys, ordered, exact = self.index.plan(query)
+            values = None
+            if projection is not None:
+                values = self.index.projection(query.kind, projection)
+        if values is not None:
+            # the values are all in the index, nothing needs reading
+            load = lambda keys: ((decode_key(k), self._indexed(k, values)) for k in keys)
+        else:
+            load = lambda keys: ((decode_key(k), self._get(k, projection)) for k in keys)
+        load_keys = (lambda keys: [decode_key(k) for k in keys]) if keys_only else None
+        return utils.run_query(query, keys, load, encode_key, limit, ordered, position,
+                               load_keys, exact)
+
+    def _indexed(self, dumped, values):
+        with self._lock:
+            if dumped not in self.keydir:
+                return None
+            return values(dumped)
+
+    def merge(self, wait=False):
+        """Merges all the full segments into one holding only the current
+        values of the keys in them. This happens in a background thread
+        unless `wait` is True."""
+        with self._lock:
+            if self._merge is None or not self._merge.is_alive():
+                merged = [self.segments[id] for id in sorted(self.segments)
+                          if id != self._active.id]
+                if not merged:
+                    return
+                self._merge = threading.Thread(target=self._merge_segments,
+                                               args=(merged,))
+                self._merge.daemon = True
+                self._merge.start()
+            merge = self._merge
+        if wait:
+            merge.join()
+
+    def _merge_segments(self, merged):
+        ids = set(s.id for s in merged)
+        segments = dict((s.id, s) for s in merged)
+        last = merged[-1]
+        with self._lock:
+            live = [(dumped, location) for dumped, location in self.keydir.iteritems()
+                    if location[0] in ids]
+        # full segments never change, so they can be read without the lock
+        tmp = os.path.join(self.path, MERGE_FILE)
+        copied = []
+        with open(tmp, 'wb') as f:
+            record = _record(_MERGED, '', str(merged[0].id))
+            f.write(record)
+            size = len(record)
+            for dumped, location in live:
+                id, offset, length = location
+                data = str(segments[id].view(offset, length))
+                record = _record(_PUT, dumped, data)
+                f.write(record)
+                size += len(record)
+                copied.append((dumped, location, size - length))
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            os.rename(tmp, last.filename)
+            segment = _Segment(self.path, last.id)
+            for dumped, location, offset in copied:
+                # unless it's been written to since
+                if self.keydir.get(dumped) == location:
+                    self.keydir[dumped] = (last.id, offset, location[2])
+            for s in merged:
+                del self.segments[s.id]
+            self.segments[last.id] = segment
+            for s in merged[:-1]:
+                os.remove(s.filename)
@@ -1,6 +1,20 @@
 from importlib import import_module
 from fndb.config import settings as global_settings
 
+def load_backend(config):
+    """Creates the backend described by `config`, a dict like
+    settings.BACKEND with the name of the backend module and its arguments."""
+    name = config.get('name')
+    if name is None:
+        raise KeyError, "settings missing 'name' key from BACKEND"
+    mod = 'fndb.backend.{0}'.format(name)
+    try:
+        mod = import_module(mod)
+    except ImportError:
+        raise ImportError, "No module named {0}".format(mod)
+    cls = getattr(mod, 'BackendWrapper')
+    return cls(**config)
+
 class BackendProxy(object):
     _b = None # singleton element for the backend
 
@@ -15,16 +29,9 @@ class BackendProxy(object):
             settings = global_settings
         if not isinstance(settings.BACKEND, dict):
             raise KeyError, "settings BACKEND key must be a dict, got %r" % settings.BACKEND
-        name = settings.BACKEND.get('name')
-        if name is None:
-            raise KeyError, "settings missing 'name' key from BACKEND"
-        mod = 'fndb.backend.{0}'.format(name)
-        try:
-            mod = import_module(mod)
-        except ImportError:
-            raise ImportError, "No module named {0}".format(mod)
-        cls = getattr(mod, 'BackendWrapper')
-        BackendProxy._b = cls(**settings.BACKEND)
+        if BackendProxy._b is not None:
+            BackendProxy._b.close()
+        BackendProxy._b = load_backend(settings.BACKEND)
 
     def __getattr__(self, item):
         return getattr(self._backend, item)
@@ -1,18 +1,31 @@
 from __future__ import absolute_import
+import atexit
+import weakref
 from importlib import import_module
 from fndb.config import settings
-from fndb.backend import BackendBase, utils
+from fndb.backend import BackendBase, codec, utils
 from simplekv import KeyValueStore
 from fndb.db import Key
 import cPickle as pickle
-from .dict import dump_key, load_key
+from multiprocessing.pool import ThreadPool
+from .codec import encode_key, decode_key
+from .dict import load_key
+from .index import Index
+
+# names the index is saved under, these can never clash with a stored key
+# (see store_key()) as they aren't hex
+INDEX_KEY = '__index__'
+DIRTY_KEY = '__index_dirty__'
 
 class BackendWrapper(BackendBase):
-    def __init__(self, name=None, store=None, **kwargs):
+    def __init__(self, name=None, store=None, threads=None, **kwargs):
         """Creates a simplekv store based backend.
         store: either a string containing the full packagename and classname of the 
                store to use (i.e. 'simplekv.fs.FilesystemStore') or an instance of
                a class that implements simplekv.KeyValueStore
+        threads: number of threads used to read and write the values of the
+                 *_multi methods concurrently (optional, the store has to be
+                 thread safe)
         kwargs: the arguments required to instantiate an instance of store (only needed
                 if store is gives as a string).
         """
@@ -27,14 +40,138 @@ class BackendWrapper(BackendBase):
                              "simplekv.KeyValueStore instance, got: %r"
                              % store)
         self.store = store
-    def get(self, key):
+        self.threads = threads
+        self._pool = None
+        self._index_dirty = False
+        self._load_index()
+        # so the index is saved even if nothing closes the backend
+        atexit.register(_flush_at_exit, weakref.ref(self))
+
+    def _load_index(self):
+        """Loads the index snapshot from the store. The index is rebuilt
+        from iter_keys() if there is no snapshot, if the process that last
+        changed the index didn't get to save it (i.e. the dirty marker is set),
+        or if the snapshot doesn't have as many keys as the store (another
+        process sharing the store saved its own index over it).
+        """
+        if INDEX_KEY in self.store and DIRTY_KEY not in self.store:
+            self.index = pickle.loads(self.store.get(INDEX_KEY))
+            if (getattr(self.index, 'version', None) == Index.version and
+                len(self.index) == len(self._names())):
+                return
+        self.index = Index(encode_key)
+        self._index_changed()
+        for k in self._names():
+            if '.' in k:
+                # saved by an older version, under its dotted key
+                key = load_key(k)
+                if key is None:
+                    continue
+                self.store.put(store_key(key), self.store.get(k))
+                self.store.delete(k)
+            else:
+                key = load_store_key(k)
+            self.index.add(key, self.get(key))
+        self.flush()
+
+    def _names(self):
+        """The names of the entities in the store (see store_key())."""
+        return [k for k in self.store.iter_keys() if k not in (INDEX_KEY, DIRTY_KEY)]
+
+    def _index_changed(self):
+        # mark the snapshot in the store as stale before the first change
+        # to the index, so a crash before flush() causes a rebuild
+        if not self._index_dirty:
+            self.store.put(DIRTY_KEY, '')
+            self._index_dirty = True
+
+    def flush(self):
+        """Saves the index to the store if it has changed."""
+        if self._index_dirty:
+            self.store.put(INDEX_KEY, pickle.dumps(self.index, pickle.HIGHEST_PROTOCOL))
+            if DIRTY_KEY in self.store:
+                self.store.delete(DIRTY_KEY)
+            self._index_dirty = False
+
+    def close(self):
+        self.flush()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def after_fork(self):
+        # the pool's threads weren't copied
+        self._pool = None
+
+    def _map(self, func, items):
+        """map() using the thread pool if there is one and it's worth it"""
+        if not self.threads or len(items) < 2:
+            return map(func, items)
+        if self._pool is None:
+            self._pool = ThreadPool(self.threads)
+        return self._pool.map(func, items)
+
+    def get(self, key, names=None):
         try:
-            return pickle.loads(self.store.get(dump_key(key)))
+            return codec.loads(self.store.get(store_key(key)), names)
         except KeyError:
             return None
+    def get_multi(self, keys):
+        return self._map(self.get, list(keys))
     def put(self, key, value):
-        key = utils.validate_key(key)
-        self.store.put(dump_key(key), pickle.dumps(value))
-        return key
+        return self.put_multi([(key, value)])[0]
+    def put_multi(self, items):
+        items = [(utils.validate_key(key), value) for key, value in items]
+        # made first, so that if a value can't be indexed nothing is written
+        rows = [self.index.row(key.kind(), value) for key, value in items]
+        if items:
+            # the dirty marker has to be in the store before any of the values
+            self._index_changed()
+        self._map(self._put, items)
+        for (key, _), row in zip(items, rows):
+            self.index.add(key, row=row)
+        return [key for key, _ in items]
+    def _put(self, item):
+        key, value = item
+        self.store.put(store_key(key), codec.dumps(value))
+    def delete(self, key):
+        self.delete_multi([key])
+    def delete_multi(self, keys):
+        keys = list(keys)
+        if any(key in self.index for key in keys):
+            self._index_changed()
+        self._map(self.store.delete, [store_key(key) for key in keys])
+        for key in keys:
+            self.index.remove(key)
     def keys(self):
-        return filter(None, [load_key(k) for k in self.store.iter_keys()])
+        return map(load_store_key, self._names())
+    def count(self, query, limit=None):
+        return self.index.count(query)
+    def query(self, query, limit=None, position=None, keys_only=False, projection=None):
+        keys, ordered, exact = self.index.plan(query)
+        values = None
+        if projection is not None:
+            values = self.index.projection(query.kind, projection)
+        if values is not None:
+            # the values are all in the index, so the store isn't read
+            load = lambda keys: ((decode_key(k), values(k)) for k in keys)
+        else:
+            load = lambda keys: ((k, self.get(k, projection))
+                                 for k in (decode_key(k) for k in keys))
+        load_keys = (lambda keys: map(decode_key, keys)) if keys_only else None
+        return utils.run_query(query, keys, load, encode_key, limit, ordered, position,
+                               load_keys, exact)
+
+def _flush_at_exit(ref):
+    backend = ref()
+    if backend is not None:
+        backend.flush()
+
+def store_key(key):
+    """Returns the name a Key's entity is stored under. simplekv only allows
+    a few characters in names, so it's the hex of codec.encode_key() (which
+    sorts the same way)."""
+    return encode_key(key).encode('hex')
+
+def load_store_key(name):
+    return decode_key(name.decode('hex'))
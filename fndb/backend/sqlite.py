@@ -0,0 +1,338 @@
+from __future__ import absolute_import
+from fndb.backend import BackendBase, codec, utils
+from fndb.db import Key
+import datetime
+import sqlite3
+import threading
+from .codec import encode_key, decode_key
+from .index import _orders
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    key BLOB PRIMARY KEY,
+    kind TEXT NOT NULL,
+    parent BLOB,
+    value BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entities_kind ON entities (kind, parent);
+CREATE TABLE IF NOT EXISTS properties (
+    key BLOB NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value
+);
+CREATE INDEX IF NOT EXISTS properties_value ON properties (kind, name, value, key);
+CREATE INDEX IF NOT EXISTS properties_key ON properties (key);
+"""
+
+# the comparisons that can be done by sqlite
+_OPERATORS = ('=', '<', '<=', '>', '>=')
+
+# values are loaded this many at a time when going through query results
+_BATCH_SIZE = 100
+
+class BackendWrapper(BackendBase):
+    def __init__(self, name=None, filename=':memory:', synchronous=None,
+                 journal_mode=None):
+        """Creates an sqlite based backend.
+        filename: the database file (defaults to an in memory database)
+        synchronous: value for sqlite's `synchronous` pragma (optional)
+        journal_mode: value for sqlite's `journal_mode` pragma, e.g. 'WAL'
+                      (optional)
+
+        Entities are stored encoded by fndb.backend.codec, along with a
+        table of the values of their indexed properties which queries are
+        translated to SQL against.
+        """
+        self.filename = filename
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        if synchronous is not None:
+            self.conn.execute('PRAGMA synchronous = %s' % synchronous)
+        if journal_mode is not None:
+            self.conn.execute('PRAGMA journal_mode = %s' % journal_mode)
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def after_fork(self):
+        self._lock = threading.RLock()
+        if self.filename != ':memory:':
+            # connections can't be shared with a forked process
+            self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+
+    def get(self, key):
+        return self.get_multi([key])[0]
+
+    def get_multi(self, keys, names=None):
+        """Only the properties in `names` are decoded, if it is given."""
+        dumped = [_dump_key(key) for key in keys]
+        values = {}
+        with self._lock:
+            for i in xrange(0, len(dumped), _BATCH_SIZE):
+                batch = dumped[i:i + _BATCH_SIZE]
+                rows = self.conn.execute(
+                    'SELECT key, value FROM entities WHERE key IN (%s)' %
+                    ','.join('?' * len(batch)), batch)
+                for k, v in rows:
+                    values[str(k)] = codec.loads(v, names)
+        return [values.get(str(k)) for k in dumped]
+
+    def put(self, key, value):
+        return self.put_multi([(key, value)])[0]
+
+    def put_multi(self, items):
+        keys = []
+        with self._lock:
+            with self.conn:
+                for key, value in items:
+                    key = utils.validate_key(key)
+                    keys.append(key)
+                    self._put(key, value)
+        return keys
+
+    def _put(self, key, value):
+        dumped = _dump_key(key)
+        blob = buffer(codec.dumps(value))
+        # update in place (rather than INSERT OR REPLACE) so the rowid, which
+        # gives the order results come in by default, stays the same
+        cursor = self.conn.execute('UPDATE entities SET value = ? WHERE key = ?',
+                                   (blob, dumped))
+        if cursor.rowcount:
+            self.conn.execute('DELETE FROM properties WHERE key = ?', (dumped,))
+        else:
+            parent = key.parent()
+            self.conn.execute(
+                'INSERT INTO entities (key, kind, parent, value) VALUES (?, ?, ?, ?)',
+                (dumped, key.kind(), _dump_key(parent) if parent else None, blob))
+        self.conn.executemany(
+            'INSERT INTO properties (key, kind, name, value) VALUES (?, ?, ?, ?)',
+            [(dumped, key.kind(), name, v) for name, v in _property_rows(key.kind(), value)])
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        dumped = [(_dump_key(key),) for key in keys]
+        with self._lock:
+            with self.conn:
+                self.conn.executemany('DELETE FROM entities WHERE key = ?', dumped)
+                self.conn.executemany('DELETE FROM properties WHERE key = ?', dumped)
+
+    def keys(self):
+        with self._lock:
+            rows = self.conn.execute('SELECT key FROM entities ORDER BY rowid').fetchall()
+        return [decode_key(str(k)) for k, in rows]
+
+    def count(self, query, limit=None):
+        sql, params, exact, _ = _select(query)
+        if not exact:
+            return None
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(max(limit, 0))
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM (%s)' % sql, params).fetchone()[0]
+
+    def query(self, query, limit=None, position=None, keys_only=False, projection=None):
+        sql, params, exact, ordered = _select(query)
+        if exact and ordered and limit is not None and position is None:
+            sql += ' LIMIT ?'
+            params.append(max(limit, 0))
+        with self._lock:
+            dumped = [str(k) for k, in self.conn.execute(sql, params)]
+        # the SQL may match more than the query does (filters that can't be
+        # done by sqlite are left out), so the entities still get checked
+        load = lambda dumped: self._items(dumped, projection)
+        load_keys = (lambda keys: map(decode_key, keys)) if keys_only else None
+        return utils.run_query(query, dumped, load, encode_key, limit, ordered,
+                               position, load_keys, exact)
+
+    def _items(self, dumped, names=None):
+        """Yields the (key, value) pairs for the dumped keys, loading the
+        values a batch at a time."""
+        for i in xrange(0, len(dumped), _BATCH_SIZE):
+            keys = map(decode_key, dumped[i:i + _BATCH_SIZE])
+            for item in zip(keys, self.get_multi(keys, names)):
+                yield item
+
+def _select(query):
+    """Translates `query` to SQL selecting the dumped keys of the entities.
+    Returns a (sql, params, exact, ordered) tuple: exact tells whether the SQL
+    does all the filtering, ordered whether it does all the ordering.
+    """
+    where = []
+    params = []
+    if query.kind is not None:
+        where.append('e.kind = ?')
+        params.append(query.kind)
+    if query.ancestor is not None:
+        where.append('e.parent = ?')
+        params.append(_dump_key(query.ancestor))
+    exact = True
+    if query.filters is not None:
+        sql, filter_params, exact = _where(query.filters, query.kind)
+        if sql is not None:
+            where.append(sql)
+            params.extend(filter_params)
+    order_by = []
+    order_params = []
+    ordered = True
+    if query.orders is not None:
+        for order in _orders(query):
+            if not _orderable(query.kind, order.name):
+                ordered = False
+                order_by = []
+                order_params = []
+                break
+            # like the datastore, repeated properties are ordered by their
+            # smallest value ascending and by their largest descending
+            if order.direction == order.DESCENDING:
+                order_by.append('(SELECT MAX(p.value) FROM properties p WHERE '
+                                'p.key = e.key AND p.name = ?) DESC')
+            else:
+                order_by.append('(SELECT MIN(p.value) FROM properties p WHERE '
+                                'p.key = e.key AND p.name = ?) ASC')
+            order_params.append(order.name)
+    params.extend(order_params)
+    # equal values in the order of their keys (the encoded keys compare the
+    # way the keys do), and otherwise in the order they were written
+    order_by.append('e.key' if order_by else 'e.rowid')
+    sql = 'SELECT e.key FROM entities e'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY ' + ', '.join(order_by)
+    return sql, params, exact, ordered
+
+def _where(node, kind):
+    """Translates a filter Node to an SQL condition. Returns a (sql, params,
+    exact) tuple, sql being None when nothing could be translated. When exact
+    is False, the condition matches more than the node does.
+    """
+    from fndb.db.query import FilterNode, ConjunctionNode, DisjunctionNode, FalseNode
+    if isinstance(node, FalseNode):
+        return '0', [], True
+    if isinstance(node, FilterNode):
+        return _where_filter(node, kind)
+    if isinstance(node, (ConjunctionNode, DisjunctionNode)):
+        conjunction = isinstance(node, ConjunctionNode)
+        parts = []
+        params = []
+        exact = True
+        for subnode in node:
+            sql, p, e = _where(subnode, kind)
+            exact = exact and e
+            if sql is None:
+                if not conjunction:
+                    # anything could match this side of the OR
+                    return None, [], False
+                continue
+            parts.append(sql)
+            params.extend(p)
+        if not parts:
+            return None, [], False
+        return '(%s)' % (' AND ' if conjunction else ' OR ').join(parts), params, exact
+    return None, [], False
+
+def _where_filter(node, kind):
+    if node.name == '__key__':
+        if node.opsymbol not in _OPERATORS or not isinstance(node.value, Key):
+            return None, [], False
+        # the encoded keys compare the way the keys do
+        return 'e.key %s ?' % node.opsymbol, [_dump_key(node.value)], True
+    if node.opsymbol not in _OPERATORS or not _indexed(kind, node.name):
+        return None, [], False
+    if node.value is None:
+        if node.opsymbol != '=':
+            return None, [], False
+        sql = 'p.value IS NULL'
+        params = []
+        exact = True
+    else:
+        try:
+            value, exact = _sql_value(node.value)
+        except TypeError:
+            return None, [], False
+        if isinstance(node.value, Key) and node.opsymbol != '=':
+            # dumped keys don't sort in key order
+            return None, [], False
+        sql = 'p.value %s ?' % node.opsymbol
+        if node.opsymbol in ('<', '<='):
+            # None is less than everything in python, NULL isn't in sqlite
+            sql = '(%s OR p.value IS NULL)' % sql
+        params = [value]
+    if kind is not None:
+        sql = ('e.key IN (SELECT p.key FROM properties p WHERE p.kind = ? AND '
+               'p.name = ? AND %s)' % sql)
+        params = [kind, node.name] + params
+    else:
+        sql = 'e.key IN (SELECT p.key FROM properties p WHERE p.name = ? AND %s)' % sql
+        params = [node.name] + params
+    return sql, params, exact
+
+def _model_property(kind, name):
+    from fndb.db import model
+    cls = model.Model._kind_map.get(kind)
+    if cls is None:
+        return None
+    return cls._properties.get(name)
+
+def _indexed(kind, name):
+    prop = _model_property(kind, name)
+    return prop is None or prop._indexed
+
+def _orderable(kind, name):
+    """Whether sqlite orders the values of the property the same way Python
+    does (only known for the basic property types)."""
+    from fndb.db import model
+    prop = _model_property(kind, name)
+    return (prop is not None and prop._indexed and
+            isinstance(prop, (model.IntegerProperty, model.FloatProperty,
+                              model.BooleanProperty, model.StringProperty,
+                              model.DateTimeProperty)))
+
+def _sql_value(value):
+    """Turns a property value into something sqlite can store and compare.
+    Returns a (value, exact) tuple, exact being False if different values may
+    end up the same. Raises TypeError for values that can't be stored."""
+    if isinstance(value, bool):
+        return int(value), True
+    if isinstance(value, (int, long)):
+        if -2 ** 63 <= value < 2 ** 63:
+            return value, True
+        return float(value), False
+    if isinstance(value, (float, unicode)):
+        return value, True
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8'), True
+        except UnicodeDecodeError:
+            return buffer(value), True
+    if isinstance(value, datetime.datetime):
+        # fixed width so they sort as text
+        return u'%04d-%02d-%02d %02d:%02d:%02d.%06d' % (
+            value.year, value.month, value.day, value.hour, value.minute,
+            value.second, value.microsecond), True
+    if isinstance(value, Key):
+        return _dump_key(value), True
+    raise TypeError('%r cannot be stored in sqlite' % (value,))
+
+def _dump_key(key):
+    # blobs compare bytewise, so they sort the way the keys do
+    return buffer(encode_key(key))
+
+def _property_rows(kind, value):
+    """Yields the (name, value) rows of the properties table for an entity"""
+    for name, v in value.iteritems():
+        if not _indexed(kind, name):
+            continue
+        for i in (v if isinstance(v, (list, tuple)) else [v]):
+            if i is None:
+                yield name, None
+                continue
+            try:
+                yield name, _sql_value(i)[0]
+            except TypeError:
+                pass
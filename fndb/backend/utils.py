@@ -1,5 +1,10 @@
+import bisect
+import heapq
+import itertools
+import multiprocessing
 import uuid
 from fndb.db import Key
+from fndb.backend.index import _Desc, _orders, _sort_value
 
 def generate_id():
     """Default id generation
@@ -16,6 +21,303 @@ def validate_key(key, id_func=generate_id):
     Returns: the original key if it was valid, otherwise a new key with an id assigned
     """
     if key.id() is None:
-        key = key.flat()[:-1] + (id_func(),)
-        return Key(*key)
+        return Key._from_flat(key.flat()[:-1] + (id_func(),))
     return key
+
+def match_key(query, key):
+    """Checks `key` against the kind and ancestor of `query`."""
+    if query.kind is not None and key.kind() != query.kind:
+        return False
+    if query.ancestor is not None and key.parent() != query.ancestor:
+        return False
+    return True
+
+def filter_keys(query, keys):
+    """Yields the keys from `keys` that match the kind and ancestor of `query`.
+    Only the keys are looked at, nothing is loaded from the backend.
+    """
+    for key in keys:
+        if match_key(query, key):
+            yield key
+
+def filter_entities(query, items, limit=None, ordered=True):
+    """Turns (key, stored value) pairs into entities and returns an iterator
+    over the ones that match the filters of `query`, stopping after `limit`
+    matches.
+    Args:
+        query: the Query being run
+        items: an iterable of (key, value) pairs, value being what the backend
+               stored for key (None values are skipped)
+        limit: the maximum number of entities to return (optional)
+        ordered: whether items are already sorted according to the orders of
+                 the query. If not, the matching entities get sorted.
+    """
+    if limit is not None:
+        limit = max(limit, 0)
+    entities = _filter_entities(query, items)
+    if query.orders is not None and not ordered:
+        return iter(sort_entities(query, entities, limit))
+    if limit is not None:
+        return itertools.islice(entities, limit)
+    return entities
+
+def _filter_entities(query, items):
+    from fndb.db import model
+    filters = query.filters
+    for key, value in items:
+        if value is None:
+            continue
+        entity = model.Model._from_stored(key, value)
+        if filters is not None and not filters.matches(entity):
+            continue
+        yield entity
+
+class Position(object):
+    """Where a query got to in its results, which is what a query Cursor
+    holds (see run_query).
+    key: the key of the last result given out (None before the first one)
+    values: the values that result had for the properties the query is
+            ordered on (see _orders)
+
+    The results of a query with a position are given out in the order of
+    those values and then of their keys, so the next result is the first one
+    after (values, key) in that order, however the backend comes up with them
+    (e.g. through another index, once entities have been written).
+    """
+    def __init__(self, key=None, values=()):
+        self.key = key
+        self.values = tuple(values)
+
+def run_query(query, dumped, load, dump, limit=None, ordered=True, position=None,
+              keys_only=None, exact=False):
+    """Runs `query` over the keys a backend came up with for it (see
+    filter_entities), optionally carrying on from a Position.
+    Args:
+        query: the Query being run
+        dumped: a list of the keys that may match, as the backend stores them
+                and in the order the backend has them (sorting them gives key
+                order)
+        load: function returning (key, value) pairs for a list of those
+        dump: function turning a Key into what's in `dumped`
+        limit: the maximum number of entities to return (optional)
+        ordered: whether `dumped` is sorted according to the query's orders
+                 (and then by key, for keys with the same values)
+        position: a Position to start after (rather than at the beginning),
+                  which is updated as the entities are given out
+        keys_only: for a keys only query, a function turning a list of
+                   dumped keys into Keys. The Keys of the results are
+                   returned rather than the entities.
+        exact: whether all of `dumped` match the query's filters, in which
+               case a keys only query doesn't load anything (if `dumped` is
+               in the right order too)
+    """
+    if position is not None:
+        return _run_positioned(query, dumped, load, dump, limit, ordered, position,
+                               keys_only, exact)
+    if keys_only is not None and exact and (ordered or query.orders is None):
+        if limit is not None:
+            dumped = dumped[:max(limit, 0)]
+        return iter(keys_only(dumped))
+    branches = getattr(dumped, 'branches', None)
+    if branches is not None:
+        results = _merged(query, branches, load, limit)
+    else:
+        results = filter_entities(query, load(dumped), limit, ordered)
+    if keys_only is not None:
+        return (entity.key for entity in results)
+    return results
+
+def _run_positioned(query, dumped, load, dump, limit, ordered, position, keys_only, exact):
+    """run_query() starting after `position`. Only the results from there on
+    are loaded, unless the backend couldn't sort them, in which case they
+    all need sorting."""
+    if limit is not None:
+        limit = max(limit, 0)
+    orders = _orders(query)
+    if not orders:
+        # in the order of their keys, which is the order of the dumped keys
+        dumped = sorted(dumped)
+        start = 0
+        if position.key is not None:
+            start = bisect.bisect_right(dumped, dump(position.key))
+        if keys_only is not None and exact:
+            end = len(dumped) if limit is None else start + limit
+            return _positioned_keys(keys_only(dumped[start:end]), position)
+        entities = _filter_entities(query, load(dumped[start:]))
+    elif ordered:
+        start = _seek(query, orders, dumped, load, position)
+        entities = _filter_entities(query, load(dumped[start:]))
+    else:
+        after = _sort_key(orders, position.values, position.key)
+        entities = (e for e in _filter_entities(query, load(dumped))
+                    if _entity_sort_key(orders, e) > after)
+        entities = sort_entities(query, entities, limit)
+    results = _positioned(query, orders, entities, limit, position)
+    if keys_only is not None:
+        return (entity.key for entity in results)
+    return results
+
+def _seek(query, orders, dumped, load, position):
+    """Returns the index in `dumped` (sorted according to `orders`) of the
+    first key after `position`, loading only the entities a binary search
+    goes through."""
+    from fndb.db import model
+    if position.key is None:
+        return 0
+    after = _sort_key(orders, position.values, position.key)
+    lo, hi = 0, len(dumped)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        key, value = next(iter(load(dumped[mid:mid + 1])))
+        # the ones that are gone (deleted since the keys were read) are
+        # looked at again by _positioned, which skips what's before position
+        if value is not None and _entity_sort_key(
+                orders, model.Model._from_stored(key, value)) <= after:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def _sort_key(orders, values, key):
+    return tuple(_Desc(_sort_value(v)) if o.direction == o.DESCENDING else _sort_value(v)
+                 for o, v in zip(orders, values)) + (key,)
+
+def _entity_sort_key(orders, entity):
+    return _sort_key(orders, [_order_value(entity, o) for o in orders], entity.key)
+
+def _positioned(query, orders, entities, limit, position):
+    """Yields `entities` (in the order of `position`), updating it as they go,
+    leaving out the ones that don't come after where it was."""
+    if limit == 0:
+        return
+    after = None
+    if position.key is not None:
+        after = _sort_key(orders, position.values, position.key)
+    count = 0
+    for entity in entities:
+        values = [_order_value(entity, o) for o in orders]
+        if after is not None and _sort_key(orders, values, entity.key) <= after:
+            continue
+        position.key, position.values = entity.key, values
+        yield entity
+        count += 1
+        if count == limit:
+            return
+
+def _positioned_keys(keys, position):
+    for key in keys:
+        position.key = key
+        yield key
+
+def _merged(query, branches, load, limit=None):
+    """Yields the entities matching `query` out of the candidate keys of the
+    branches of an OR (see index.Union), each already sorted according to
+    the query's orders: the branches are merged in that order, and the
+    entities already given out by another branch are skipped. Each branch
+    is only loaded as far as the merge gets."""
+    if limit is not None and limit <= 0:
+        return
+    orders = list(query.orders)
+    def stream(i, keys):
+        for n, entity in enumerate(_filter_entities(query, load(keys))):
+            yield _entity_sort_key(orders, entity), i, n, entity
+    seen = set()
+    count = 0
+    for _, _, _, entity in heapq.merge(*[stream(i, keys) for i, keys in enumerate(branches)]):
+        if entity.key in seen:
+            continue
+        seen.add(entity.key)
+        yield entity
+        count += 1
+        if count == limit:
+            return
+
+def sort_entities(query, entities, limit=None):
+    """Returns a list of `entities` sorted by the orders of `query`, and by
+    key for the ones that are equal. If `limit` is given only the first
+    `limit` entities are kept, which only needs a heap of that size rather
+    than sorting everything.
+    """
+    orders = list(query.orders)
+    sort_key = lambda entity: _entity_sort_key(orders, entity)
+    if limit is not None:
+        return heapq.nsmallest(limit, entities, key=sort_key)
+    return sorted(entities, key=sort_key)
+
+def _order_value(entity, order):
+    """The value of the property `order` is on, as used for sorting. Like the
+    datastore, repeated properties sort by their smallest value in ascending
+    order and their largest in descending order."""
+    if order.name == '__key__':
+        return entity.key
+    prop = entity._properties.get(order.name)
+    value = prop._get_value(entity) if prop is not None else None
+    if isinstance(value, (list, tuple)):
+        descending = order.direction == order.DESCENDING
+        value = (max if descending else min)(value, key=_sort_value) if value else None
+    return value
+
+def scan(query, backend, limit=None, position=None, keys_only=False):
+    """The generic (slow) query execution: goes through every key in `backend`
+    and loads each of the ones matching the kind and ancestor exactly once.
+    Keys only queries without filters don't load anything.
+    """
+    keys = list(filter_keys(query, backend.keys()))
+    return run_query(query, keys, lambda keys: ((k, backend.get(k)) for k in keys),
+                     lambda k: k, limit, ordered=query.orders is None, position=position,
+                     keys_only=list if keys_only else None, exact=query.filters is None)
+
+# the candidate keys of a parallel_scan, in the processes it forks
+_scan_keys = None
+
+def parallel_scan(query, backend, processes, limit=None):
+    """Like scan(), but with the loading and filtering of the entities done
+    by `processes` forked worker processes, each taking a slice of the keys
+    at a time and sending back which of them match. The matching entities
+    are then loaded again here (which is worth it when the filters only let
+    through a small part of the kind).
+    """
+    keys = list(filter_keys(query, backend.keys()))
+    if not keys:
+        return iter([])
+    # a few slices per process so they all keep busy, and so the results of
+    # an unordered query with a limit can stop coming in early
+    size = -(-len(keys) // (processes * 4))
+    slices = [(query, start, min(start + size, len(keys)))
+              for start in xrange(0, len(keys), size)]
+    wanted = limit if query.orders is None else None
+    matched = []
+    # the keys are passed on by the fork, rather than pickled for every slice
+    pool = multiprocessing.Pool(processes, _init_scan, (backend, keys))
+    try:
+        for indexes in pool.imap(_scan_slice, slices):
+            matched.extend(keys[i] for i in indexes)
+            if wanted is not None and len(matched) >= wanted:
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+    # filtered again, in case they've been changed since
+    return filter_entities(query, zip(matched, backend.get_multi(matched)), limit,
+                           ordered=False)
+
+def _init_scan(backend, keys):
+    global _scan_keys
+    _scan_keys = keys
+    backend.after_fork()
+
+def _scan_slice(args):
+    """Returns the indexes in _scan_keys of the keys in a slice of them that
+    match the query."""
+    from fndb.backend import backend
+    from fndb.db import model
+    query, start, end = args
+    keys = _scan_keys[start:end]
+    filters = query.filters
+    indexes = []
+    for i, (key, value) in enumerate(zip(keys, backend.get_multi(keys))):
+        if value is None:
+            continue
+        if filters is None or filters.matches(model.Model._from_stored(key, value)):
+            indexes.append(start + i)
+    return indexes
@@ -5,3 +5,9 @@ __all__ += model.__all__
 
 from query import *
 __all__ += query.__all__
+
+from context import *
+__all__ += context.__all__
+
+from future import *
+__all__ += future.__all__
@@ -0,0 +1,125 @@
+"""
+A cache of the entities loaded and written while handling a request (like
+the NDB's in-context cache).
+
+    with Context():
+        a = Key('A', 1).get()
+        assert Key('A', 1).get() is a  # doesn't go to the backend
+
+Key.get, get_multi, put, delete and queries all go through the current
+context, so a get after a put or delete gives what was written. Contexts only
+last as long as the `with` block (or the request, see ContextMiddleware) and
+belong to the thread that entered them; writes made by other threads or
+processes aren't seen until the next context.
+
+The gets and puts queued by the *_async functions (see future.py) are sent
+when a context is left, or dropped if it's left because of an exception.
+
+Models can opt out with `_use_cache = False`.
+"""
+import sys
+import threading
+
+__all__ = ['Context', 'ContextMiddleware', 'get_context']
+
+_local = threading.local()
+
+# returned by Context._get for keys the context doesn't know about
+_NOT_CACHED = object()
+
+def get_context():
+    """Returns the innermost Context entered by this thread, or None."""
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+def _use_cache(key):
+    from . import model
+    cls = model.Model._kind_map.get(key.kind())
+    return cls is not None and cls._use_cache
+
+def _written(key, entity):
+    """Records that `entity` was put for `key` (None for a delete)."""
+    stack = getattr(_local, 'stack', None)
+    if not stack:
+        return
+    # the contexts this one is nested in may have the old entity
+    for context in stack[:-1]:
+        context._cache.pop(key, None)
+    stack[-1]._set(key, entity)
+
+class Context(object):
+    """An identity map of Key to entity (or to None if there is no entity
+    for the key), used while the context is entered."""
+    def __init__(self):
+        self._cache = {}
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        from . import future
+        try:
+            if exc_type is None:
+                # while the writes still go to this context
+                future.flush()
+            else:
+                future._discard()
+        finally:
+            _local.stack.remove(self)
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def _get(self, key):
+        return self._cache.get(key, _NOT_CACHED)
+
+    def _set(self, key, entity):
+        if _use_cache(key):
+            self._cache[key] = entity
+
+    def _from_query(self, entity):
+        """Returns the entity to give out for a query result, which is the
+        cached one if there is one."""
+        key = entity._key
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+        self._set(key, entity)
+        return entity
+
+class ContextMiddleware(object):
+    """WSGI middleware handling every request in its own Context."""
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        context = Context().__enter__()
+        try:
+            result = self.app(environ, start_response)
+        except:
+            exc_info = sys.exc_info()
+            context.__exit__(*exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return _ClosingIterable(result, context)
+
+class _ClosingIterable(object):
+    """Leaves the context once the server is done with the response, which
+    may be generated after the app has returned."""
+    def __init__(self, result, context):
+        self.result = result
+        self.context = context
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            if self.context in getattr(_local, 'stack', ()):
+                self.context.__exit__()
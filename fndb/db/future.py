@@ -0,0 +1,190 @@
+"""
+Futures returned by the *_async functions (a much simplified version of the
+NDB's, there are no tasklets or event loop).
+
+Gets and puts started with Key.get_async, Model.put_async, get_multi_async
+and put_multi_async aren't sent to the backend straight away. They're queued
+(per thread) until one of their results is needed, or flush() is called, and
+then sent in as few get_multi and put_multi calls as possible:
+
+    a, b = key_a.get_async(), key_b.get_async()
+    a.get_result()  # both are fetched with one backend.get_multi()
+
+They are also sent before the thread reads anything itself (Key.get,
+get_multi, Query.fetch, count, ...), so it sees its own puts, and when the
+thread ends or the process exits, so none are lost. Leaving a Context (so
+also the end of a request, with ContextMiddleware) flushes them too, unless
+it's left because of an exception, in which case they are dropped: nothing
+queued in a request outlives it.
+
+Query.fetch_async runs the query on a thread pool (of
+settings.ASYNC_THREADS threads, 4 by default) so it can go on while the
+caller does something else.
+"""
+import atexit
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+from fndb.backend import backend
+from fndb.config import settings
+
+__all__ = ['Future', 'flush', 'wait_all']
+
+_local = threading.local()
+_pool = None
+_pool_lock = threading.Lock()
+
+class Future(object):
+    """The result of an operation that may not have happened yet."""
+    # set for futures done by another thread, the queued ones are done by
+    # flush() in the thread waiting for them
+    _event = None
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exception(self, exc_info):
+        """Makes get_result() raise the exception of the sys.exc_info()
+        tuple `exc_info`."""
+        self._exc_info = exc_info
+        self._set_done()
+
+    def _set_done(self):
+        self._done = True
+        if self._event is not None:
+            self._event.set()
+
+    def wait(self):
+        if not self._done:
+            flush()
+            if self._event is not None:
+                self._event.wait()
+
+    def get_exception(self):
+        self.wait()
+        return self._exc_info[1] if self._exc_info else None
+
+    def get_result(self):
+        self.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    check_success = get_result
+
+def wait_all(futures):
+    """Waits for all the futures to be done."""
+    flush()
+    for future in futures:
+        future.wait()
+
+class _Queue(list):
+    """The (op, arg, future) entries queued by a thread. What is left in it
+    when it is collected (i.e. the thread has ended without flushing) is
+    sent then."""
+    def __del__(self):
+        if self:
+            _flush(self)
+
+def _queue(op, arg):
+    """Queues a 'get' of a key or a 'put' of an entity, returns its Future."""
+    queue = getattr(_local, 'queue', None)
+    if queue is None:
+        queue = _local.queue = _Queue()
+    future = Future()
+    queue.append((op, arg, future))
+    return future
+
+def flush():
+    """Sends the gets and puts queued by this thread to the backend, in the
+    order they were made (consecutive gets and puts are sent together)."""
+    _flush(getattr(_local, 'queue', None))
+
+def _flush(queue):
+    while queue:
+        op = queue[0][0]
+        n = 1
+        while n < len(queue) and queue[n][0] == op:
+            n += 1
+        batch = queue[:n]
+        del queue[:n]
+        _run(op, batch)
+
+def _discard():
+    """Drops the gets and puts queued by this thread without sending them,
+    their futures raise RuntimeError."""
+    queue = getattr(_local, 'queue', None)
+    if not queue:
+        return
+    batch = queue[:]
+    del queue[:]
+    try:
+        raise RuntimeError('Dropped: the context it was made in was left '
+                           'because of an exception')
+    except RuntimeError:
+        exc_info = sys.exc_info()
+    for _, _, future in batch:
+        future.set_exception(exc_info)
+
+def _flush_at_exit():
+    queue = getattr(_local, 'queue', None)
+    if queue:
+        flush()
+        # the backends that save what they hold at exit have already done
+        # so (they are created after this is registered, and atexit goes
+        # in reverse), they need to do it again
+        backend_flush = getattr(backend, 'flush', None)
+        if backend_flush is not None:
+            backend_flush()
+
+atexit.register(_flush_at_exit)
+
+def _run(op, batch):
+    from . import model
+    args = [arg for _, arg, _ in batch]
+    try:
+        if op == 'get':
+            # (get_multi would flush what's queued after the batch first)
+            results = model._get_multi(args)
+        else:
+            model.put_multi(args)
+            results = args
+    except Exception:
+        exc_info = sys.exc_info()
+        for _, _, future in batch:
+            future.set_exception(exc_info)
+        return
+    for (_, arg, future), result in zip(batch, results):
+        if op == 'get' and result is None:
+            # like Key.get()
+            try:
+                raise KeyError(arg)
+            except KeyError:
+                future.set_exception(sys.exc_info())
+        else:
+            future.set_result(result)
+
+def _start(func, *args):
+    """Calls func(*args) on the thread pool, returns a Future of its result."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(settings.ASYNC_THREADS or 4)
+    future = Future()
+    future._event = threading.Event()
+    def call():
+        try:
+            future.set_result(func(*args))
+        except Exception:
+            future.set_exception(sys.exc_info())
+    _pool.apply_async(call)
+    return future
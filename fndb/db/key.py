@@ -4,24 +4,35 @@ https://developers.google.com/appengine/docs/python/ndb/entities
 """
 import base64
 import cPickle as pickle
+import threading
 from fndb.backend import backend
+from fndb.config import settings
+from . import context
 
 __all__ = ['Key']
 
 class Key(object):
+    """An immutable key, backed by the tuple of its flat() form.
+
+    Keys are hashed, compared and sorted a lot (they are what the backends
+    and caches are indexed by), so the hash is computed once, kinds are
+    interned and nothing gets allocated to compare two keys.
+    """
+    __slots__ = ('__flat', '__hash', '__parent', '__urlsafe')
+
     def __new__(cls, *args, **kwargs):
-        self = super(Key, cls).__new__(cls)
-        self.__pairs = []
+        flat = []
         if args:
             if len(args) % 2:
                 raise ValueError('Key() must have an even number of positional '
                                  'arguments.')
-            pairs = [(args[i], args[i + 1]) for i in xrange(0, len(args), 2)]
-            for i, (kind, id) in enumerate(pairs):
+            last = len(args) - 2
+            for i in xrange(0, len(args), 2):
+                kind, id = args[i], args[i + 1]
                 if isinstance(id, unicode):
                     id = id.encode('utf8')
                 elif id is None:
-                    if i + 1 < len(pairs):
+                    if i < last:
                         raise ValueError('Incomplete Key entry must be last')
                 else:
                     if not isinstance(id, (int, long, str)):
@@ -35,76 +46,103 @@ class Key(object):
                                     'received %r' % kind)
                 if not id:
                     id = None
-                self.__pairs.append((kind, id))
+                flat.append(intern(kind))
+                flat.append(id)
         urlsafe = kwargs.get("urlsafe")
         if urlsafe is not None:
             if not isinstance(urlsafe, basestring):
                 raise TypeError('urlsafe must be a string; received %r' % urlsafe)
             if isinstance(urlsafe, unicode):
                 urlsafe = urlsafe.encode('utf8')
-            mod = len(urlsafe) % 4
-            if mod:
-                urlsafe += "=" * (4 - mod)
-            self.__pairs = pickle.loads(base64.b64decode(urlsafe.replace('-', '+').replace('_', '/')))
+            key = _from_urlsafe(urlsafe)
+            if len(kwargs) == 1 and cls is Key:
+                # keys are immutable, the cached one can be handed out
+                return key
+            flat = list(key.flat())
         parent = kwargs.get("parent")
         if parent is not None:
-            self.__pairs[:0] = parent.pairs()
+            flat[:0] = parent.flat()
+        return cls._from_flat(tuple(flat))
+
+    @classmethod
+    def _from_flat(cls, flat):
+        """Makes a Key from a flat tuple, without checking anything (it has to
+        come from another Key, or be just as valid)."""
+        self = object.__new__(cls)
+        self.__flat = flat
+        self.__hash = hash(flat)
         return self
 
+    def __reduce__(self):
+        return _from_flat, (self.__flat,)
+
+    def __setstate__(self, state):
+        # keys pickled before they were immutable
+        self.__flat = tuple(_flatten(state['_Key__pairs']))
+        self.__hash = hash(self.__flat)
+
     def parent(self):
-        pairs = self.pairs()
-        if len(pairs) <= 1:
-            return None
-        return Key(*pairs[:-1])
+        try:
+            return self.__parent
+        except AttributeError:
+            flat = self.__flat
+            self.__parent = Key._from_flat(flat[:-2]) if len(flat) > 2 else None
+            return self.__parent
 
     def pairs(self):
-        return self.__pairs
+        flat = self.__flat
+        return tuple(zip(flat[::2], flat[1::2]))
 
     def id(self):
-        return self.__pairs[-1][1]
+        return self.__flat[-1]
 
     def kind(self):
-        return self.__pairs[-1][0]
+        return self.__flat[-2]
 
     def flat(self):
-        flat = []
-        for kind, id in self.pairs():
-            flat.append(kind)
-            flat.append(id)
-        return tuple(flat)
+        return self.__flat
 
     def urlsafe(self):
-        urlsafe = base64.b64encode(pickle.dumps(self.pairs()))
-        return urlsafe.rstrip('=').replace('+', '-').replace('/', '_')
+        try:
+            return self.__urlsafe
+        except AttributeError:
+            self.__urlsafe = _encode_urlsafe(self.__flat)
+            return self.__urlsafe
 
     def get(self):
-        from . import model
-        obj = backend.get(self)
-        if obj is None:
+        from . import model, future
+        # so what this thread has put is seen
+        future.flush()
+        ctx = context.get_context()
+        entity = context._NOT_CACHED if ctx is None else ctx._get(self)
+        if entity is context._NOT_CACHED:
+            obj = backend.get(self)
+            entity = None if obj is None else model.Model._from_stored(self, obj)
+            if ctx is not None:
+                ctx._set(self, entity)
+        if entity is None:
             raise KeyError
-        cls = model.Model._kind_map.get(self.kind())
-        expando = issubclass(cls, model.Expando)
-        kwargs = {}
-        for k,v in obj.iteritems():
-            if v is not None:
-                code_name = cls._properties.get(k)
-                if code_name is None:
-                    if not expando:
-                        raise KeyError
-                    code_name = k
-                else:
-                    code_name = cls._properties[k]._code_name
-                kwargs[code_name] = v            
-        mdl = cls(key=self, **kwargs)
-        return mdl
+        return entity
+
+    def get_async(self):
+        """Returns a Future of get(), see future.py."""
+        from . import future
+        return future._queue('get', self)
+
+    def delete(self):
+        backend.delete(self)
+        context._written(self, None)
 
     def __repr__(self):
-        return 'Key(%s)' % ', '.join(str(i) for i in self.flat())
+        return 'Key(%s)' % ', '.join(str(i) for i in self.__flat)
+
+    def __hash__(self):
+        return self.__hash
 
     def __eq__(self, other):
         if not isinstance(other, Key):
             return NotImplemented
-        return (tuple(self.pairs()) == tuple(other.pairs()))
+        return self.__hash == other.__hash and self.__flat == other.__flat
 
     def __ne__(self, other):
         """The opposite of __eq__."""
@@ -116,22 +154,152 @@ class Key(object):
         """Less than ordering."""
         if not isinstance(other, Key):
             return NotImplemented
-        return self.pairs() < other.pairs()
+        return self.__flat < other.__flat
 
     def __gt__(self, other):
-        """Less than ordering."""
+        """Greater than ordering."""
         if not isinstance(other, Key):
             return NotImplemented
-        return self.pairs() > other.pairs()
+        return self.__flat > other.__flat
 
     def __le__(self, other):
-        """Less than ordering."""
+        """Less than or equal ordering."""
         if not isinstance(other, Key):
             return NotImplemented
-        return self.pairs() <= other.pairs()
+        return self.__flat <= other.__flat
 
     def __ge__(self, other):
-        """Less than ordering."""
+        """Greater than or equal ordering."""
         if not isinstance(other, Key):
             return NotImplemented
-        return self.pairs() >= other.pairs()
+        return self.__flat >= other.__flat
+
+def _flatten(pairs):
+    for kind, id in pairs:
+        yield kind
+        yield id
+
+def _from_flat(flat):
+    # what pickled keys are loaded with
+    return Key._from_flat(flat)
+
+# urlsafe strings are the url safe base64 (without padding) of a format byte
+# followed by the pairs, each being the length of the kind, the kind and the
+# id. The id starts with a number: for string ids, their length shifted left
+# by one bit with the lowest bit set, followed by the string (a length of 0
+# being an incomplete key's None). For integer ids, the number of bytes the
+# (zigzag encoded) integer takes shifted left by one bit, followed by those
+# bytes, big-endian. Numbers are varints: 7 bits per byte, the high bit
+# telling whether more bytes follow.
+_URLSAFE_FORMAT = '\x01'
+
+# the keys of the urlsafe strings decoded recently: an approximate LRU made
+# of two generations, so a hit is a single dict lookup. Keys are moved to the
+# current generation when they are used, and the older one is dropped when
+# the current one is full.
+_URLSAFE_CACHE_SIZE = 128
+_urlsafe_cache = [{}, {}]
+_urlsafe_lock = threading.Lock()
+
+def _varint(n):
+    if n < 0x80:
+        return chr(n)
+    out = []
+    while n >= 0x80:
+        out.append(chr(n & 0x7f | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+def _read_varint(data, pos):
+    n = ord(data[pos])
+    if n < 0x80:
+        return n, pos + 1
+    n &= 0x7f
+    shift = 7
+    while True:
+        pos += 1
+        b = ord(data[pos])
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos + 1
+        shift += 7
+
+def _encode_urlsafe(flat):
+    out = [_URLSAFE_FORMAT]
+    for i in xrange(0, len(flat), 2):
+        kind, id = flat[i], flat[i + 1]
+        out.append(_varint(len(kind)))
+        out.append(kind)
+        if id is None:
+            out.append('\x01')
+        elif isinstance(id, str):
+            out.append(_varint(len(id) << 1 | 1))
+            out.append(id)
+        else:
+            id = id << 1 if id >= 0 else ~id << 1 | 1
+            data = '%x' % id
+            data = ('0' * (len(data) & 1) + data).decode('hex')
+            out.append(_varint(len(data) << 1))
+            out.append(data)
+    return base64.urlsafe_b64encode(''.join(out)).rstrip('=')
+
+def _from_urlsafe(urlsafe):
+    """Returns the key `urlsafe` is for."""
+    current, previous = _urlsafe_cache
+    key = current.get(urlsafe)
+    if key is not None:
+        return key
+    key = previous.get(urlsafe)
+    if key is not None:
+        _cache_urlsafe(urlsafe, key)
+        return key
+    try:
+        data = base64.urlsafe_b64decode(urlsafe + '=' * (-len(urlsafe) % 4))
+    except TypeError:
+        raise ValueError('Invalid urlsafe key %r' % (urlsafe,))
+    if data[:1] == _URLSAFE_FORMAT:
+        try:
+            key = Key._from_flat(_decode_pairs(data))
+        except (IndexError, ValueError):
+            raise ValueError('Invalid urlsafe key %r' % (urlsafe,))
+    elif settings.PICKLED_URLSAFE_KEYS:
+        # made by earlier versions. Unpickling strings from urls isn't safe
+        # though (they can run anything), so this has to be turned on.
+        key = Key(*_flatten(pickle.loads(data)))
+    else:
+        raise ValueError('Invalid urlsafe key %r (pickled urlsafe keys are only '
+                         'accepted if settings.PICKLED_URLSAFE_KEYS is set)'
+                         % (urlsafe,))
+    _cache_urlsafe(urlsafe, key)
+    return key
+
+def _cache_urlsafe(urlsafe, key):
+    with _urlsafe_lock:
+        if len(_urlsafe_cache[0]) >= _URLSAFE_CACHE_SIZE:
+            _urlsafe_cache[:] = [{}, _urlsafe_cache[0]]
+        _urlsafe_cache[0][urlsafe] = key
+
+def _decode_pairs(data):
+    flat = []
+    pos = 1
+    end = len(data)
+    while pos < end:
+        length, pos = _read_varint(data, pos)
+        if not length or pos + length > end:
+            raise ValueError
+        flat.append(intern(data[pos:pos + length]))
+        pos += length
+        n, pos = _read_varint(data, pos)
+        length = n >> 1
+        if pos + length > end:
+            raise ValueError
+        if n & 1:
+            flat.append(data[pos:pos + length] if length else None)
+        else:
+            id = int(data[pos:pos + length].encode('hex') or '0', 16)
+            flat.append(int(id >> 1 if not id & 1 else ~(id >> 1)))
+        pos += length
+    if not flat or None in flat[1:-1:2]:
+        raise ValueError
+    return tuple(flat)
@@ -15,6 +15,7 @@ import uuid
 
 from fndb.backend import backend
 
+from . import context
 from . import key as key_module
 Key = key_module.Key # For export
 
@@ -29,12 +30,17 @@ def _validate_key(value, entity=None):
                             (entity._get_kind(), value.kind()))
     return value
 
+class UnprojectedPropertyError(AttributeError):
+    """Raised when getting a property that isn't in the projection of the
+    entity (see Query.fetch)."""
+
 class Property(object):
     """
     TODO: some way to make sure this doesn't get instantiated itself
     """
     _code_name = None
     _name = None
+    _indexed = True
     _repeated = False
     _required = False
     _default = None
@@ -42,7 +48,7 @@ class Property(object):
     _validator = None
     _verbose_name = None
 
-    _attributes = ['_name', '_repeated', '_required', '_default',
+    _attributes = ['_name', '_indexed', '_repeated', '_required', '_default',
                    '_verbose_name']
 
     def __new__(cls, *args, **kwargs):
@@ -50,8 +56,8 @@ class Property(object):
             raise TypeError("Property class may not be directly instantiated")
         return object.__new__(cls, *args, **kwargs)
 
-    def __init__(self, name=None, required=None, default=None, validator=None,
-                 verbose_name=None, choices=None, repeated=None):
+    def __init__(self, name=None, indexed=None, required=None, default=None,
+                 validator=None, verbose_name=None, choices=None, repeated=None):
         if name is not None:
             if isinstance(name, unicode):
                 name = name.encode('utf-8')
@@ -60,6 +66,8 @@ class Property(object):
             if '.' in name:
                 raise ValueError('Name %r cannot contain period characters' % (name,))
             self._name = name
+        if indexed is not None:
+            self._indexed = indexed
         if required is not None:
             self._required = required
         if default is not None:
@@ -95,7 +103,8 @@ class Property(object):
     # for details on how these can be used.
 
     def _comparison(self, op, value):
-        # TODO: cannot filter undex properties, I don't deal with indexed properties at all
+        # NOTE: unlike ndb, filtering on unindexed properties is allowed, the
+        # backends simply can't use an index to answer those filters
         from .query import FilterNode
         if value is not None:
             value = self._do_validate(value)
@@ -105,6 +114,16 @@ class Property(object):
         """Return a FilterNode instance representing the '=' comparison."""
         return self._comparison('=', value)
 
+    def _IN(self, value):
+        """Return a Node matching any of the values in `value` (an OR of '='
+        comparisons)."""
+        from .query import FilterNode
+        if not isinstance(value, (list, tuple, set, frozenset)):
+            raise ValueError('Expected list, tuple or set, got %r' % (value,))
+        values = [self._do_validate(v) if v is not None else None for v in value]
+        return FilterNode(self._name, 'in', values)
+    IN = _IN
+
     def __ne__(self, value):
         """Return a FilterNode instance representing the '!=' comparison."""
         return self._comparison('!=', value)
@@ -125,6 +144,18 @@ class Property(object):
         """Return a FilterNode instance representing the '>=' comparison."""
         return self._comparison('>=', value)
 
+    # Unary operators on Property instances return sort orders for queries.
+
+    def __neg__(self):
+        """Return a descending sort order on this Property."""
+        from .query import PropertyOrder
+        return PropertyOrder(self._name, PropertyOrder.DESCENDING)
+
+    def __pos__(self):
+        """Return an ascending sort order on this Property."""
+        from .query import PropertyOrder
+        return PropertyOrder(self._name, PropertyOrder.ASCENDING)
+
     #def _serialize(self, entity):
     #    return self._get_value(entity)
 
@@ -149,6 +180,10 @@ class Property(object):
     def _pre_put(self, entity):
         pass
 
+    def _has_pre_put(self):
+        """Whether _pre_put needs calling for this property."""
+        return self.__class__._pre_put.im_func is not Property._pre_put.im_func
+
     def _has_value(self, entity, unused_rest=None):
         return self._name in entity._values
 
@@ -164,6 +199,9 @@ class Property(object):
         entity._values[self._name] = value
 
     def _get_value(self, entity):
+        if entity._projection is not None and self._name not in entity._projection:
+            raise UnprojectedPropertyError('Property %s is not in the projection' %
+                                           self._code_name)
         value = entity._values.get(self._name, self._default)
         return [] if value is None and self._repeated else value
 
@@ -251,9 +289,11 @@ class DateTimeProperty(Property):
             elif auto_now_add:
                 raise ValueError('DateTimeProperty %s could use auto_now_add and be '
                                  'repeated, but there would be no point.' % self._name)
+        self._auto_now = auto_now
+        self._auto_now_add = auto_now_add
 
-            self._auto_now = auto_now
-            self._auto_now_add = auto_now_add
+    def _has_pre_put(self):
+        return self._auto_now or self._auto_now_add
 
     def _validate(self, value):
         if not isinstance(value, datetime.datetime):
@@ -267,6 +307,7 @@ class DateTimeProperty(Property):
             self._set_value(entity, value)
 
 class TextProperty(Property):
+    _indexed = False
 
     def _validate(self, value):
         if isinstance(value, str):
@@ -289,6 +330,8 @@ class TextProperty(Property):
 
 _MAX_STRING_LENGTH = 1000
 class StringProperty(TextProperty):
+    _indexed = True
+
     def _validate(self, value):
         value = super(StringProperty, self)._validate(value)
         if len(value) > _MAX_STRING_LENGTH:
@@ -317,6 +360,28 @@ class FloatProperty(Property):
                              (self, value,))
         return float(value)
 
+class _Plan(object):
+    """What put(), to_dict() and __eq__ need to know about a model's
+    properties, worked out once when the class is made (for Expandos it's
+    made from the properties they have at the time).
+    properties: the properties, ordered by name
+    pre_put: the properties with a _pre_put hook to run
+    required: the required properties
+    repeated: the names of the repeated properties
+    code_names: property name -> attribute name
+    names: attribute name -> property
+    """
+    __slots__ = ('properties', 'pre_put', 'required', 'repeated', 'code_names', 'names')
+
+    def __init__(self, properties):
+        props = tuple(prop for _, prop in sorted(properties.iteritems()))
+        self.properties = props
+        self.pre_put = tuple(prop for prop in props if prop._has_pre_put())
+        self.required = tuple(prop for prop in props if prop._required)
+        self.repeated = frozenset(prop._name for prop in props if prop._repeated)
+        self.code_names = dict((prop._name, prop._code_name) for prop in props)
+        self.names = dict((prop._code_name, prop) for prop in props)
+
 class ModelMeta(type):
     def __init__(cls, name, bases, classdict):
         super(ModelMeta, cls).__init__(name, bases, classdict)
@@ -327,11 +392,25 @@ class Model(object):
     # Class variables for properties
     _properties = None
     _has_repeated = False
+    # whether entities are kept in the context cache (see context.py)
+    _use_cache = True
+    # a _Plan of the properties, made by _configure_properties
+    _plan = None
     _kind_map = {}
 
+    # Composite indexes, given as tuples of property names with a '-' in front
+    # of the descending ones, e.g. _indexes = [('status', '-created')].
+    # _composite_indexes holds them as tuples of (name, descending) pairs
+    # using the names the properties are stored under.
+    _indexes = ()
+    _composite_indexes = ()
+
     # Defaults for instance variables.
     _entity_key = None
     _values = None
+    # the names of the properties loaded by a projection query, for partial
+    # entities (which can't be put)
+    _projection = None
     
     # Hardcoded pseudo-property for the key (makes sure every model has a key).
     _key = ModelKey()
@@ -352,17 +431,52 @@ class Model(object):
                                 (cls.__name__, kind))
         cls._properties = {}
         if cls.__module__ == __name__:
+            cls._configure_plan()
             return
-        for name in set(dir(cls)):
-            attr = getattr(cls, name, None)
+        # the class attributes, with the ones of subclasses taking precedence
+        attrs = {}
+        for klass in reversed(cls.__mro__):
+            attrs.update(vars(klass))
+        for name, attr in attrs.iteritems():
             if isinstance(attr, Property) and not isinstance(attr, ModelKey):
                 attr._set_code_name(cls, name)
                 if attr._name in cls._properties:
                     raise ValueError('Class %s defines multiple properties with the '
                                      'same name: %s' % (cls.__name__, attr._name))
                 cls._properties[attr._name] = attr
+        cls._configure_plan()
+        cls._configure_indexes()
         cls._kind_map[cls._get_kind()] = cls
 
+    @classmethod
+    def _configure_plan(cls):
+        cls._plan = _Plan(cls._properties)
+
+    @classmethod
+    def _configure_indexes(cls):
+        indexes = []
+        for columns in cls._indexes:
+            if isinstance(columns, basestring):
+                raise TypeError('Class %s defines an index that is a string (%r); '
+                                'indexes must be tuples of property names' %
+                                (cls.__name__, columns))
+            index = []
+            for name in columns:
+                descending = name.startswith('-')
+                name = name.lstrip('-')
+                prop = getattr(cls, name, None)
+                if not isinstance(prop, Property):
+                    prop = cls._properties.get(name)
+                if prop is None or isinstance(prop, ModelKey):
+                    raise ValueError('Class %s defines an index on an unknown '
+                                     'property: %s' % (cls.__name__, name))
+                if not prop._indexed:
+                    raise ValueError('Class %s defines an index on the unindexed '
+                                     'property: %s' % (cls.__name__, name))
+                index.append((prop._name, descending))
+            indexes.append(tuple(index))
+        cls._composite_indexes = tuple(indexes)
+
     def __init__(*args, **kwargs):
         if len(args) > 1:
             raise TypeError('Model constructor takes no positional arguments.')
@@ -384,8 +498,11 @@ class Model(object):
         
     def _set_attributes(self, kwargs):
         cls = self.__class__
+        names = self._plan.names
         for name, value in kwargs.iteritems():
-            prop = getattr(cls, name)
+            prop = names.get(name)
+            if prop is None:
+                prop = getattr(cls, name)
             if not isinstance(prop, Property):
                 raise TypeError('Cannot set non-property %s' % name)
             # TODO: maybe we shouldn't call __x__ directly?
@@ -410,16 +527,66 @@ class Model(object):
         return cls.__name__
 
     def put(self):
+        self._key = backend.put(*self._prepare_for_put())
+        context._written(self._key, self)
+        return self
+
+    def put_async(self):
+        """Returns a Future of put(), see future.py."""
+        from . import future
+        return future._queue('put', self)
+
+    def _prepare_for_put(self):
+        """Returns the (key, value) pair to write to the backend for this entity"""
+        if self._projection is not None:
+            raise ValueError('Cannot put a partial entity (from a projection query)')
         if self._key is None:
             self._key = Key(self._get_kind(), None)
-        val = {}
-        for name, prop in sorted(self._properties.iteritems()):
+        plan = self._plan
+        for prop in plan.pre_put:
             prop._pre_put(self)
-            val[name] = prop._get_value(self)
-            if prop._required and val[name] is None:
-                raise ValueError('Entity has uninitialized properties: %s' % name)
-        self._key = backend.put(self._key, val)
-        return self
+        val = {}
+        for prop in plan.properties:
+            val[prop._name] = prop._get_value(self)
+        for prop in plan.required:
+            if val[prop._name] is None:
+                raise ValueError('Entity has uninitialized properties: %s' % prop._name)
+        return self._key, val
+
+    @classmethod
+    def _from_stored(cls, key, value):
+        """Builds an entity for `key` from the value stored in the backend
+        (a dict of property name to value).
+
+        The values were validated when they were put, so (other than for
+        Expandos, which need a property made for every dynamic attribute)
+        they go straight into the entity's _values without going through
+        the constructor or the properties' validators.
+        """
+        cls = cls._kind_map.get(key.kind())
+        if issubclass(cls, Expando):
+            kwargs = {}
+            for k,v in value.iteritems():
+                if v is not None:
+                    prop = cls._properties.get(k)
+                    kwargs[k if prop is None else prop._code_name] = v
+            return cls(key=key, **kwargs)
+        values = {}
+        repeated = cls._plan.repeated
+        for name, v in value.iteritems():
+            if v is not None:
+                if name in repeated:
+                    # the dict backend hands out the lists it stores
+                    v = list(v)
+                values[name] = v
+        unknown = values.viewkeys() - cls._properties.viewkeys()
+        if unknown:
+            raise KeyError('%s has no properties named %s' %
+                           (cls.__name__, ', '.join(sorted(unknown))))
+        entity = object.__new__(cls)
+        entity._entity_key = key
+        entity._values = values
+        return entity
 
     @classmethod
     def get_by_id(cls, id, parent=None):
@@ -450,12 +617,15 @@ class Model(object):
             not isinstance(exclude, (list, tuple, set, frozenset))):
             raise TypeError('exclude should be a list, tuple or set')
         values = {}
-        for prop in self._properties.itervalues():
+        projection = self._projection
+        for prop in self._plan.properties:
             name = prop._code_name
             if include is not None and name not in include:
                 continue
             if exclude is not None and name in exclude:
                 continue
+            if projection is not None and prop._name not in projection:
+                continue
             values[name] = prop._get_value(self)
         return values
             
@@ -487,25 +657,30 @@ class Model(object):
     def __eq__(self, other):
         if other.__class__ is not self.__class__:
             return NotImplemented
-        if self._key != other._key:
+        if self._key != other._key or self._projection != other._projection:
             return False
-        if len(self._properties) != len(other._properties):
+        plan = self._plan
+        other_plan = other._plan
+        if plan is not other_plan and plan.code_names != other_plan.code_names:
             return False  # Can only happen for Expandos.
-        my_prop_names = set(self._properties.iterkeys())
-        their_prop_names = set(other._properties.iterkeys())
-        if my_prop_names != their_prop_names:
-            return False
-        for name in my_prop_names:
-            if '.' in name:
-                name, _ = name.split('.', 1)
-            my_value = self._properties[name]._get_value(self)
-            their_value = other._properties[name]._get_value(other)
-            if my_value != their_value:
+        for prop in plan.properties:
+            if self._projection is not None and prop._name not in self._projection:
+                continue
+            if prop._get_value(self) != prop._get_value(other):
                 return False
         return True
 
 class Expando(Model):
-   
+
+    @classmethod
+    def _configure_plan(cls):
+        pass
+
+    @property
+    def _plan(self):
+        # properties are added as attributes are set, so it can't be kept
+        return _Plan(self._properties)
+
     def _set_attributes(self, kwargs):
         for name, value in kwargs.iteritems():
             setattr(self, name, value)
@@ -542,6 +717,63 @@ class Expando(Model):
         del self._properties[name]
 
 
+def get_multi(keys):
+    """Fetches the entities for a sequence of keys in one go.
+    Returns a list with an entity (or None if there isn't one) for every key.
+    """
+    from . import future
+    # so what this thread has put is seen
+    future.flush()
+    return _get_multi(keys)
+
+def _get_multi(keys):
+    keys = list(keys)
+    ctx = context.get_context()
+    if ctx is None:
+        values = backend.get_multi(keys)
+        return [None if value is None else Model._from_stored(key, value)
+                for key, value in zip(keys, values)]
+    entities = [ctx._get(key) for key in keys]
+    missing = [key for key, entity in zip(keys, entities)
+               if entity is context._NOT_CACHED]
+    if missing:
+        loaded = {}
+        for key, value in zip(missing, backend.get_multi(missing)):
+            loaded[key] = None if value is None else Model._from_stored(key, value)
+            ctx._set(key, loaded[key])
+        entities = [loaded[key] if entity is context._NOT_CACHED else entity
+                    for key, entity in zip(keys, entities)]
+    return entities
+
+def put_multi(entities):
+    """Writes a sequence of entities in one go. Returns the list of their keys."""
+    entities = list(entities)
+    keys = backend.put_multi([entity._prepare_for_put() for entity in entities])
+    for entity, key in zip(entities, keys):
+        entity._key = key
+        context._written(key, entity)
+    return keys
+
+def get_multi_async(keys):
+    """Returns a list of Futures of the entities for `keys` (see future.py),
+    which raise KeyError for the ones there isn't an entity for."""
+    from . import future
+    return [future._queue('get', key) for key in keys]
+
+def put_multi_async(entities):
+    """Returns a list of Futures of the entities being put (see future.py)."""
+    from . import future
+    return [future._queue('put', entity) for entity in entities]
+
+def delete_multi(keys):
+    """Deletes the entities for a sequence of keys in one go."""
+    keys = list(keys)
+    backend.delete_multi(keys)
+    for key in keys:
+        context._written(key, None)
+
+__all__ += ['get_multi', 'put_multi', 'delete_multi', 'get_multi_async', 'put_multi_async']
+
 # Update __all__ to contain all Property and Exception subclasses.
 for _name, _object in globals().items():
     if ((_name.endswith('Property') and issubclass(_object, Property)) or
@@ -36,24 +36,50 @@ class FalseNode(Node):
             return NotImplemented
         return True
 
+    def matches(self, obj):
+        return False
+
 class FilterNode(Node):
     """Tree node for a single filter expression."""
 
     def __new__(cls, name, opsymbol, value):
-        if isinstance(value, model.Key):
-            value = value.to_old_key()
         if opsymbol == '!=':
             n1 = FilterNode(name, '<', value)
             n2 = FilterNode(name, '>', value)
             return DisjunctionNode(n1, n2)
         if opsymbol == 'in':
-            pass # TODO:
+            if not isinstance(value, (list, tuple, set, frozenset)):
+                raise TypeError('in expects a list, tuple or set of values; '
+                                'received %r' % (value,))
+            nodes = [FilterNode(name, '=', v) for v in value]
+            if not nodes:
+                return FalseNode()
+            return DisjunctionNode(*nodes)
         self = super(FilterNode, cls).__new__(cls)
         self.__name = name
         self.__opsymbol = opsymbol
         self.__value = value
         return self
 
+    def __getnewargs__(self):
+        return self.__name, self.__opsymbol, self.__value
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def opsymbol(self):
+        return self.__opsymbol
+
+    @property
+    def value(self):
+        return self.__value
+
+    def __repr__(self):
+        return '%s(%r, %r, %r)' % (self.__class__.__name__,
+                                   self.__name, self.__opsymbol, self.__value)
+
     def __eq__(self, other):
         if not isinstance(other, FilterNode):
             return NotImplemented
@@ -62,7 +88,15 @@ class FilterNode(Node):
                 self.__value == other.__value)
 
     def matches(self, obj):
-        values = getattr(obj, self.__name)
+        # filters use the names properties are stored under, which aren't
+        # necessarily the attribute names
+        prop = obj._properties.get(self.__name)
+        if prop is not None:
+            values = prop._get_value(obj)
+        elif self.__name == '__key__':
+            values = obj._key
+        else:
+            values = getattr(obj, self.__name)
         # TODO: should maybe add in a check for obj.prop._repeated = True
         if not hasattr(values, '__iter__'):
             values = [values]
@@ -70,14 +104,19 @@ class FilterNode(Node):
             return any(v == self.__value for v in values)
         elif self.__opsymbol == '!=':
             return any(v != self.__value for v in values)
-        elif self.__opsymbol == '>':
-            return any(v > self.__value for v in values)
-        elif self.__opsymbol == '<':
-            return any(v < self.__value for v in values)
-        elif self.__opsymbol == '>=':
-            return any(v >= self.__value for v in values)
-        elif self.__opsymbol == '<=':
-            return any(v <= self.__value for v in values)
+        elif self.__opsymbol in ('>', '<', '>=', '<='):
+            # compared the way the indexes sort them, so e.g. an unset
+            # datetime is less than any datetime rather than a TypeError
+            from fndb.backend.index import _sort_value
+            value = _sort_value(self.__value)
+            values = [_sort_value(v) for v in values]
+            if self.__opsymbol == '>':
+                return any(v > value for v in values)
+            elif self.__opsymbol == '<':
+                return any(v < value for v in values)
+            elif self.__opsymbol == '>=':
+                return any(v >= value for v in values)
+            return any(v <= value for v in values)
         elif self.__opsymbol == '__contains__':
             return any(self.__value in v for v in values)
         raise TypeError("unexpected op symbol %s" % self.__opsymbol)
@@ -121,6 +160,9 @@ class ConjunctionNode(Node):
         self.__nodes = clauses[0]
         return self
 
+    def __getnewargs__(self):
+        return tuple(self.__nodes)
+
     def __iter__(self):
         return iter(self.__nodes)
 
@@ -152,6 +194,9 @@ class DisjunctionNode(Node):
                 self.__nodes.append(node)
         return self
 
+    def __getnewargs__(self):
+        return tuple(self.__nodes)
+
     def __iter__(self):
         return iter(self.__nodes)
 
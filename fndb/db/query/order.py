@@ -1,10 +1,82 @@
 
-# TODO: everything!!!! (a lot from datastore_query)
-
-__all__ = ['Order', 'PropertyOrder']
+__all__ = ['Order', 'PropertyOrder', 'CompositeOrder']
 
 class Order(object):
-    pass
+    """Base class for the sort orders of a query."""
+
+    def __iter__(self):
+        """Iterates over the PropertyOrders making up this order."""
+        raise NotImplementedError
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is not NotImplemented:
+            eq = not eq
+        return eq
 
 class PropertyOrder(Order):
-    pass
+    """Sort order on a single property."""
+    ASCENDING = 1
+    DESCENDING = 2
+
+    def __init__(self, name, direction=ASCENDING):
+        if direction not in (self.ASCENDING, self.DESCENDING):
+            raise ValueError('direction must be ASCENDING or DESCENDING; '
+                             'received %r' % (direction,))
+        self.__name = name
+        self.__direction = direction
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def direction(self):
+        return self.__direction
+
+    def reversed(self):
+        """Returns the same order in the opposite direction."""
+        if self.__direction == self.ASCENDING:
+            return PropertyOrder(self.__name, self.DESCENDING)
+        return PropertyOrder(self.__name, self.ASCENDING)
+
+    def __iter__(self):
+        return iter([self])
+
+    def __eq__(self, other):
+        if not isinstance(other, PropertyOrder):
+            return NotImplemented
+        return (self.__name == other.__name and
+                self.__direction == other.__direction)
+
+    def __repr__(self):
+        return '%s(%r, %s)' % (self.__class__.__name__, self.__name,
+                               'ASCENDING' if self.__direction == self.ASCENDING
+                               else 'DESCENDING')
+
+class CompositeOrder(Order):
+    """Sort order on several properties, the first one being the most
+    significant."""
+
+    def __init__(self, orders):
+        flat = []
+        for order in orders:
+            if not isinstance(order, Order):
+                raise TypeError('CompositeOrder() expects Order instances; '
+                                'received %r' % (order,))
+            flat.extend(order)
+        self.__orders = flat
+
+    def __iter__(self):
+        return iter(self.__orders)
+
+    def __eq__(self, other):
+        if not isinstance(other, CompositeOrder):
+            return NotImplemented
+        return self.__orders == other.__orders
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.__orders)
+
+_ASC = PropertyOrder.ASCENDING
+_DESC = PropertyOrder.DESCENDING
@@ -1,19 +1,74 @@
 
+import base64
 from ..model import Key
 from fndb.backend import backend
-from .. import model
+from .. import context, future, model
 
 
-__all__ = ['Query',]
+__all__ = ['Query', 'Cursor']
 
 from .node import *
 from .order import *
+from .order import _ASC
 
 from . import node
 __all__ += node.__all__
 from . import order
 __all__ += order.__all__
 
+class Cursor(object):
+    """A position in the results of a query, as returned by fetch_page() to
+    get the next page with. Cursor(urlsafe=s) makes one from the string its
+    urlsafe() method returns.
+
+    It holds the key of the last result and the values it had for the
+    properties the query is ordered on, so the next page starts right after
+    it even if the entities were written in between."""
+    def __init__(self, urlsafe=None):
+        self._key = None
+        self._values = ()
+        if urlsafe is not None:
+            from fndb.backend import codec
+            try:
+                data = base64.urlsafe_b64decode(str(urlsafe) + '=' * (-len(urlsafe) % 4))
+                values = codec.decode_values(data)
+            except (TypeError, ValueError, UnicodeError):
+                raise ValueError('Invalid cursor %r' % (urlsafe,))
+            if not values or not isinstance(values[0], (Key, type(None))):
+                raise ValueError('Invalid cursor %r' % (urlsafe,))
+            self._key = values[0]
+            self._values = values[1:]
+
+    @classmethod
+    def _from_position(cls, position):
+        cursor = cls()
+        cursor._key = position.key
+        cursor._values = position.values
+        return cursor
+
+    def _position(self):
+        from fndb.backend import utils
+        return utils.Position(self._key, self._values)
+
+    def urlsafe(self):
+        from fndb.backend import codec
+        data = codec.encode_values((self._key,) + tuple(self._values))
+        return base64.urlsafe_b64encode(data).rstrip('=')
+
+    def __eq__(self, other):
+        if not isinstance(other, Cursor):
+            return NotImplemented
+        return self.urlsafe() == other.urlsafe()
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is not NotImplemented:
+            eq = not eq
+        return eq
+
+    def __repr__(self):
+        return 'Cursor(urlsafe=%r)' % self.urlsafe()
+
 class Query(object):
     """
     """
@@ -28,7 +83,11 @@ class Query(object):
             if not isinstance(filters, Node):
                 raise TypeError('filters must be a query Node or None; received %r' %
                                 (filters,))
-        # TODO: orders, default_options
+        if orders is not None:
+            if not isinstance(orders, Order):
+                raise TypeError('orders must be an Order instance or None; '
+                                'received %r' % (orders,))
+        # TODO: default_options
         self.__ancestor = ancestor
         self.__kind = kind
         self.__filters = filters
@@ -53,7 +112,7 @@ class Query(object):
 
     @property
     def orders(self):
-        """Accessor for the filters (an Order or None)."""
+        """Accessor for the orders (an Order or None)."""
         return self.__orders
     
     @property
@@ -109,38 +168,185 @@ class Query(object):
                               filters=self.filters, orders=orders,
                               default_options=self.default_options)
 
-    def _fetch(self, limit=None):
-        """A really dirty fetch
-        NOTE: this really sucks as it doesn't take advantage of anything the
-        backend might provide to help out with making searches quicker.
+    def _projection_names(self, projection):
+        """Returns a frozenset of the names the properties in `projection`
+        (Property instances or attribute names) are stored under."""
+        cls = model.Model._kind_map.get(self.kind)
+        names = []
+        for prop in projection:
+            if isinstance(prop, basestring):
+                name = prop
+                prop = getattr(cls, name, None) if cls is not None else None
+                if prop is None:
+                    if cls is not None and not issubclass(cls, model.Expando):
+                        raise ValueError('%s has no property %s' % (cls.__name__, name))
+                    names.append(name)
+                    continue
+            if not isinstance(prop, model.Property) or isinstance(prop, model.ModelKey):
+                raise TypeError('Cannot project on %r' % (prop,))
+            names.append(prop._name)
+        if not names:
+            raise ValueError('projection needs at least one property')
+        return frozenset(names)
+
+    def _fetch(self, limit=None, parallel=None, position=None, keys_only=False,
+               projection=None):
+        """Runs the query against the backend, falling back to a generic scan
+        of every key if the backend doesn't know how to process queries.
+        With `parallel` the query is always run as a scan, split between that
+        many processes. With `position` (a backend.utils.Position) the results
+        start after it, and it's kept up to date with where they got to. With
+        `keys_only` the keys of the results are yielded instead, and with
+        `projection` (a list of properties) partial entities with only those
+        properties.
 
-        TODO: make the backend code responsible for processing queries.
-        _fetch could call a backend.query(self) function, which would use
-        all the information available in the query (kind, ancestor, filters, etc)
-        to make the query as quick as possible
+        A final None is yielded after the results so get() has something
+        to return when nothing matches.
         """
-        matches = 0
-        for k in backend.keys():
-            if self.__ancestor is not None and self.__ancestor != k.parent():
-                continue
-            if self.__kind != k.kind(): #not in k[0::2]:
-                continue
-            if self.__filters is not None:
-                flts = self.filters
-                if isinstance(flts, Node):
-                    flts = [flts]
-                if flts:
-                    obj = k.get()
-                    if not all(f.matches(obj) for f in flts):
-                        continue
-            matches += 1
-            yield k.get()
-            if limit is not None and matches >= limit:
-                break
+        from fndb.backend import utils
+        names = None
+        if projection is not None:
+            if keys_only:
+                raise ValueError('keys_only and projection cannot be used together')
+            names = self._projection_names(projection)
+        # so what this thread has put is seen
+        future.flush()
+        if parallel:
+            if position is not None:
+                raise ValueError('parallel queries cannot be started from a cursor')
+            results = utils.parallel_scan(self, backend, parallel, limit)
+            if keys_only:
+                results = (entity.key for entity in results)
+        else:
+            # only passed when needed, for backends that don't take them
+            kwargs = {}
+            if position is not None:
+                kwargs['position'] = position
+            if keys_only:
+                kwargs['keys_only'] = True
+            if names is not None:
+                # the filters and orders may need checking too
+                kwargs['projection'] = frozenset(names | self._property_names())
+            try:
+                results = backend.query(self, limit=limit, **kwargs)
+            except NotImplementedError:
+                results = utils.scan(self, backend, limit, position, keys_only)
+        ctx = context.get_context()
+        if keys_only or names is not None:
+            ctx = None
+        for entity in results:
+            if ctx is not None:
+                entity = ctx._from_query(entity)
+            elif names is not None:
+                values = entity._values
+                entity._values = dict((name, values[name]) for name in names
+                                      if name in values)
+                entity._projection = names
+            yield entity
         yield None
 
-    def fetch(self, limit=None):
-        return [k for k in self._fetch(limit) if k is not None]
+    def _property_names(self):
+        """Returns a set of the names of the properties the filters and
+        orders of the query are on."""
+        names = set()
+        nodes = [self.filters] if self.filters is not None else []
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, FilterNode):
+                names.add(node.name)
+            elif isinstance(node, (ConjunctionNode, DisjunctionNode)):
+                nodes.extend(node)
+        if self.orders is not None:
+            names.update(order.name for order in self.orders)
+        names.discard('__key__')
+        return names
+
+    def fetch(self, limit=None, parallel=None, keys_only=False, projection=None):
+        """Returns a list of the entities matching the query. `parallel` is
+        a number of processes to go through the kind with, for queries
+        the backend's indexes can't help with (e.g. _CONTAINS filters on
+        big kinds) on a machine with the cores to spare.
+
+        With `keys_only` a list of their keys is returned instead, which
+        doesn't load the entities when the backend's indexes can answer the
+        filters by themselves.
+
+        With `projection`, a list of properties (or their names), the
+        entities only have those properties: getting any other raises
+        UnprojectedPropertyError, and they can't be put. Only those
+        properties are read (and those the filters and orders need), from
+        the backend's indexes if they're all indexed."""
+        return [k for k in self._fetch(limit, parallel, keys_only=keys_only,
+                                       projection=projection) if k is not None]
+
+    def iter(self, limit=None, keys_only=False, projection=None):
+        """Returns an iterator over the results of the query (see fetch())."""
+        return (k for k in self._fetch(limit, keys_only=keys_only, projection=projection)
+                if k is not None)
+
+    def fetch_async(self, limit=None, keys_only=False, projection=None):
+        """Returns a Future of fetch(), which is run on a thread pool (see
+        future.py)."""
+        # the query should see the puts made before it
+        future.flush()
+        ctx = context.get_context()
+        def fetch():
+            if ctx is None:
+                return self.fetch(limit, keys_only=keys_only, projection=projection)
+            with ctx:
+                return self.fetch(limit, keys_only=keys_only, projection=projection)
+        return future._start(fetch)
+
+    def fetch_page(self, page_size, start_cursor=None, keys_only=False, projection=None):
+        """Returns a (results, cursor, more) tuple: a list of (at most)
+        `page_size` entities (or keys, with `keys_only`) starting after
+        `start_cursor` (or from the beginning), a Cursor to get the next page
+        with and whether there are more results after this page.
+
+        The next page carries on from where this one ended rather than
+        going through the results before it again. Pages come in the order
+        of the query's orders and then of the keys (just the keys if the
+        query has no orders).
+        """
+        if start_cursor is not None:
+            position = start_cursor._position()
+        else:
+            from fndb.backend import utils
+            position = utils.Position()
+        results = []
+        cursor = start_cursor
+        more = False
+        for entity in self._fetch(page_size + 1, position=position, keys_only=keys_only,
+                                  projection=projection):
+            if entity is None:
+                break
+            if len(results) == page_size:
+                more = True
+                break
+            results.append(entity)
+            cursor = Cursor._from_position(position)
+        return results, cursor, more
+
+    def count(self, limit=None):
+        """Returns the number of entities matching the query, counting up to
+        `limit` if it is given. Backends answer it from their indexes when
+        they can, otherwise the keys of the results are counted (which only
+        loads the entities if the filters need checking)."""
+        # so what this thread has put is counted
+        future.flush()
+        # orders don't change the count, and without them the backend can
+        # pick the smallest index range
+        query = self.__class__(kind=self.kind, ancestor=self.ancestor,
+                               filters=self.filters,
+                               default_options=self.default_options)
+        n = backend.count(query, limit=limit)
+        if n is None:
+            n = 0
+            for _ in query.iter(limit, keys_only=True):
+                n += 1
+        if limit is not None:
+            n = min(n, max(limit, 0))
+        return n
 
     def get(self):
         g = self._fetch()
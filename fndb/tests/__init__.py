@@ -3,3 +3,9 @@ from basic import *
 __all__ += basic.__all__
 from query import *
 __all__ += query.__all__
+from backend import *
+__all__ += backend.__all__
+from context import *
+__all__ += context.__all__
+from future import *
+__all__ += future.__all__
@@ -0,0 +1,791 @@
+import os
+import uuid
+import shutil
+from basetest import BaseTest
+from fndb.backend import backend
+from fndb.config import settings
+
+__all__ = ['BackendTest', 'DictLogBackendTest', 'DictPickleFileBackendTest',
+           'SimpleKVBackendTest', 'SqliteBackendTest', 'MmapStoreBackendTest',
+           'CacheBackendTest', 'CodecTest']
+
+from fndb import db
+class BackendTestModel(db.Model):
+    a = db.StringProperty()
+
+class BackendTestChild(db.Model):
+    a = db.StringProperty()
+
+class BackendTestIndexed(db.Model):
+    i = db.IntegerProperty()
+    r = db.IntegerProperty(repeated=True)
+    t = db.TextProperty()
+
+class BackendTestOrder(db.Model):
+    status = db.StringProperty()
+    created = db.IntegerProperty()
+    tags = db.StringProperty(repeated=True)
+    _indexes = [('status', '-created'), ('tags', 'status', 'created')]
+
+class BackendTest(BaseTest):
+
+    def test_delete(self):
+        x = BackendTestModel(a='x').put()
+        self.assertEqual(len(BackendTestModel.query().fetch()), 1)
+        x.key.delete()
+        with self.assertRaises(KeyError):
+            x.key.get()
+        self.assertEqual(BackendTestModel.query().fetch(), [])
+        # deleting twice is harmless
+        x.key.delete()
+
+    def test_concurrent_queries(self):
+        import sys
+        import threading
+        class BackendTestConcurrent(db.Model):
+            a = db.IntegerProperty()
+        X = BackendTestConcurrent
+        xs = [X(a=i).put() for i in range(10)]
+        done = []
+        results = []
+        def write():
+            for i in range(300):
+                x = xs[i % 10]
+                x.a = (x.a + 1) % 20
+                x.put()
+            done.append(True)
+        def read():
+            while not done:
+                results.append(len(X.query(X.a >= 0).fetch()))
+                results.append(len(backend.keys()) >= 10)
+        interval = sys.getcheckinterval()
+        # switch threads as often as possible
+        sys.setcheckinterval(1)
+        try:
+            threads = [threading.Thread(target=write)]
+            threads += [threading.Thread(target=read) for i in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setcheckinterval(interval)
+        # updated entities never went missing (and the readers didn't die)
+        self.assertTrue(results)
+        self.assertEqual(set(results), set([10, True]))
+
+    def test_key_index(self):
+        p1 = BackendTestModel(a='p1').put()
+        p2 = BackendTestModel(a='p2').put()
+        c1 = BackendTestChild(parent=p1.key).put()
+        c2 = BackendTestChild(parent=p2.key).put()
+        index = backend.index
+        self.assertIn(c1.key, index)
+        self.assertEqual(len(index.keys(BackendTestChild._get_kind())), 2)
+        self.assertEqual(len(index.keys(ancestor=p1.key)), 1)
+        c1.key.delete()
+        self.assertNotIn(c1.key, index)
+        self.assertEqual(index.keys(ancestor=p1.key), [])
+        q = db.Query(kind=BackendTestChild._get_kind(), ancestor=p2.key)
+        self.assertEqual([x.key for x in q.fetch()], [c2.key])
+
+    def test_property_index(self):
+        X = BackendTestIndexed
+        for i in range(10):
+            X(i=i, r=[i, i + 10], t=u'text %d' % i).put()
+        index = backend.index.properties[X._get_kind()]
+        self.assertEqual(len(index['i']), 10)
+        self.assertEqual(len(index['r']), 20)
+        self.assertNotIn('t', index)
+
+        def fetch(*filters):
+            return sorted(x.i for x in X.query(*filters).fetch())
+        self.assertEqual(fetch(X.i == 3), [3])
+        self.assertEqual(fetch(X.i < 3), [0, 1, 2])
+        self.assertEqual(fetch(X.i <= 3), [0, 1, 2, 3])
+        self.assertEqual(fetch(X.i > 7), [8, 9])
+        self.assertEqual(fetch(X.i >= 7), [7, 8, 9])
+        self.assertEqual(fetch(X.i > 2, X.i < 5), [3, 4])
+        self.assertEqual(fetch(X.i > 5, X.i < 5), [])
+        # each filter may match a different value of a repeated property
+        self.assertEqual(fetch(X.r > 10, X.r < 8), [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(fetch(X.r == 15), [5])
+        self.assertEqual(fetch(X.i > 4, X.r < 8), [5, 6, 7])
+        # unindexed properties can still be filtered on
+        self.assertEqual(fetch(X.t._CONTAINS(u'5')), [5])
+        self.assertEqual(fetch(X.t == u'text 5', X.i < 6), [5])
+
+        # the index is kept up to date
+        x = X.query(X.i == 3).get()
+        x.i = 30
+        x.r = [30]
+        x.put()
+        self.assertEqual(fetch(X.i == 3), [])
+        self.assertEqual(fetch(X.i == 30), [30])
+        self.assertEqual(fetch(X.r == 13), [])
+        x.key.delete()
+        self.assertEqual(fetch(X.i == 30), [])
+        self.assertEqual(len(index['i']), 9)
+
+    def test_union(self):
+        from fndb.db import model
+        class BackendTestUnion(db.Model):
+            i = db.IntegerProperty()
+            r = db.IntegerProperty(repeated=True)
+            t = db.TextProperty()
+        X = BackendTestUnion
+        for i in range(100):
+            X(i=i, r=[i % 10, 100 + i % 7], t=u'text').put()
+        # an OR is the union of the ranges of its branches
+        q = X.query(X.i.IN([3, 50, 99]))
+        keys, ordered, exact = backend.index.plan(q)
+        self.assertEqual((len(keys), ordered, exact), (3, True, True))
+        q = X.query(db.OR(X.i < 5, X.r == 3)).order(-X.i)
+        keys, ordered, exact = backend.index.plan(q)
+        self.assertEqual((len(keys), ordered, exact), (14, False, True))
+        self.assertEqual([x.i for x in q.fetch()],
+                         [93, 83, 73, 63, 53, 43, 33, 23, 13, 4, 3, 2, 1, 0])
+        self.assertEqual(q.count(), 14)
+        # with a limit, branches that are in order are merged as far as needed
+        q = X.query(db.OR(X.i < 20, X.i >= 90, X.i.IN([50, 95]))).order(-X.i)
+        keys, ordered, exact = backend.index.plan(q)
+        self.assertEqual((len(keys), ordered, exact), (31, False, True))
+        self.assertIsNotNone(keys.branches)
+        self.assertEqual([x.i for x in q.fetch()],
+                         range(99, 89, -1) + [50] + range(19, -1, -1))
+        loads = []
+        from_stored = model.Model.__dict__['_from_stored']
+        def counting(cls, key, value):
+            loads.append(key)
+            return from_stored.__func__(cls, key, value)
+        model.Model._from_stored = classmethod(counting)
+        try:
+            self.assertEqual([x.i for x in q.fetch(3)], [99, 98, 97])
+        finally:
+            model.Model._from_stored = from_stored
+        # a look ahead in each of the 4 branches, and 95 twice
+        self.assertLessEqual(len(loads), 8)
+        # the same entity from several branches
+        q = X.query(X.r.IN([1, 101])).order(X.i)
+        self.assertEqual([x.i for x in q.fetch()],
+                         sorted(set(range(1, 100, 10)) | set(range(1, 100, 7))))
+
+    def test_composite_index(self):
+        from fndb.db.query import PropertyOrder, CompositeOrder
+        X = BackendTestOrder
+        for i in range(20):
+            X(status='open' if i % 2 else 'closed', created=i,
+              tags=['a', 'b'] if i % 3 else ['a']).put()
+        DESC = PropertyOrder.DESCENDING
+        q = X.query(X.status == 'open', X.created > 10)
+        q = q.order(PropertyOrder('created', DESC))
+        keys, ordered = backend.index.candidates(q)
+        # a single contiguous range of the ('status', '-created') index
+        self.assertTrue(ordered)
+        self.assertEqual(len(keys), 5)
+        self.assertEqual([x.created for x in q.fetch()], [19, 17, 15, 13, 11])
+
+        # read backwards for the opposite order
+        q = X.query(X.status == 'open', X.created <= 5).order(X.created)
+        keys, ordered = backend.index.candidates(q)
+        self.assertTrue(ordered)
+        self.assertEqual([x.created for x in q.fetch()], [1, 3, 5])
+
+        # equality on a repeated property
+        q = X.query(X.status == 'closed', X.tags == 'b')
+        q = q.order(X.created)
+        keys, ordered = backend.index.candidates(q)
+        self.assertTrue(ordered)
+        self.assertEqual([x.created for x in q.fetch()], [2, 4, 8, 10, 14, 16])
+
+        # orders on properties with an equality filter don't matter
+        q = X.query(X.status == 'open').order(X.status, X.created)
+        self.assertTrue(backend.index.candidates(q)[1])
+        # orders that don't match the index columns can't use it
+        q = X.query(X.status == 'open').order(X.tags, -X.created)
+        self.assertFalse(backend.index.candidates(q)[1])
+        self.assertEqual([x.created for x in q.fetch()],
+                         [19, 17, 15, 13, 11, 9, 7, 5, 3, 1])
+
+        # whether the range answers all the filters
+        q = X.query(X.status == 'open', X.created > 10).order(-X.created)
+        self.assertTrue(backend.index.plan(q)[2])
+        q = X.query(X.status == 'open', X.tags == 'b').order(-X.created)
+        self.assertTrue(backend.index.plan(q)[2])
+        q = X.query(X.tags == 'b', X.created > 3)
+        self.assertFalse(backend.index.plan(q)[2])
+        self.assertEqual(q.fetch(keys_only=True), [x.key for x in q.fetch()])
+
+    def test_composite_repeated_order(self):
+        class BackendTestTags(db.Model):
+            tags = db.StringProperty(repeated=True)
+            n = db.IntegerProperty()
+            _indexes = [('tags', 'n')]
+        X = BackendTestTags
+        X(tags=['a', 'z'], n=1).put()
+        X(tags=['c'], n=2).put()
+        X(tags=['d', 'y'], n=3).put()
+        for i in range(5):
+            X(key=db.Key(X, 10 + i), tags=['a'], n=10 + i).put()
+        # entities sort on their smallest (or largest) value, which may be
+        # outside of the range of the filter
+        q = X.query(X.tags > 'b').order(X.tags)
+        self.assertEqual([x.n for x in q.fetch()], [1, 2, 3])
+        q = X.query(X.tags < 'x').order(-X.tags)
+        self.assertEqual([x.n for x in q.fetch()], [1, 3, 2] + range(10, 15))
+        self.assertEqual([x.n for x in q.fetch(2)], [1, 3])
+        # entities with an empty list aren't in the composite index at all
+        X(tags=[], n=20).put()
+        q = X.query().order(X.tags, X.n)
+        self.assertEqual([x.n for x in q.fetch()], [20, 1] + range(10, 15) + [2, 3])
+
+    def test_composite_index_declaration(self):
+        with self.assertRaises(ValueError):
+            class BadIndex(db.Model):
+                a = db.StringProperty()
+                _indexes = [('a', 'b')]
+        with self.assertRaises(ValueError):
+            class UnindexedIndex(db.Model):
+                a = db.StringProperty()
+                t = db.TextProperty()
+                _indexes = [('a', 't')]
+        class NamedIndex(db.Model):
+            a = db.StringProperty(name='x')
+            b = db.IntegerProperty()
+            _indexes = [('a', '-b')]
+        self.assertEqual(NamedIndex._composite_indexes,
+                         ((('x', False), ('b', True)),))
+
+class DictLogBackendTest(BaseTest):
+
+    def setUp(self):
+        self.path = os.path.join(str(uuid.uuid1()), 'data')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def open(self, **kwargs):
+        from fndb.backend import dict
+        return dict.BackendWrapper(path=self.path, **kwargs)
+
+    def test_replay(self):
+        b = self.open()
+        k1 = b.put(db.Key(BackendTestModel, None), {'a': u'1'})
+        k2 = b.put(db.Key(BackendTestModel, None), {'a': u'2'})
+        b.put(k1, {'a': u'3'})
+        b.delete(k2)
+        b.close()
+        b = self.open()
+        self.assertEqual(b.get(k1), {'a': u'3'})
+        self.assertIsNone(b.get(k2))
+        self.assertIn(k1, b.index)
+        self.assertNotIn(k2, b.index)
+        b.close()
+
+    def test_failed_put(self):
+        b = self.open()
+        k = db.Key(BackendTestModel, 1)
+        def row(kind, value):
+            raise TypeError('not indexable')
+        b.index.row = row
+        self.assertRaises(TypeError, b.put, k, {'a': u'1'})
+        del b.index.row
+        # neither stored nor logged
+        self.assertIsNone(b.get(k))
+        self.assertNotIn(k, b.index)
+        b.close()
+        b = self.open()
+        self.assertIsNone(b.get(k))
+        b.close()
+
+    def test_dotted_keys(self):
+        from fndb.backend import dict
+        from fndb.backend.log import AppendLog
+        # a log written before keys were encoded by the codec
+        os.makedirs(self.path)
+        log = AppendLog(os.path.join(self.path, dict.LOG_FILE))
+        k1 = db.Key(BackendTestModel, 'a.b')
+        k2 = db.Key(BackendTestModel, 2)
+        log.append(('put', dict.dump_key(k2), {'a': u'1'}))
+        log.append(('put', dict.dump_key(k2), {'a': u'2'}))
+        log.commit()
+        log.close()
+        b = self.open()
+        self.assertEqual(b.get(k2), {'a': u'2'})
+        self.assertEqual(b.keys(), [k2])
+        b.put(k1, {'a': u'3'})
+        b.close()
+        b = self.open()
+        self.assertEqual(b.get(k1), {'a': u'3'})
+        self.assertEqual(sorted(b.keys()), [k2, k1])
+        self.assertEqual(len(b.index.keys(BackendTestModel._get_kind())), 2)
+        b.close()
+
+    def test_torn_write(self):
+        from fndb.backend import dict
+        b = self.open(sync_every=0)
+        k1 = b.put(db.Key(BackendTestModel, None), {'a': u'1'})
+        b.close()
+        log = os.path.join(self.path, dict.LOG_FILE)
+        size = os.path.getsize(log)
+        with open(log, 'ab') as f:
+            f.write('\x00\x00\x01\x00garbage')
+        b = self.open()
+        self.assertEqual(b.get(k1), {'a': u'1'})
+        # the broken record is dropped before anything else gets appended
+        k2 = b.put(db.Key(BackendTestModel, None), {'a': u'2'})
+        b.close()
+        self.assertGreater(os.path.getsize(log), size)
+        b = self.open()
+        self.assertEqual(b.get(k2), {'a': u'2'})
+        b.close()
+
+    def test_compaction(self):
+        from fndb.backend import dict
+        b = self.open(compact_size=1024)
+        keys = [b.put(db.Key(BackendTestModel, None), {'a': u'x' * 100})
+                for _ in range(50)]
+        b.delete(keys[0])
+        b.close()
+        log = os.path.join(self.path, dict.LOG_FILE)
+        self.assertTrue(os.path.exists(os.path.join(self.path, dict.SNAPSHOT_FILE)))
+        self.assertFalse(os.path.exists(os.path.join(self.path, dict.OLD_LOG_FILE)))
+        self.assertLess(os.path.getsize(log), 1024 + 200)
+        b = self.open()
+        self.assertIsNone(b.get(keys[0]))
+        self.assertEqual(b.get_multi(keys[1:]), [{'a': u'x' * 100}] * 49)
+        b.close()
+
+    def test_interrupted_compaction(self):
+        from fndb.backend import dict
+        b = self.open()
+        k1 = b.put(db.Key(BackendTestModel, None), {'a': u'1'})
+        b.close()
+        # as if the process died before the snapshot was written
+        os.rename(os.path.join(self.path, dict.LOG_FILE),
+                  os.path.join(self.path, dict.OLD_LOG_FILE))
+        b = self.open()
+        self.assertEqual(b.get(k1), {'a': u'1'})
+        self.assertFalse(os.path.exists(os.path.join(self.path, dict.OLD_LOG_FILE)))
+        b.close()
+        b = self.open()
+        self.assertEqual(b.get(k1), {'a': u'1'})
+        b.close()
+
+class DictPickleFileBackendTest(BaseTest):
+
+    def test_saved_at_exit(self):
+        import subprocess, sys, tempfile
+        import cPickle as pickle
+        from fndb.backend import dict
+        fd, name = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({}, f)
+            # a process that writes and exits without closing the backend
+            script = '''if 1:
+                from fndb.backend import dict
+                b = dict.BackendWrapper(pickle_file=open(%r, 'r+b'))
+                b.put(dict.Key('X', 1), {'a': 1})
+            ''' % name
+            env = os.environ.copy()
+            env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+                os.path.dirname(os.path.abspath(dict.__file__))))
+            subprocess.check_call([sys.executable, '-c', script], env=env)
+            with open(name, 'r+b') as f:
+                b = dict.BackendWrapper(pickle_file=f)
+                self.assertEqual(b.get(db.Key('X', 1)), {'a': 1})
+                b.close()
+        finally:
+            os.remove(name)
+
+class SimpleKVBackendTest(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setUpFilesystemStoreBackend()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tearDownFilesystemStoreBackend()
+
+    def test_index_persists(self):
+        from fndb.backend import simplekv
+        x = BackendTestModel(a='x').put()
+        y = BackendTestModel(a='y').put()
+        backend.close()
+        store = backend.store
+        self.assertNotIn(simplekv.DIRTY_KEY, store)
+        # loading the saved index never has to read the entities
+        get = store.get
+        names = []
+        def counted_get(name):
+            names.append(name)
+            return get(name)
+        store.get = counted_get
+        try:
+            b = simplekv.BackendWrapper(store=store)
+        finally:
+            del store.get
+        self.assertEqual(names, [simplekv.INDEX_KEY])
+        self.assertIn(x.key, b.index)
+        self.assertIn(y.key, b.index)
+
+    def test_index_shared_store(self):
+        from fndb.backend import simplekv
+        # two processes writing to the same store, each saving its own index
+        b1 = simplekv.BackendWrapper(store=backend.store)
+        b2 = simplekv.BackendWrapper(store=backend.store)
+        k1 = b1.put(db.Key(BackendTestChild, None), {'a': u'1'})
+        k2 = b2.put(db.Key(BackendTestChild, None), {'a': u'2'})
+        b1.close()
+        b2.close()
+        b = simplekv.BackendWrapper(store=backend.store)
+        self.assertIn(k1, b.index)
+        self.assertIn(k2, b.index)
+        b.delete_multi([k1, k2])
+        b.close()
+
+    def test_index_rebuilt_when_dirty(self):
+        from fndb.backend import simplekv
+        x = BackendTestChild(a='x').put()
+        self.assertIn(simplekv.DIRTY_KEY, backend.store)
+        # without a flush() the next backend can't trust the saved index
+        b = simplekv.BackendWrapper(store=backend.store)
+        self.assertIn(x.key, b.index)
+        self.assertNotIn(simplekv.DIRTY_KEY, backend.store)
+
+    def test_index_saved_at_exit(self):
+        import subprocess, sys, tempfile
+        from fndb.backend import simplekv
+        # a process that writes and exits without closing the backend
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        script = '''if 1:
+            from simplekv.fs import FilesystemStore
+            from fndb.backend import simplekv
+            b = simplekv.BackendWrapper(store=FilesystemStore(%r))
+            b.put(simplekv.Key('X', 1), {'a': 1})
+        ''' % root
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(simplekv.__file__)))))
+        subprocess.check_call([sys.executable, '-c', script], env=env)
+        from simplekv.fs import FilesystemStore
+        store = FilesystemStore(root)
+        self.assertIn(simplekv.INDEX_KEY, store)
+        self.assertNotIn(simplekv.DIRTY_KEY, store)
+
+    def test_dotted_keys(self):
+        from fndb.backend import simplekv, dict, codec
+        # saved before keys were encoded by the codec
+        k = db.Key(BackendTestModel, 'dotted')
+        backend.store.put(dict.dump_key(k), codec.dumps({'a': u'x'}))
+        backend.store.put(simplekv.DIRTY_KEY, '')
+        b = simplekv.BackendWrapper(store=backend.store)
+        self.assertEqual(b.get(k), {'a': u'x'})
+        self.assertIn(k, b.index)
+        self.assertNotIn(dict.dump_key(k), backend.store)
+        b.delete(k)
+        b.close()
+
+    def test_multi_threads(self):
+        from fndb.backend import simplekv
+        b = simplekv.BackendWrapper(store=backend.store, threads=4)
+        try:
+            keys = b.put_multi([(db.Key(BackendTestModel, None), {'a': unicode(i)})
+                                for i in range(10)])
+            self.assertEqual(len(set(keys)), 10)
+            self.assertEqual([v['a'] for v in b.get_multi(keys)],
+                             [unicode(i) for i in range(10)])
+            b.delete_multi(keys[:5])
+            self.assertEqual(b.get_multi(keys)[:5], [None] * 5)
+            self.assertNotIn(keys[0], b.index)
+            self.assertIn(keys[5], b.index)
+        finally:
+            b.close()
+
+class SqliteBackendTest(BaseTest):
+    BACKEND = {'name':'sqlite'}
+
+    def test_pushdown(self):
+        from fndb.backend import sqlite
+        X = BackendTestIndexed
+        for i in range(10):
+            X(i=i, r=[i, i + 10], t=u'text %d' % i).put()
+        # everything is done by sqlite, including the limit
+        q = X.query(X.i > 2, X.r < 5).order(-X.i)
+        sql, params, exact, ordered = sqlite._select(q)
+        self.assertTrue(exact)
+        self.assertTrue(ordered)
+        self.assertEqual([x.i for x in q.fetch(2)], [4, 3])
+        q = X.query(db.OR(X.i == 1, X.i == 7)).order(X.i)
+        self.assertTrue(sqlite._select(q)[2])
+        self.assertEqual([x.i for x in q.fetch()], [1, 7])
+        # unindexed properties are filtered after loading the entities
+        q = X.query(X.t == u'text 5', X.i >= 5)
+        self.assertFalse(sqlite._select(q)[2])
+        self.assertEqual([x.i for x in q.fetch(1)], [5])
+        q = X.query(db.OR(X.t == u'text 5', X.i == 7))
+        self.assertEqual(sqlite._select(q)[:3], sqlite._select(X.query())[:2] + (False,))
+        self.assertEqual(sorted(x.i for x in q.fetch()), [5, 7])
+
+    def test_file(self):
+        from fndb.backend import sqlite
+        path = str(uuid.uuid1())
+        os.mkdir(path)
+        try:
+            filename = os.path.join(path, 'db.sqlite')
+            b = sqlite.BackendWrapper(filename=filename)
+            k = b.put(db.Key(BackendTestModel, None), {'a': u'1'})
+            b.close()
+            b = sqlite.BackendWrapper(filename=filename)
+            self.assertEqual(b.get(k), {'a': u'1'})
+            b.delete(k)
+            self.assertIsNone(b.get(k))
+            b.close()
+        finally:
+            shutil.rmtree(path)
+
+class MmapStoreBackendTest(BaseTest):
+
+    def setUp(self):
+        self.path = os.path.join(str(uuid.uuid1()), 'data')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def open(self, **kwargs):
+        from fndb.backend import mmapstore
+        return mmapstore.BackendWrapper(path=self.path, **kwargs)
+
+    def segments(self):
+        from fndb.backend import mmapstore
+        return sorted(name for name in os.listdir(self.path)
+                      if name.endswith(mmapstore.SEGMENT_SUFFIX))
+
+    def test_reopen(self):
+        from fndb.backend import mmapstore
+        b = self.open()
+        k1 = b.put(db.Key(BackendTestModel, None), {'a': u'1'})
+        k2 = b.put(db.Key(BackendTestModel, None), {'a': u'2'})
+        b.put(k1, {'a': u'3'})
+        b.delete(k2)
+        b.close()
+        # with the index saved by close()
+        b = self.open()
+        self.assertEqual(b.get(k1), {'a': u'3'})
+        self.assertIsNone(b.get(k2))
+        self.assertEqual(b.keys(), [k1])
+        # in key order
+        more = [db.Key(BackendTestModel, i) for i in (20, 3, 100)]
+        b.put_multi([(k, {'a': u''}) for k in more])
+        self.assertEqual(b.keys(), sorted(more + [k1]))
+        b.delete_multi(more)
+        self.assertIn(k1, b.index)
+        k3 = b.put(db.Key(BackendTestModel, None), {'a': u'4'})
+        b._file.flush()
+        # and without it, as if the process died
+        self.assertFalse(os.path.exists(os.path.join(self.path, mmapstore.INDEX_FILE)))
+        b = self.open()
+        self.assertEqual(b.get_multi([k1, k2, k3]), [{'a': u'3'}, None, {'a': u'4'}])
+        self.assertNotIn(k2, b.index)
+        self.assertIn(k3, b.index)
+        b.close()
+
+    def test_torn_write(self):
+        b = self.open(sync_every=0)
+        k1 = b.put(db.Key(BackendTestModel, None), {'a': u'1'})
+        b.close()
+        os.remove(os.path.join(self.path, 'index'))
+        segment = os.path.join(self.path, self.segments()[-1])
+        size = os.path.getsize(segment)
+        with open(segment, 'ab') as f:
+            f.write('\x00\x00\x01\x00garbage')
+        b = self.open()
+        self.assertEqual(b.get(k1), {'a': u'1'})
+        self.assertEqual(os.path.getsize(segment), size)
+        k2 = b.put(db.Key(BackendTestModel, None), {'a': u'2'})
+        b.close()
+        os.remove(os.path.join(self.path, 'index'))
+        b = self.open()
+        self.assertEqual(b.get_multi([k1, k2]), [{'a': u'1'}, {'a': u'2'}])
+        b.close()
+
+    def test_merge(self):
+        b = self.open(segment_size=1024, merge_segments=100)
+        keys = [b.put(db.Key(BackendTestModel, None), {'a': u'x' * 100})
+                for _ in range(50)]
+        for k in keys[:25]:
+            b.put(k, {'a': u'y'})
+        b.delete(keys[-1])
+        self.assertGreater(len(self.segments()), 3)
+        b.merge(wait=True)
+        # the full segments are merged into one
+        self.assertEqual(len(self.segments()), 2)
+        self.assertEqual(b.get_multi(keys[:25]), [{'a': u'y'}] * 25)
+        self.assertEqual(b.get_multi(keys[25:-1]), [{'a': u'x' * 100}] * 24)
+        self.assertIsNone(b.get(keys[-1]))
+        b.close()
+        os.remove(os.path.join(self.path, 'index'))
+        b = self.open()
+        self.assertEqual(b.get_multi(keys[:25]), [{'a': u'y'}] * 25)
+        self.assertEqual(b.get_multi(keys[25:-1]), [{'a': u'x' * 100}] * 24)
+        self.assertIsNone(b.get(keys[-1]))
+        self.assertEqual(len(b.keys()), 49)
+        b.close()
+
+    def test_interrupted_merge(self):
+        b = self.open(segment_size=1024, merge_segments=100)
+        keys = [b.put(db.Key(BackendTestModel, None), {'a': unicode(i) * 100})
+                for i in range(20)]
+        b.close()
+        before = self.segments()
+        first = os.path.join(self.path, before[0])
+        with open(first, 'rb') as f:
+            data = f.read()
+        b = self.open()
+        b.merge(wait=True)
+        b.close()
+        # as if the process died before the merged segments got removed
+        with open(first, 'wb') as f:
+            f.write(data)
+        os.remove(os.path.join(self.path, 'index'))
+        b = self.open()
+        self.assertEqual(self.segments(), [before[-2], before[-1]])
+        self.assertEqual([v['a'][0] for v in b.get_multi(keys)],
+                         [unicode(i)[0] for i in range(20)])
+        b.close()
+
+    def test_query(self):
+        X = BackendTestOrder
+        b = self.open()
+        for i in range(5):
+            b.put(db.Key(X, None), {'status': u'a' if i % 2 else u'b',
+                                    'created': i, 'tags': []})
+        q = X.query(X.status == u'b').order(-X.created)
+        self.assertEqual([x.created for x in b.query(q)], [4, 2, 0])
+        b.close()
+
+class CacheBackendTest(BaseTest):
+    BACKEND = {'name':'cache', 'backend':{'name':'dict'}, 'max_entries':3}
+
+    def setUp(self):
+        backend.clear()
+
+    def test_cache(self):
+        x = BackendTestModel(a='x').put()
+        stats = backend.stats()
+        self.assertEqual(x.key.get(), x)
+        missing = db.Key(BackendTestModel, 'missing')
+        self.assertEqual(backend.get_multi([x.key, missing, missing]), [{'a': 'x'}, None, None])
+        self.assertEqual(backend.stats()['hits'], stats['hits'] + 2)
+        self.assertEqual(backend.stats()['misses'], stats['misses'] + 1)
+        # writes go through to the cached backend and update the cache
+        x.a = 'y'
+        x.put()
+        self.assertEqual(backend.backend.get(x.key), {'a': 'y'})
+        self.assertEqual(x.key.get().a, 'y')
+        x.key.delete()
+        self.assertIsNone(backend.backend.get(x.key))
+        self.assertIsNone(backend.get(x.key))
+        self.assertEqual(backend.stats()['misses'], stats['misses'] + 1)
+
+    def test_values_not_shared(self):
+        x = BackendTestIndexed(r=[1])
+        x.put()
+        x.r.append(2)
+        self.assertEqual(backend.get(x.key)['r'], [1])
+
+    def test_eviction(self):
+        keys = [BackendTestModel(a=str(i)).put().key for i in range(4)]
+        stats = backend.stats()
+        self.assertEqual(stats['entries'], 3)
+        self.assertEqual(stats['evictions'], 1)
+        backend.get(keys[0])
+        self.assertEqual(backend.stats()['misses'], stats['misses'] + 1)
+        # keys[1] was the least recently used
+        backend.get(keys[2])
+        self.assertEqual(backend.stats()['hits'], stats['hits'] + 1)
+        backend.get(keys[1])
+        self.assertEqual(backend.stats()['misses'], stats['misses'] + 2)
+
+    def test_limits(self):
+        from fndb.backend import cache
+        b = cache.BackendWrapper(backend={'name':'dict'}, max_entries=None,
+                                 max_bytes=200, ttl=60, cache_misses=False)
+        keys = b.put_multi([(db.Key(BackendTestModel, None), {'a': 'x' * 50})
+                            for i in range(5)])
+        self.assertLessEqual(b.stats()['bytes'], 200)
+        self.assertLess(b.stats()['entries'], 5)
+        b.get(db.Key(BackendTestModel, 'missing'))
+        b.get(db.Key(BackendTestModel, 'missing'))
+        self.assertEqual(b.stats()['hits'], 0)
+        b.ttl = -1
+        b.put(keys[0], {'a': 'y'})
+        self.assertEqual(b.get(keys[0]), {'a': 'y'})
+        self.assertEqual(b.stats()['hits'], 0)
+        b.close()
+
+class CodecTest(BaseTest):
+
+    def test_roundtrip(self):
+        from fndb.backend import codec
+        import datetime
+        key = db.Key(BackendTestModel, 1, BackendTestChild, 'x')
+        values = [
+            {},
+            {'a': u'\xe9t\xe9', 'b': 'bytes\xff', 'i': -5, 'f': 1.5, 't': True,
+             'n': None, 'd': datetime.datetime(2013, 5, 6, 7, 8, 9, 10)},
+            {'k': key, 'r': [1, 2, 3], 'e': [], 's': [u'x' * 300, u'y'],
+             'ks': [key, db.Key(BackendTestModel, 2)], 'tu': (1, u'2'),
+             'big': 2 ** 70, 'l': 5L, 'o': {'x': [1]}, 'long': u'z' * 100000},
+        ]
+        for value in values:
+            data = codec.dumps(value)
+            for loaded in codec.loads(data), codec.loads(buffer('xx' + data, 2)):
+                self.assertEqual(loaded, value)
+                self.assertEqual(dict((k, type(v)) for k, v in loaded.iteritems()),
+                                 dict((k, type(v)) for k, v in value.iteritems()))
+            # only some of the fields
+            for names in [frozenset(), frozenset(value), frozenset(['x']),
+                          frozenset(list(value)[::2] + ['x'])]:
+                self.assertEqual(codec.loads(data, names),
+                                 dict((k, v) for k, v in value.iteritems() if k in names))
+
+    def test_pickled_records(self):
+        from fndb.backend import codec
+        import cPickle as pickle
+        value = {'a': u'1', 'k': db.Key(BackendTestModel, 1)}
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            data = pickle.dumps(value, protocol)
+            self.assertEqual(codec.loads(data), value)
+            self.assertEqual(codec.loads(buffer(data)), value)
+            self.assertEqual(codec.loads(data, frozenset(['a'])), {'a': u'1'})
+
+    def test_key_encoding(self):
+        from fndb.backend import codec
+        import bisect
+        K = db.Key
+        keys = [K('A', 1), K('A', 2), K('A', 10), K('A', -3), K('A', 'a.b'),
+                K('A', 'a'), K('A', 'a\x00'), K('A.b', 1), K('A\x00', 1),
+                K('A', 1, 'B', 1), K('A', 1, 'B', 'x', 'C', 1), K('A', 1, 'C', 1),
+                K('A', 2, 'B', 1), K('B', 1), K('A', 1, 'B', 2 ** 62),
+                K('A', 2 ** 63 - 1), K('A', 2 ** 63), K('A', 2 ** 64), K('A', 2 ** 70),
+                K('A', -2 ** 63), K('A', -2 ** 63 - 1), K('A', -2 ** 64),
+                K('A', -2 ** 70), K('A', 2 ** 70, 'B', 1)]
+        encoded = sorted(codec.encode_key(k) for k in keys)
+        self.assertEqual([codec.decode_key(e) for e in encoded], sorted(keys))
+
+        def scan(ancestor=None, kind=None):
+            start, end = codec.key_range(ancestor, kind)
+            return [codec.decode_key(e) for e in
+                    encoded[bisect.bisect_left(encoded, start):
+                            bisect.bisect_left(encoded, end)]]
+        self.assertEqual(scan(K('A', 1)), [K('A', 1, 'B', 1), K('A', 1, 'B', 2 ** 62),
+                                           K('A', 1, 'B', 'x', 'C', 1), K('A', 1, 'C', 1)])
+        self.assertEqual(scan(K('A', 1), 'C'), [K('A', 1, 'C', 1)])
+        self.assertEqual(scan(kind='A.b'), [K('A.b', 1)])
+        self.assertEqual(len(scan(kind='A')), 21)
+        self.assertEqual(scan(K('A', 2 ** 70)), [K('A', 2 ** 70, 'B', 1)])
+        with self.assertRaises(ValueError):
+            codec.encode_key(K('A', 2 ** 2048))
@@ -6,6 +6,8 @@ from fndb.backend import backend
 from fndb.config import settings
 
 class BaseTest(unittest.TestCase):
+    # the settings.BACKEND used by the tests
+    BACKEND = {'name':'dict'}
 
     @classmethod
     def setUpFilesystemStoreBackend(self):
@@ -22,13 +24,12 @@ class BaseTest(unittest.TestCase):
 
     @classmethod
     def tearDownFilesystemStoreBackend(self):
+        backend.close()
         shutil.rmtree(self.tempdir)
 
     @classmethod
     def setUpClass(self):
-        settings.BACKEND = {
-            'name':'dict'
-        }
+        settings.BACKEND = dict(self.BACKEND)
         backend.reconfigure()
         #self.setUpFilesystemStoreBackend()
 
@@ -10,6 +10,38 @@ class BasicTest(BaseTest):
         self.assertEqual(k.kind(), 'ABC')
         self.assertEqual(k.id(), 'def')
 
+    def test_key_hash(self):
+        from fndb.db import Key
+        k = Key('ABC', 'def', 'GHI', 1)
+        self.assertEqual(hash(k), hash(Key(u'ABC', u'def', 'GHI', 1)))
+        self.assertEqual(len(set([k, Key('ABC', 'def', 'GHI', 1), k.parent()])), 2)
+        self.assertEqual({k: 1}[Key('GHI', 1, parent=Key('ABC', 'def'))], 1)
+        self.assertIs(k.parent(), k.parent())
+        self.assertIsNone(k.parent().parent())
+        self.assertEqual(k.flat(), ('ABC', 'def', 'GHI', 1))
+        self.assertEqual(k.pairs(), (('ABC', 'def'), ('GHI', 1)))
+        self.assertLess(k.parent(), k)
+        self.assertLess(k, Key('ABC', 'deg'))
+        with self.assertRaises(AttributeError):
+            k.x = 1
+
+    def test_key_pickle(self):
+        import cPickle as pickle
+        from fndb.db import Key
+        k = Key('A', 1, 'B', 'x')
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(pickle.loads(pickle.dumps(k, protocol)), k)
+        # as pickled when keys had a list of pairs
+        old = ['ccopy_reg\n_reconstructor\nq\x01(cfndb.db.key\nKey\nq\x02c__builtin__\n'
+               'object\nq\x03NtRq\x04}q\x05U\x0b_Key__pairsq\x06]q\x07((U\x01AK\x01tq'
+               '\x08(U\x01BU\x01xtq\tesb.',
+               '\x80\x02cfndb.db.key\nKey\nq\x01)\x81q\x02}q\x03U\x0b_Key__pairsq\x04]'
+               'q\x05(U\x01AK\x01\x86q\x06U\x01BU\x01x\x86q\x07esb.']
+        for data in old:
+            loaded = pickle.loads(data)
+            self.assertEqual(loaded, k)
+            self.assertEqual(hash(loaded), hash(k))
+
     def test_urlsafe(self):
         from fndb import db
         class URLSafeTestModel(db.Model):
@@ -22,6 +54,31 @@ class BasicTest(BaseTest):
         self.assertEqual(k1, k2)
         self.assertEqual(x1, x2)
 
+    def test_urlsafe_encoding(self):
+        import base64
+        import cPickle as pickle
+        from fndb import db
+        from fndb.config import settings
+        for k in [db.Key('A', 1, 'B', 'x'), db.Key('A', -1), db.Key('A', 2 ** 63 - 1),
+                  db.Key('A', 'x' * 300, 'C', 2 ** 70), db.Key('A', None)]:
+            self.assertEqual(db.Key(urlsafe=k.urlsafe()), k)
+            self.assertEqual(db.Key(urlsafe=unicode(k.urlsafe())), k)
+        self.assertEqual(db.Key(urlsafe=db.Key('B', 2).urlsafe(), parent=db.Key('A', 1)),
+                         db.Key('A', 1, 'B', 2))
+        for bad in ['', 'AQE', 'AQFB', '!!!', 'AQFBBA']:
+            with self.assertRaises(ValueError):
+                db.Key(urlsafe=bad)
+        # made by earlier versions, only loaded when asked for
+        legacy = base64.b64encode(pickle.dumps([('A', 1), ('B', 'x')]))
+        legacy = legacy.rstrip('=').replace('+', '-').replace('/', '_')
+        with self.assertRaises(ValueError):
+            db.Key(urlsafe=legacy)
+        settings.PICKLED_URLSAFE_KEYS = True
+        try:
+            self.assertEqual(db.Key(urlsafe=legacy), db.Key('A', 1, 'B', 'x'))
+        finally:
+            settings.PICKLED_URLSAFE_KEYS = None
+
     def test_basic(self):
         from fndb import db
 
@@ -159,3 +216,71 @@ class BasicTest(BaseTest):
 
         x = TestRepeated()
         self.assertFalse('x' in x.a)
+
+    def test_load_skips_validation(self):
+        from fndb import db
+        validated = []
+        def validator(prop, value):
+            validated.append(value)
+            return value
+        class TestLoadValidation(db.Model):
+            a = db.StringProperty(validator=validator)
+            b = db.IntegerProperty(repeated=True)
+            c = db.StringProperty(name='x', default='C')
+        x = TestLoadValidation(a='a', b=[1, 2]).put()
+        del validated[:]
+        y = x.key.get()
+        self.assertEqual(validated, [])
+        self.assertEqual(y, x)
+        self.assertEqual((y.a, y.b, y.c), ('a', [1, 2], 'C'))
+        # the lists aren't shared with the backend
+        y.b.append(3)
+        self.assertEqual(x.key.get().b, [1, 2])
+        y.a = 'b'
+        self.assertEqual(validated, ['b'])
+
+    def test_plan(self):
+        import datetime
+        from fndb import db
+        class TestPlanBase(db.Model):
+            b = db.StringProperty(required=True)
+            hidden = db.StringProperty()
+        class TestPlan(TestPlanBase):
+            a = db.IntegerProperty(name='z', repeated=True)
+            created = db.DateTimeProperty(auto_now_add=True)
+            updated = db.DateTimeProperty(auto_now=True)
+            hidden = None
+        plan = TestPlan._plan
+        self.assertEqual([p._name for p in plan.properties], ['b', 'created', 'updated', 'z'])
+        self.assertEqual(plan.pre_put, (TestPlan.created, TestPlan.updated))
+        self.assertEqual(plan.required, (TestPlan.b,))
+        self.assertEqual(plan.repeated, frozenset(['z']))
+        self.assertEqual(plan.code_names['z'], 'a')
+        self.assertIs(plan.names['a'], TestPlan.a)
+        with self.assertRaises(ValueError):
+            TestPlan().put()
+        x = TestPlan(b='b', a=[1]).put()
+        self.assertIsInstance(x.created, datetime.datetime)
+        created, updated = x.created, x.updated
+        x.put()
+        self.assertEqual(x.created, created)
+        self.assertGreaterEqual(x.updated, updated)
+        self.assertEqual(x.to_dict(exclude=['created', 'updated']), {'a': [1], 'b': 'b'})
+        self.assertEqual(x.key.get(), x)
+
+    def test_multi(self):
+        from fndb import db
+        class TestMulti(db.Model):
+            a = db.IntegerProperty()
+        xs = [TestMulti(a=i) for i in range(5)]
+        keys = db.put_multi(xs)
+        self.assertEqual(len(keys), 5)
+        self.assertEqual([x.key for x in xs], keys)
+        self.assertTrue(all(k.id() is not None for k in keys))
+        missing = db.Key(TestMulti, 'missing')
+        ys = db.get_multi(keys + [missing])
+        self.assertEqual(ys[:5], xs)
+        self.assertIsNone(ys[5])
+        db.delete_multi(keys[:3])
+        self.assertEqual(db.get_multi(keys), [None, None, None] + xs[3:])
+        self.assertEqual(len(TestMulti.query().fetch()), 2)
@@ -0,0 +1,115 @@
+from basetest import BaseTest
+
+__all__ = ['ContextTest']
+
+class ContextTest(BaseTest):
+    def setUp(self):
+        from fndb import db
+        class CachedModel(db.Model):
+            a = db.IntegerProperty()
+        class UncachedModel(db.Model):
+            _use_cache = False
+            a = db.IntegerProperty()
+        self.Cached = CachedModel
+        self.Uncached = UncachedModel
+
+    def test_identity(self):
+        from fndb import db
+        x = self.Cached(a=1).put()
+        self.assertIsNot(x.key.get(), x)
+        with db.Context() as ctx:
+            self.assertIs(db.get_context(), ctx)
+            y = x.key.get()
+            self.assertIs(x.key.get(), y)
+            self.assertIs(self.Cached.get_by_id(x.key.id()), y)
+            self.assertEqual(db.get_multi([x.key]), [y])
+            self.assertIs(self.Cached.query().get(), y)
+            ctx.clear_cache()
+            self.assertIsNot(x.key.get(), y)
+        self.assertIsNone(db.get_context())
+
+    def test_invalidation(self):
+        from fndb import db
+        from fndb.backend import backend
+        x = self.Cached(a=1).put()
+        with db.Context() as outer:
+            x.key.get()
+            with db.Context():
+                y = x.key.get()
+                y.a = 2
+                y.put()
+                self.assertIs(x.key.get(), y)
+            self.assertEqual(x.key.get().a, 2)
+            z = self.Cached(a=3).put()
+            self.assertIs(z.key.get(), z)
+            z.key.delete()
+            with self.assertRaises(KeyError):
+                z.key.get()
+            self.assertEqual(db.get_multi([z.key]), [None])
+            db.put_multi([z])
+            self.assertIs(z.key.get(), z)
+            db.delete_multi([z.key])
+            with self.assertRaises(KeyError):
+                z.key.get()
+            # writes that don't go through the context aren't seen
+            backend.put(x.key, {'a': 4})
+            self.assertEqual(x.key.get().a, 2)
+
+    def test_opt_out(self):
+        from fndb import db
+        x = self.Uncached(a=1).put()
+        with db.Context():
+            self.assertIsNot(x.key.get(), x)
+            self.assertIsNot(x.key.get(), x.key.get())
+            self.assertIsNot(self.Uncached.query().get(), x)
+
+    def test_middleware(self):
+        from fndb import db
+        x = self.Cached(a=1).put()
+        seen = []
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            seen.append(db.get_context())
+            def body():
+                seen.append(x.key.get() is x.key.get())
+                yield 'ok'
+            return body()
+        result = db.ContextMiddleware(app)({}, lambda status, headers: None)
+        self.assertEqual(list(result), ['ok'])
+        self.assertIsNotNone(seen[0])
+        self.assertTrue(seen[1])
+        result.close()
+        self.assertIsNone(db.get_context())
+
+    def test_async_on_exit(self):
+        from fndb import db
+        with db.Context():
+            future = self.Uncached(a=11).put_async()
+        self.assertEqual(future.get_result().key.get().a, 11)
+        try:
+            with db.Context():
+                future = self.Uncached(a=12).put_async()
+                raise KeyError
+        except KeyError:
+            pass
+        self.assertRaises(RuntimeError, future.get_result)
+        self.assertIsNone(self.Uncached.query(self.Uncached.a == 12).get())
+
+    def test_middleware_async(self):
+        from fndb import db
+        futures = []
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            futures.append(self.Uncached(a=13).put_async())
+            return ['ok']
+        result = db.ContextMiddleware(app)({}, lambda status, headers: None)
+        self.assertEqual(list(result), ['ok'])
+        result.close()
+        self.assertEqual(futures[0].get_result().key.get().a, 13)
+        def failing(environ, start_response):
+            futures.append(self.Uncached(a=14).put_async())
+            raise KeyError
+        self.assertRaises(KeyError, db.ContextMiddleware(failing), {},
+                          lambda status, headers: None)
+        self.assertRaises(RuntimeError, futures[1].get_result)
+        self.assertIsNone(self.Uncached.query(self.Uncached.a == 14).get())
@@ -0,0 +1,136 @@
+from basetest import BaseTest
+from fndb import db
+from fndb.backend import backend
+
+__all__ = ['FutureTest']
+
+class FutureTestModel(db.Model):
+    a = db.IntegerProperty()
+
+class FutureTest(BaseTest):
+    def setUp(self):
+        self.calls = []
+        b = backend._backend
+        for name in ('get_multi', 'put_multi'):
+            def call(arg, name=name, method=getattr(b, name)):
+                arg = list(arg)
+                self.calls.append((name, len(arg)))
+                return method(arg)
+            setattr(b, name, call)
+
+    def tearDown(self):
+        b = backend._backend
+        del b.get_multi
+        del b.put_multi
+
+    def test_batching(self):
+        xs = [FutureTestModel(a=i) for i in range(3)]
+        futures = [x.put_async() for x in xs]
+        futures += db.put_multi_async([FutureTestModel(a=3)])
+        self.assertEqual(self.calls, [])
+        self.assertIs(futures[0].get_result(), xs[0])
+        self.assertEqual(self.calls, [('put_multi', 4)])
+        self.assertTrue(all(f.done() for f in futures))
+        keys = [f.get_result().key for f in futures]
+        missing = db.Key(FutureTestModel, 'missing')
+        gets = [k.get_async() for k in keys] + db.get_multi_async([missing])
+        db.wait_all(gets)
+        self.assertEqual(self.calls[1:], [('get_multi', 5)])
+        self.assertEqual([f.get_result().a for f in gets[:4]], range(4))
+        self.assertIsInstance(gets[4].get_exception(), KeyError)
+        with self.assertRaises(KeyError):
+            gets[4].get_result()
+
+    def test_order(self):
+        x = FutureTestModel(a=1)
+        x.put()
+        x.a = 2
+        put = x.put_async()
+        get = x.key.get_async()
+        y = FutureTestModel(a=3)
+        y.put_async()
+        self.assertIsNone(y.key)
+        self.assertEqual(get.get_result().a, 2)
+        self.assertTrue(put.done())
+        # everything queued is sent, in the order it was queued
+        self.assertEqual(self.calls, [('put_multi', 1), ('put_multi', 1), ('get_multi', 1),
+                                      ('put_multi', 1)])
+        self.assertIsNotNone(y.key)
+
+    def test_fetch_async(self):
+        class FutureQueryModel(db.Model):
+            a = db.IntegerProperty()
+        FutureQueryModel(a=1).put_async()
+        q = FutureQueryModel.query()
+        futures = [q.fetch_async(), q.filter(FutureQueryModel.a == 2).fetch_async()]
+        self.assertEqual([x.a for x in futures[0].get_result()], [1])
+        self.assertEqual(futures[1].get_result(), [])
+        with db.Context():
+            x = FutureQueryModel.query().get()
+            self.assertIs(q.fetch_async().get_result()[0], x)
+
+    def test_read_your_writes(self):
+        class FutureReadModel(db.Model):
+            a = db.IntegerProperty()
+        X = FutureReadModel
+        x = X(key=db.Key(X, 'x'), a=1)
+        x.put_async()
+        self.assertEqual(x.key.get().a, 1)
+        y = X(key=db.Key(X, 'y'), a=2)
+        y.put_async()
+        self.assertEqual([e.a for e in db.get_multi([y.key])], [2])
+        X(a=3).put_async()
+        self.assertEqual(X.query().count(), 3)
+        X(a=4).put_async()
+        self.assertEqual(sorted(e.a for e in X.query().fetch()), [1, 2, 3, 4])
+
+    def test_thread_end(self):
+        import gc
+        import threading
+        import time
+        class FutureThreadModel(db.Model):
+            a = db.IntegerProperty()
+        futures = []
+        # a thread that ends without waiting for its put
+        thread = threading.Thread(
+            target=lambda: futures.append(FutureThreadModel(a=1).put_async()))
+        thread.start()
+        thread.join()
+        # the thread's locals go a little after join() returns
+        for _ in range(100):
+            gc.collect()
+            if futures[0].done():
+                break
+            time.sleep(0.01)
+        self.assertTrue(futures[0].done())
+        self.assertEqual([e.a for e in FutureThreadModel.query()], [1])
+
+    def test_exit(self):
+        import os, subprocess, sys, tempfile, shutil
+        from simplekv.fs import FilesystemStore
+        from fndb.backend import simplekv
+        root = tempfile.mkdtemp()
+        try:
+            # a process that exits without waiting for its put
+            script = '''if 1:
+                from fndb.config import settings
+                settings.BACKEND = {'name': 'simplekv', 'root': %r,
+                                    'store': 'simplekv.fs.FilesystemStore'}
+                from fndb import db
+                class X(db.Model):
+                    a = db.IntegerProperty()
+                # the backend is made (and saves its index at exit) before
+                X.query().count()
+                X(key=db.Key(X, 1), a=1).put_async()
+            ''' % root
+            env = os.environ.copy()
+            env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+                os.path.dirname(os.path.abspath(simplekv.__file__))))
+            subprocess.check_call([sys.executable, '-c', script], env=env)
+            store = FilesystemStore(root)
+            # the index was saved after it
+            self.assertNotIn(simplekv.DIRTY_KEY, store)
+            b = simplekv.BackendWrapper(store=store)
+            self.assertEqual(b.get(db.Key('X', 1)), {'a': 1})
+        finally:
+            shutil.rmtree(root)
@@ -1,11 +1,13 @@
 import unittest
+import base64
 import os
 import uuid
 import shutil
 from basetest import BaseTest
 from fndb.config import settings
 
-__all__ = ['QueryTest']
+__all__ = ['QueryTest', 'SqliteQueryTest', 'SimpleKVQueryTest', 'MmapStoreQueryTest',
+           'CacheQueryTest']
 
 from fndb import db
 class QueryTestModel(db.Model):
@@ -14,6 +16,15 @@ class QueryTestModel(db.Model):
 class QueryTestModel2(db.Model):
     a = db.StringProperty(repeated=True)
 
+class QueryTestChild(db.Model):
+    a = db.StringProperty()
+
+class QueryTestProjection(db.Model):
+    a = db.StringProperty()
+    b = db.IntegerProperty()
+    c = db.StringProperty(repeated=True)
+    body = db.TextProperty()
+
 class QueryTest(BaseTest):
 
     @classmethod
@@ -73,3 +84,480 @@ class QueryTest(BaseTest):
         q = QueryTestModel2.query(QueryTestModel2.a != '1')
         r = q.fetch()
         self.assertEqual(len(r), 6)
+
+    def test_ancestor(self):
+        p = QueryTestChild(a='p').put()
+        c1 = QueryTestChild(parent=p.key, a='c').put()
+        c2 = QueryTestChild(parent=p.key, a='c').put()
+        q = db.Query(kind=QueryTestChild._get_kind(), ancestor=p.key)
+        r = q.fetch()
+        self.assertEqual(sorted(x.key for x in r), sorted([c1.key, c2.key]))
+        self.assertEqual(r[0].key.parent(), p.key)
+        self.assertEqual(q.count(), 2)
+        self.assertEqual(q.filter(QueryTestChild.a == 'c').count(), 2)
+        self.assertEqual(q.filter(QueryTestChild.a == 'p').count(), 0)
+
+    def test_string_ids(self):
+        from fndb.backend import backend
+        # ids that look like the parts of a dumped key are kept as they are
+        p = QueryTestChild(key=db.Key(QueryTestChild, 'a.b'), a='p').put()
+        c = QueryTestChild(parent=p.key, id='c.I1', a='c').put()
+        try:
+            self.assertEqual(p.key.get().a, 'p')
+            self.assertEqual(c.key.get().key, c.key)
+            q = db.Query(kind=QueryTestChild._get_kind(), ancestor=p.key)
+            self.assertEqual([x.key for x in q.fetch()], [c.key])
+            self.assertEqual(q.fetch(keys_only=True), [c.key])
+            self.assertIn(c.key, backend.keys())
+        finally:
+            c.key.delete()
+            p.key.delete()
+
+    def test_large_ids(self):
+        class QueryLargeId(db.Model):
+            a = db.IntegerProperty()
+        X = QueryLargeId
+        ids = [-2 ** 70, -2 ** 63 - 1, -2 ** 63, -1, 1, 2 ** 63 - 1, 2 ** 63, 2 ** 70]
+        db.put_multi([X(key=db.Key(X, id), a=2 ** 70) for id in reversed(ids)])
+        self.assertEqual(db.Key(X, 2 ** 70).get().key.id(), 2 ** 70)
+        self.assertEqual(sorted(x.key.id() for x in X.query().fetch()), ids)
+        self.assertEqual(sorted(x.key.id() for x in X.query(X.a == 2 ** 70).fetch()), ids)
+        # the cursors hold the keys and the values too
+        pages = []
+        cursor = None
+        while True:
+            results, cursor, more = X.query().order(X.a).fetch_page(3, start_cursor=cursor)
+            pages.append([x.key.id() for x in results])
+            if not more:
+                break
+        self.assertEqual(pages, [ids[:3], ids[3:6], ids[6:]])
+
+    def test_key_filters(self):
+        X = QueryTestModel
+        keys = sorted(x.key for x in X.query().fetch())
+        k = keys[3]
+        self.assertEqual([x.key for x in X.query(X._key == k).fetch()], [k])
+        self.assertEqual(X.query(X._key == k).fetch(keys_only=True), [k])
+        self.assertEqual(X.query(X._key == k).count(), 1)
+        self.assertEqual(X.query(X._key == k, X.a == k.get().a).count(), 1)
+        self.assertEqual(X.query(X._key == db.Key(QueryTestChild, k.id())).fetch(), [])
+        self.assertEqual(sorted(x.key for x in X.query(X._key > k).fetch()), keys[4:])
+        self.assertEqual(sorted(X.query(X._key <= k).fetch(keys_only=True)), keys[:4])
+        self.assertEqual(X.query(X._key > k).count(), len(keys) - 4)
+        self.assertEqual(X.query(X._key > k).order(-X._key).fetch(keys_only=True),
+                         keys[:3:-1])
+
+    def test_none_values(self):
+        class QueryNoneModel(db.Model):
+            a = db.IntegerProperty()
+        X = QueryNoneModel
+        db.put_multi([X(a=None), X(a=1), X(a=5)])
+        def fetch(*filters):
+            return sorted(x.a for x in X.query(*filters).fetch())
+        # None sorts before everything else, like it does in python
+        self.assertEqual(fetch(X.a < 3), [None, 1])
+        self.assertEqual(fetch(X.a <= 1), [None, 1])
+        self.assertEqual(fetch(X.a != 1), [None, 5])
+        self.assertEqual(fetch(X.a > 1), [5])
+        self.assertEqual(fetch(X.a == None), [None])
+        self.assertEqual(X.query(X.a < 3).count(), 2)
+        self.assertEqual(len(X.query(X.a != 1).fetch(keys_only=True)), 2)
+        self.assertEqual([x.a for x in X.query().order(X.a).fetch()], [None, 1, 5])
+
+    def test_datetime_values(self):
+        import datetime
+        class QueryDateModel(db.Model):
+            created = db.DateTimeProperty()
+            n = db.IntegerProperty()
+            note = db.StringProperty(indexed=False)
+        X = QueryDateModel
+        t = datetime.datetime(2013, 5, 6, 7, 8, 9)
+        day = datetime.timedelta(days=1)
+        db.put_multi([X(created=t - day, n=1, note='x'), X(created=t, n=2, note='x'),
+                      X(created=t + day, n=3, note='x'), X(n=4, note='x')])
+        def fetch(*filters):
+            return sorted(x.n for x in X.query(*filters).fetch())
+        self.assertEqual(fetch(X.created > t), [3])
+        self.assertEqual(fetch(X.created >= t), [2, 3])
+        self.assertEqual(fetch(X.created > t - day, X.created < t + day), [2])
+        self.assertEqual(fetch(X.created == t), [2])
+        # an unset datetime sorts before any datetime
+        self.assertEqual(fetch(X.created < t), [1, 4])
+        self.assertEqual(fetch(X.created != t), [1, 3, 4])
+        self.assertEqual(fetch(X.created == None), [4])
+        # checked against the entities (the note isn't indexed)
+        self.assertEqual(fetch(X.created < t, X.note == 'x'), [1, 4])
+        self.assertEqual(fetch(X.created > t, X.note == 'x'), [3])
+        self.assertEqual(X.query(X.created > t).count(), 1)
+        self.assertEqual(X.query(X.created < t).count(), 2)
+        self.assertEqual([x.n for x in X.query().order(X.created).fetch()], [4, 1, 2, 3])
+        self.assertEqual([x.n for x in X.query().order(-X.created).fetch()], [3, 2, 1, 4])
+        results, cursor, _ = X.query().order(X.created).fetch_page(2)
+        self.assertEqual([x.n for x in results], [4, 1])
+        results, _, _ = X.query().order(X.created).fetch_page(2, start_cursor=cursor)
+        self.assertEqual([x.n for x in results], [2, 3])
+
+    def test_order_empty_lists(self):
+        class QueryEmptyList(db.Model):
+            tags = db.StringProperty(repeated=True)
+            n = db.IntegerProperty()
+        X = QueryEmptyList
+        db.put_multi([X(tags=['b', 'c'], n=1), X(tags=[], n=2), X(tags=['a'], n=3),
+                      X(tags=[], n=4)])
+        # entities with an empty list sort as None, first ascending and last
+        # descending (in key order among themselves)
+        empty = [x.n for x in sorted(X.query(X.n.IN([2, 4])).fetch(), key=lambda x: x.key)]
+        self.assertEqual([x.n for x in X.query().order(X.tags).fetch()], empty + [3, 1])
+        self.assertEqual([x.n for x in X.query().order(-X.tags).fetch()], [1, 3] + empty)
+        self.assertEqual([x.n for x in X.query(X.tags >= 'a').order(X.tags).fetch()], [3, 1])
+        self.assertEqual(len(X.query().order(X.tags).fetch(keys_only=True)), 4)
+
+    def test_generic_scan(self):
+        from fndb.backend import backend, utils
+        q = QueryTestModel.query(QueryTestModel.a == '5')
+        r = list(utils.scan(q, backend))
+        self.assertEqual(len(r), 4)
+        self.assertEqual(sorted(x.key for x in r), sorted(x.key for x in q.fetch()))
+        self.assertEqual(len(list(utils.scan(q, backend, 2))), 2)
+
+    def test_order(self):
+        X = QueryTestModel
+        r = X.query().order(X.a).fetch()
+        self.assertEqual([x.a for x in r], ['1', '2', '3', '4', '5', '5', '5', '5'])
+        r = X.query().order(-X.a).fetch(3)
+        self.assertEqual([x.a for x in r], ['5', '5', '5'])
+        r = X.query(X.a < '5').order(-X.a).fetch()
+        self.assertEqual([x.a for x in r], ['4', '3', '2', '1'])
+        self.assertEqual(X.query().order(-X.a).get().a, '5')
+
+    def test_order_multiple(self):
+        class QueryOrderModel(db.Model):
+            a = db.IntegerProperty()
+            b = db.IntegerProperty()
+        X = QueryOrderModel
+        for a, b in [(1, 2), (2, 1), (1, 1), (2, 3), (1, 3)]:
+            X(a=a, b=b).put()
+        r = X.query().order(X.a, -X.b).fetch()
+        self.assertEqual([(x.a, x.b) for x in r], [(1, 3), (1, 2), (1, 1), (2, 3), (2, 1)])
+        r = X.query().order(-X.a).order(X.b).fetch(3)
+        self.assertEqual([(x.a, x.b) for x in r], [(2, 1), (2, 3), (1, 1)])
+
+    def test_order_repeated(self):
+        # ascending uses the smallest value, descending the largest
+        X = QueryTestModel2
+        r = X.query().order(X.a).fetch(2)
+        self.assertEqual([min(x.a) for x in r], ['0', '0'])
+        r = X.query().order(-X.a).fetch()
+        self.assertEqual([max(x.a) for x in r][:2], ['9', '9'])
+        self.assertEqual(max(r[-1].a), '4')
+
+    def test_order_generic_scan(self):
+        from fndb.backend import backend, utils
+        X = QueryTestModel
+        r = list(utils.scan(X.query().order(-X.a), backend, 5))
+        self.assertEqual([x.a for x in r], ['5', '5', '5', '5', '4'])
+
+    def fetch_pages(self, q, page_size):
+        pages = []
+        cursor = None
+        more = True
+        while more:
+            results, cursor, more = q.fetch_page(page_size, start_cursor=cursor)
+            pages.append(results)
+            cursor = db.Cursor(urlsafe=cursor.urlsafe()) if cursor else None
+        return pages
+
+    def test_fetch_page(self):
+        X = QueryTestModel
+        Y = QueryTestModel2
+        for q in [X.query(), X.query(X.a == '5'), X.query().order(-X.a),
+                  X.query(X.a > '1').order(X.a), Y.query().order(-Y.a),
+                  Y.query(Y.a._CONTAINS('1'))]:
+            expected = q.fetch()
+            if q.orders is None:
+                # pages of an unordered query come in key order
+                expected.sort(key=lambda x: x.key)
+            for page_size in (1, 3, len(expected)):
+                pages = self.fetch_pages(q, page_size)
+                self.assertTrue(all(len(p) == page_size for p in pages[:-1]))
+                self.assertEqual([x.key for p in pages for x in p], [x.key for x in expected])
+        results, cursor, more = X.query(X.a == '6').fetch_page(5)
+        self.assertEqual((results, cursor, more), ([], None, False))
+        with self.assertRaises(ValueError):
+            db.Cursor(urlsafe='x.0.')
+        # cursors come from anywhere, they never get unpickled
+        from fndb.backend import codec
+        with self.assertRaises(ValueError):
+            db.Cursor(urlsafe=base64.urlsafe_b64encode(codec.encode_values((None, set([1])))))
+        # nor do they make invalid keys (a tuple of a key with a kind and no id)
+        with self.assertRaises(ValueError):
+            db.Cursor(urlsafe=base64.urlsafe_b64encode('R\x00\x00\x00\x01k\x01s\x01X'))
+
+    def test_fetch_page_changes(self):
+        class QueryPageModel(db.Model):
+            a = db.IntegerProperty()
+        X = QueryPageModel
+        xs = [X(a=i).put() for i in range(10)]
+        keys = set(x.key for x in xs)
+        for q in [X.query(), X.query().order(X.a), X.query().order(-X.a)]:
+            # an entity is added before the cursor
+            first, cursor, more = q.fetch_page(4)
+            self.assertTrue(more)
+            added = X(a=-1 if q.orders is None else first[0].a).put()
+            second, _, more = q.fetch_page(100, start_cursor=cursor)
+            self.assertFalse(more)
+            seen = [x.key for x in first + second]
+            self.assertEqual(len(seen), len(set(seen)))
+            self.assertEqual(set(seen) - set([added.key]), keys)
+            added.key.delete()
+            # the last entity of the page is deleted
+            first, cursor, more = q.fetch_page(4)
+            first[-1].key.delete()
+            second, _, _ = q.fetch_page(100, start_cursor=cursor)
+            self.assertEqual(set(x.key for x in first + second), keys)
+            self.assertEqual(len(first + second), len(keys))
+            first[-1].put()
+
+    def test_fetch_page_loads(self):
+        from fndb.db import model
+        class QueryPageLoads(db.Model):
+            a = db.IntegerProperty()
+        X = QueryPageLoads
+        db.put_multi([X(a=i) for i in range(50)])
+        loads = []
+        from_stored = model.Model.__dict__['_from_stored']
+        def counting(cls, key, value):
+            loads.append(key)
+            return from_stored.__func__(cls, key, value)
+        # the page and the one after it, and for an ordered query the few
+        # entities a binary search for where the cursor is goes through
+        for q, most in [(X.query(), 11), (X.query().order(-X.a), 11 + 6)]:
+            _, cursor, _ = q.fetch_page(10)
+            _, cursor, _ = q.fetch_page(10, start_cursor=cursor)
+            del loads[:]
+            model.Model._from_stored = classmethod(counting)
+            try:
+                results, _, more = q.fetch_page(10, start_cursor=cursor)
+            finally:
+                model.Model._from_stored = from_stored
+            self.assertTrue(more)
+            self.assertEqual(len(results), 10)
+            self.assertLessEqual(len(loads), most)
+
+    def test_fetch_page_plan_changes(self):
+        class QueryPagePlan(db.Model):
+            a = db.IntegerProperty()
+            b = db.IntegerProperty()
+        X = QueryPagePlan
+        db.put_multi([X(a=i, b=20 - i) for i in range(20)])
+        for q in [X.query(X.a >= 5, X.b >= 5), X.query(X.a >= 5, X.b >= 5).order(-X.b)]:
+            expected = [x.key for x in q.fetch()]
+            if q.orders is None:
+                expected.sort()
+            first, cursor, _ = q.fetch_page(4)
+            # the range of the index of a gets bigger than the one of b, so
+            # the backend may go through the other index for the next page
+            added = db.put_multi([X(a=100 + i, b=-1) for i in range(20)])
+            second, _, more = q.fetch_page(100, start_cursor=cursor)
+            self.assertFalse(more)
+            self.assertEqual([x.key for x in first + second], expected)
+            db.delete_multi(added)
+
+    def test_keys_only(self):
+        from fndb.db import model
+        X = QueryTestModel
+        Y = QueryTestModel2
+        exact = [X.query(), X.query(X.a == '5'), X.query(X.a > '2'), X.query().order(-X.a),
+                 X.query(X.a >= '2', X.a < '5'), Y.query(Y.a == '1'), Y.query(Y.a == '6')]
+        loaded = [X.query(X.a._CONTAINS('5')), X.query(X.a > '2').order(X.key),
+                  Y.query(Y.a == '1', Y.a == '2'), Y.query().order(Y.a)]
+        for q in exact + loaded:
+            expected = [x.key for x in q.fetch()]
+            self.assertEqual(q.fetch(keys_only=True), expected)
+            self.assertEqual(q.fetch(2, keys_only=True), expected[:2])
+            self.assertEqual(list(q.iter(keys_only=True)), expected)
+            if q.orders is None:
+                expected.sort()
+            keys, cursor, more = q.fetch_page(3, keys_only=True)
+            self.assertEqual(keys, expected[:3])
+            keys, _, _ = q.fetch_page(100, start_cursor=cursor, keys_only=True)
+            self.assertEqual(keys, expected[3:])
+        # the filters are answered by the index, nothing gets loaded
+        from_stored = model.Model.__dict__['_from_stored']
+        def fail(cls, key, value):
+            raise AssertionError('%r was loaded' % (key,))
+        model.Model._from_stored = classmethod(fail)
+        try:
+            for q in exact:
+                q.fetch(keys_only=True)
+                if q.orders is None:
+                    keys, cursor, _ = q.fetch_page(2, keys_only=True)
+                    q.fetch_page(2, start_cursor=cursor, keys_only=True)
+        finally:
+            model.Model._from_stored = from_stored
+
+    def test_projection(self):
+        from fndb.backend import codec
+        X = QueryTestProjection
+        xs = [X(a=str(i % 3), b=i, c=[str(i), 'x'], body=u'text %d' % i * 100) for i in range(9)]
+        db.put_multi(xs)
+        full = dict((x.key, x) for x in xs)
+        loads = codec.loads
+        names = []
+        def partial_loads(data, fields=None):
+            names.append(fields)
+            return loads(data, fields)
+        codec.loads = partial_loads
+        try:
+            for q, projection in [(X.query(), [X.a]), (X.query(X.b > 4), [X.a, X.c]),
+                                  (X.query(X.a == '1').order(-X.b), ['c']),
+                                  (X.query(X.body._CONTAINS(u'7')), [X.a]),
+                                  (X.query().order(X.b), [X.body, X.a])]:
+                expected = [x.key for x in q.fetch()]
+                del names[:]
+                results = q.fetch(projection=projection)
+                # nothing is decoded in full
+                self.assertNotIn(None, names)
+                self.assertEqual([x.key for x in results], expected)
+                projected = [p if isinstance(p, basestring) else p._code_name
+                             for p in projection]
+                for x in results:
+                    self.assertEqual(x.to_dict(), full[x.key].to_dict(include=projected))
+                    for name in projected:
+                        self.assertEqual(getattr(x, name), getattr(full[x.key], name))
+                    with self.assertRaises(db.UnprojectedPropertyError):
+                        x.b if 'b' not in projected else x.body
+                    self.assertFalse(hasattr(x, 'b' if 'b' not in projected else 'body'))
+        finally:
+            codec.loads = loads
+        x = X.query().get()
+        y = X.query().fetch(1, projection=[X.a])[0]
+        self.assertNotEqual(x, y)
+        self.assertEqual(y, X.query().fetch(1, projection=['a'])[0])
+        with self.assertRaises(ValueError):
+            y.put()
+        with self.assertRaises(ValueError):
+            X.query().fetch(projection=['nope'])
+        with self.assertRaises(ValueError):
+            X.query().fetch(keys_only=True, projection=[X.a])
+        self.assertEqual([x.a for x in X.query().fetch(projection=[X.a])],
+                         [x.a for x in X.query().iter(projection=[X.a])])
+
+    def test_count(self):
+        from fndb.backend import backend
+        from fndb.db import model
+        X = QueryTestModel
+        Y = QueryTestModel2
+        exact = [X.query(), X.query(X.a == '5'), X.query(X.a > '2').order(-X.a),
+                 Y.query(Y.a == '1'), X.query(X.a == '6'), Y.query()]
+        others = [X.query(X.a._CONTAINS('5')), Y.query(Y.a == '1', Y.a == '2')]
+        for q in exact + others:
+            n = len(q.fetch())
+            self.assertEqual(q.count(), n)
+            self.assertEqual(q.count(2), min(n, 2))
+            self.assertEqual(q.count(0), 0)
+        # answered by the backend, or by its indexes without loading anything
+        self.assertEqual(backend.count(X.query()), 8)
+        from_stored = model.Model.__dict__['_from_stored']
+        def fail(cls, key, value):
+            raise AssertionError('%r was loaded' % (key,))
+        model.Model._from_stored = classmethod(fail)
+        try:
+            for q in exact:
+                q.count()
+        finally:
+            model.Model._from_stored = from_stored
+
+    def test_in_or(self):
+        from fndb.backend import utils
+        X = QueryTestModel
+        Y = QueryTestModel2
+        def brute_force(cls, node):
+            return [x for x in cls.query().fetch() if node.matches(x)]
+        for cls, node in [(X, X.a.IN(['1', '5'])), (X, X.a.IN(['2'])), (X, X.a != '5'),
+                          (X, db.OR(X.a < '2', X.a >= '5')), (Y, Y.a.IN(['1', '9'])),
+                          (Y, db.AND(Y.a.IN(['1', '5']), Y.a != '2')),
+                          (X, db.OR(X.a == '3', X.a._CONTAINS('5')))]:
+            expected = brute_force(cls, node)
+            q = cls.query(node)
+            results = q.fetch()
+            self.assertEqual(sorted(x.key for x in results), sorted(x.key for x in expected))
+            self.assertEqual(len(set(x.key for x in results)), len(results))
+            self.assertEqual(sorted(q.fetch(keys_only=True)), sorted(x.key for x in expected))
+            self.assertEqual(q.count(), len(expected))
+            for order in [cls.a, -cls.a]:
+                ordered = q.order(order).fetch()
+                self.assertEqual(sorted(x.key for x in ordered), sorted(x.key for x in expected))
+                order = list(q.order(order).orders)[0]
+                values = [utils._order_value(x, order) for x in ordered]
+                self.assertEqual(values, sorted(values, reverse=order.direction == order.DESCENDING))
+                self.assertEqual(len(q.order(order).fetch(2)), min(2, len(expected)))
+                pages = self.fetch_pages(q.order(order), 2)
+                self.assertEqual(sorted(x.key for p in pages for x in p),
+                                 sorted(x.key for x in expected))
+        self.assertEqual(X.query(X.a.IN([])).fetch(), [])
+        self.assertIsInstance(X.a.IN(['1']), db.FilterNode)
+        with self.assertRaises(ValueError):
+            X.a.IN('15')
+        with self.assertRaises(ValueError):
+            X.a.IN([1])
+
+    def test_parallel(self):
+        X = QueryTestModel2
+        for q, value in [(X.query(X.a == '1'), None),
+                         (X.query(X.a._CONTAINS('9')).order(-X.a), max),
+                         (X.query(db.OR(X.a == '0', X.a > '8')).order(X.a), min),
+                         (X.query(), None)]:
+            expected = q.fetch()
+            r = q.fetch(parallel=2)
+            self.assertEqual(sorted(x.key for x in r), sorted(x.key for x in expected))
+            if value is not None:
+                self.assertEqual([value(x.a) for x in r], [value(x.a) for x in expected])
+            self.assertEqual(len(q.fetch(2, parallel=2)), min(2, len(expected)))
+        self.assertEqual(QueryTestModel.query(QueryTestModel.a == '0').fetch(parallel=2), [])
+
+    def test_pickle(self):
+        import cPickle as pickle
+        X = QueryTestModel2
+        q = X.query(db.OR(X.a == '1', X.a != '5'), X.a._CONTAINS('2')).order(-X.a)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            loaded = pickle.loads(pickle.dumps(q, protocol))
+            self.assertEqual(loaded.filters, q.filters)
+            self.assertEqual(list(loaded.orders), list(q.orders))
+            self.assertEqual(loaded.kind, q.kind)
+
+class SqliteQueryTest(QueryTest):
+    BACKEND = {'name':'sqlite'}
+
+class SimpleKVQueryTest(QueryTest):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tempdir = str(uuid.uuid1())
+        os.mkdir(cls.tempdir)
+        cls.BACKEND = {'name':'simplekv', 'store':'simplekv.fs.FilesystemStore',
+                       'root':cls.tempdir}
+        super(SimpleKVQueryTest, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        from fndb.backend import backend
+        backend.close()
+        shutil.rmtree(cls.tempdir)
+
+class MmapStoreQueryTest(QueryTest):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tempdir = str(uuid.uuid1())
+        cls.BACKEND = {'name':'mmapstore', 'path':cls.tempdir}
+        super(MmapStoreQueryTest, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        from fndb.backend import backend
+        backend.close()
+        shutil.rmtree(cls.tempdir)
+
+class CacheQueryTest(QueryTest):
+    BACKEND = {'name':'cache', 'backend':{'name':'dict'}}